@@ -5,24 +5,360 @@ Flask app for Project 3 - Driver Availability Microservice
 
 import sqlite3
 import os
-import json
-import requests
+import asyncio
+import sys
+import threading
+import heapq
+import math
+from array import array
+from bisect import bisect_left, bisect_right
 from flask import Flask, request, jsonify
 
+import common.db
+from common.wire import msgpack, WireJSONProvider, response_body, get_post_param
+from common.ratelimit import RateLimiter, Admission
+from common.upstream import Upstream
+from common.transport import serve_unix_socket
+from common.auth import TokenVerifier
+from common.db import QueryStats, ChangeNotifier, ChangesFeed
+from common.backup import Backups
+from common.profiling import Profiling
+from common.metrics import Metrics
+from common.memory import MemoryDiagnostics
+from common.asgi import AsgiApp, serve_asgi
+from common.aio import gather, loop_views
+
 app = Flask(__name__)
 db_name = "listings.db"
 sql_file = "listings.sql"
 db_flag = False
 
+# "file" keeps the database in db_name; "memory" uses a shared-cache in-memory
+# database (for tests) that /clear resets from a pristine snapshot
+db_mode = os.environ.get('DB_MODE', 'file')
+memory_anchor = None
+memory_pristine = None
+
+# With KEEP_DB=1 a service starts on the database files already there (restored or
+# bulk-loaded) instead of recreating them; /clear still resets. File mode only
+keep_db = os.environ.get('KEEP_DB', '0') == '1'
+
+# Statements slower than this are logged with their query plan
+slow_query_ms = float(os.environ.get('SLOW_QUERY_MS', '50'))
+
+# /changes long-polls wait at most CHANGES_MAX_WAIT seconds, re-reading the changelog every
+# CHANGES_POLL_INTERVAL for commits by other processes, and return up to CHANGES_BATCH_SIZE
+changes_max_wait = float(os.environ.get('CHANGES_MAX_WAIT', '25'))
+changes_poll_interval = float(os.environ.get('CHANGES_POLL_INTERVAL', '1'))
+changes_batch_size = int(os.environ.get('CHANGES_BATCH_SIZE', '1000'))
+# At most CHANGES_MAX_WAITERS /changes requests wait at once, each holding a thread; past
+# that a request that would wait gets 503 (wait=0 reads are never turned away)
+changes_max_waiters = int(os.environ.get('CHANGES_MAX_WAITERS', '32'))
+
+# Online backups: every BACKUP_INTERVAL seconds (0 turns the schedule off) the database is
+# copied into BACKUP_DIR/<UTC time>/, BACKUP_PAGES pages per step with BACKUP_SLEEP seconds
+# between steps. After BACKUP_MAX_RESTARTS restarts caused by concurrent writes, the rest
+# is copied in one step. The newest BACKUP_KEEP backups are kept
+backup_interval = float(os.environ.get('BACKUP_INTERVAL', '3600'))
+backup_dir = os.environ.get('BACKUP_DIR', 'backups')
+backup_pages = int(os.environ.get('BACKUP_PAGES', '64'))
+backup_sleep = float(os.environ.get('BACKUP_SLEEP', '0.005'))
+backup_max_restarts = int(os.environ.get('BACKUP_MAX_RESTARTS', '3'))
+backup_keep = int(os.environ.get('BACKUP_KEEP', '24'))
+
+# Memory diagnostics (opt-in): MEMORY_DIAGNOSTICS=1 starts tracemalloc with MEMORY_TRACE_FRAMES
+# frames per allocation, enables /internal/memory/snapshots and adds cache sizes in bytes to
+# /metrics. The newest MEMORY_SNAPSHOTS snapshots are kept for diffing
+memory_diagnostics = os.environ.get('MEMORY_DIAGNOSTICS', '0') == '1'
+memory_trace_frames = int(os.environ.get('MEMORY_TRACE_FRAMES', '1'))
+memory_snapshots_kept = int(os.environ.get('MEMORY_SNAPSHOTS', '8'))
+
+# Upper bounds (seconds) of the request latency histogram served at /metrics
+latency_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# End-to-end budget for a request without an X-Request-Timeout header, the cap on a
+# single upstream call, and when a target's circuit breaker opens and re-probes
+request_budget = float(os.environ.get('REQUEST_BUDGET', '10'))
+upstream_timeout = float(os.environ.get('UPSTREAM_TIMEOUT', '2'))
+breaker_failure_threshold = int(os.environ.get('BREAKER_FAILURE_THRESHOLD', '5'))
+breaker_reset_timeout = float(os.environ.get('BREAKER_RESET_TIMEOUT', '10'))
+
+# Encoding of service-to-service bodies: "msgpack" (when installed) or "json"
+wire_format = os.environ.get('WIRE_FORMAT', 'msgpack')
+
+# Base URL of each upstream service; "unix:///path/to.sock" reaches it over a Unix socket
+service_urls = {
+    'user': os.environ.get('USER_URL', 'http://user:5000')
+}
+
+# TCP port to serve on, and also this Unix socket path for co-located services
+port = int(os.environ.get('PORT', '5000'))
+unix_socket = os.environ.get('UNIX_SOCKET', '')
+
+# "wsgi" runs Flask's threaded server, async views included; "asgi" runs uvicorn, serving async
+# views on one event loop with a non-blocking HTTP client and the others on up to asgi_threads threads
+server_mode = os.environ.get('SERVER_MODE', 'wsgi')
+asgi_threads = int(os.environ.get('ASGI_THREADS', '64'))
+asgi_max_connections = int(os.environ.get('ASGI_MAX_CONNECTIONS', '1000'))
+
+# Token-bucket limits per (client, endpoint) and the cap on concurrent public requests
+rate_limit_rate = float(os.environ.get('RATE_LIMIT_RATE', '20'))
+rate_limit_burst = float(os.environ.get('RATE_LIMIT_BURST', '40'))
+rate_limit_max_clients = int(os.environ.get('RATE_LIMIT_MAX_CLIENTS', '100000'))
+public_concurrency = int(os.environ.get('PUBLIC_CONCURRENCY', '4096' if server_mode == 'asgi' else '64'))
+
+# Opt-in profiling: requests signed with PROFILE_SECRET (X-Profile header) or a random
+# PROFILE_SAMPLE_RATE fraction are run under cProfile and saved to PROFILE_DIR
+profile_enabled = os.environ.get('PROFILE_ENABLED', '0') == '1'
+profile_secret = os.environ.get('PROFILE_SECRET', '')
+profile_sample_rate = float(os.environ.get('PROFILE_SAMPLE_RATE', '0'))
+profile_dir = os.environ.get('PROFILE_DIR', 'profiles')
+profile_max_files = int(os.environ.get('PROFILE_MAX_FILES', '200'))
+
+# Endpoints served on the internal lane, exempt from admission control
+internal_endpoints = {'get_listing', 'delete_listing', 'claim_listings', 'release_listings', 'circuit_breakers',
+                      'single_flight_stats', 'profile_summary', 'query_stats_report', 'changes_feed',
+                      'backups_report', 'take_backup', 'metrics', 'memory_report', 'take_memory_snapshot',
+                      'memory_diff', 'clear_db'}
+
+# Revocation feed polling and how stale it may get before cached identities are distrusted
+revocation_poll_interval = float(os.environ.get('REVOCATION_POLL_INTERVAL', '5'))
+revocation_max_staleness = float(os.environ.get('REVOCATION_MAX_STALENESS', '30'))
+verify_cache_size = int(os.environ.get('VERIFY_CACHE_SIZE', '10000'))
+
+# Shared secret for X-Identity headers signed by the gateway (empty ignores them),
+# and how long after signing such a header is accepted
+identity_secret = os.environ.get('IDENTITY_SECRET', '')
+identity_ttl = float(os.environ.get('IDENTITY_TTL', '30'))
+
+valid_days = ['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday']
+
+# Default weights and result size for sort=best ranking
+best_price_weight = float(os.environ.get('SEARCH_PRICE_WEIGHT', '1.0'))
+best_rating_weight = float(os.environ.get('SEARCH_RATING_WEIGHT', '10.0'))
+best_top_k = int(os.environ.get('SEARCH_TOP_K', '10'))
+# sort=best looks up driver ratings for at most SEARCH_MAX_CANDIDATES of the cheapest listings
+# that could still rank; ratings run from 0 to max_rating
+best_max_candidates = int(os.environ.get('SEARCH_MAX_CANDIDATES', '50'))
+max_rating = 5.0
+
+
+class DayListings:
+    """Sorted columns for one day's listings.
+
+    ids/prices/drivers are parallel columns in listingid order. price_keys and
+    price_ids hold the same listings ordered by (price, listingid) so that price
+    ranges and "cheapest N" are contiguous slices.
+    """
+    __slots__ = ('ids', 'prices', 'drivers', 'price_keys', 'price_ids')
+
+    def __init__(self):
+        self.ids = array('q')
+        self.prices = array('d')
+        self.drivers = []
+        self.price_keys = array('d')
+        self.price_ids = array('q')
+
+    def __len__(self):
+        return len(self.ids)
+
+    def _price_position(self, price, listingid):
+        """Position of (price, listingid) in the price-ordered columns"""
+        lo = bisect_left(self.price_keys, price)
+        hi = bisect_right(self.price_keys, price, lo)
+        return bisect_left(self.price_ids, listingid, lo, hi)
+
+    def add(self, listingid, price, driver):
+        pos = bisect_left(self.ids, listingid)
+        self.ids.insert(pos, listingid)
+        self.prices.insert(pos, price)
+        self.drivers.insert(pos, driver)
+        pos = self._price_position(price, listingid)
+        self.price_keys.insert(pos, price)
+        self.price_ids.insert(pos, listingid)
+
+    def remove(self, listingid):
+        pos = bisect_left(self.ids, listingid)
+        if pos == len(self.ids) or self.ids[pos] != listingid:
+            return False
+        price = self.prices[pos]
+        del self.ids[pos]
+        del self.prices[pos]
+        del self.drivers[pos]
+        pos = self._price_position(price, listingid)
+        del self.price_keys[pos]
+        del self.price_ids[pos]
+        return True
+
+    def rows(self):
+        """All listings in listingid order"""
+        return list(zip(self.ids, self.prices, self.drivers))
+
+    def rows_by_price(self, min_price=None, max_price=None, limit=None):
+        """Listings in (price, listingid) order, optionally bounded and truncated"""
+        lo = 0 if min_price is None else bisect_left(self.price_keys, min_price)
+        hi = len(self.price_keys) if max_price is None else bisect_right(self.price_keys, max_price)
+        if limit is not None:
+            hi = min(hi, lo + limit)
+        result = []
+        for listingid in self.price_ids[lo:hi]:
+            pos = bisect_left(self.ids, listingid)
+            result.append((listingid, self.prices[pos], self.drivers[pos]))
+        return result
+
+
+class ListingIndex:
+    """In-memory per-day listing index, written through by create/delete"""
+    __slots__ = ('days', 'day_of', 'lock')
+
+    def __init__(self):
+        self.days = {day: DayListings() for day in valid_days}
+        self.day_of = {}
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.day_of)
+
+    def load(self, conn):
+        """Rebuild the index from the listings table"""
+        cursor = conn.cursor()
+        cursor.execute("SELECT listingid, price, driver_username, day FROM listings ORDER BY listingid")
+        days = {day: DayListings() for day in valid_days}
+        day_of = {}
+        for listingid, price, driver, day in cursor.fetchall():
+            if day not in days:
+                continue
+            days[day].add(listingid, price, sys.intern(driver))
+            day_of[listingid] = day
+        with self.lock:
+            self.days = days
+            self.day_of = day_of
+
+    def add(self, listingid, day, price, driver):
+        with self.lock:
+            if listingid in self.day_of:
+                return
+            self.days[day].add(listingid, float(price), sys.intern(driver))
+            self.day_of[listingid] = day
+
+    def remove(self, listingid):
+        with self.lock:
+            day = self.day_of.pop(listingid, None)
+            if day is not None:
+                self.days[day].remove(listingid)
+
+    def search(self, day, min_price=None, max_price=None, limit=None):
+        """Return (listingid, price, driver) rows for a day.
+
+        Without filters rows come back in listingid order, matching the original
+        SQL query; with a price range or limit they come back cheapest first.
+        """
+        with self.lock:
+            return self._search(day, min_price, max_price, limit)
+
+    def search_days(self, days, min_price=None, max_price=None, limit=None):
+        """Search several days under a single lock acquisition, keyed by day"""
+        with self.lock:
+            return {day: self._search(day, min_price, max_price, limit) for day in days}
+
+    def _search(self, day, min_price, max_price, limit):
+        listings = self.days[day]
+        if min_price is None and max_price is None and limit is None:
+            return listings.rows()
+        return listings.rows_by_price(min_price, max_price, limit)
+
+
+listing_index = ListingIndex()
+
+
+upstream = Upstream(service_urls, request_budget, upstream_timeout, breaker_failure_threshold, breaker_reset_timeout,
+                    wire_format, public_concurrency, app.logger, async_views=True)
+upstream.install(app)
+
+verifier = TokenVerifier(upstream, revocation_poll_interval, revocation_max_staleness, verify_cache_size,
+                         identity_secret, identity_ttl)
+
+# Async views stay async on the ASGI event loop and run as sync views on the threaded server
+loop_view = loop_views(server_mode == 'asgi')
+
+
+rate_limiter = RateLimiter(rate_limit_rate, rate_limit_burst, rate_limit_max_clients)
+admission = Admission(rate_limiter, public_concurrency, internal_endpoints, verifier.client_key)
+admission.install(app)
+
+
+profiling = Profiling(profile_enabled, profile_secret, profile_sample_rate, profile_dir, profile_max_files)
+profiling.install(app)
+
+
+query_stats = QueryStats(slow_query_ms, app.logger)
+change_notifier = ChangeNotifier()
+TimedConnection = common.db.timed_connection(query_stats, change_notifier)
+query_stats.install(app)
+
+
+def backup_sources():
+    """(file name, connect function) for each database file a backup covers"""
+    return [(db_name, connect_db)]
+
+def prepare_backup():
+    if not db_flag:
+        create_db()
+
+metrics = Metrics()
+backups = Backups(backup_dir, backup_pages, backup_sleep, backup_max_restarts, backup_keep, backup_interval,
+                  latency_buckets, app.logger, backup_sources, prepare=prepare_backup)
+backups.install(app, metrics)
+metrics.install(app)
+
+# Caches and in-memory indexes whose size /metrics and /internal/memory report;
+# name -> function returning (object, number of entries)
+memory_caches = {
+    'listing_index': lambda: (listing_index, len(listing_index)),
+    'verified_tokens': lambda: (verifier.verified_tokens, len(verifier.verified_tokens)),
+    'revocations': lambda: (verifier.revocations, len(verifier.revocations.entries)),
+    'rate_limit_buckets': lambda: (rate_limiter.buckets, len(rate_limiter.buckets)),
+    'query_stats': lambda: (query_stats.stats, len(query_stats.stats))
+}
+
+memory = MemoryDiagnostics(memory_caches, memory_diagnostics, memory_trace_frames, memory_snapshots_kept)
+memory.install(app, metrics)
+
+def connect_db():
+    """Open a connection to the service database"""
+    if db_mode == 'memory':
+        return sqlite3.connect(f"file:{db_name}?mode=memory&cache=shared", uri=True, check_same_thread=False,
+                               factory=TimedConnection)
+    return sqlite3.connect(db_name, factory=TimedConnection)
+
 def create_db():
     """Create database from SQL file"""
-    conn = sqlite3.connect(db_name)
-    
-    with open(sql_file, 'r') as sql_startup:
-        init_db = sql_startup.read()
-    cursor = conn.cursor()
-    cursor.executescript(init_db)
-    conn.commit()
+    global memory_anchor, memory_pristine
+    if db_mode == 'memory' and memory_anchor is not None:
+        # Reset from the pristine snapshot instead of re-running the script
+        memory_pristine.backup(memory_anchor)
+        # A restored snapshot restarts the changelog, so it gets a new epoch
+        memory_anchor.execute("UPDATE changelog_epoch SET epoch = lower(hex(randomblob(8)))")
+        memory_anchor.commit()
+    else:
+        conn = connect_db()
+        
+        if not (keep_db and db_mode == 'file' and
+                conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'changelog_epoch'").fetchone()):
+            with open(sql_file, 'r') as sql_startup:
+                init_db = sql_startup.read()
+            cursor = conn.cursor()
+            cursor.executescript(init_db)
+            conn.commit()
+        if db_mode == 'memory':
+            # The in-memory database lives as long as this connection stays open
+            memory_anchor = conn
+            memory_pristine = sqlite3.connect(':memory:', check_same_thread=False)
+            conn.backup(memory_pristine)
+        else:
+            conn.close()
+    conn = connect_db()
+    listing_index.load(conn)
     conn.close()
     global db_flag
     db_flag = True
@@ -31,41 +367,75 @@ def get_db():
     """Get database connection, creating if necessary"""
     if not db_flag:
         create_db()
-    conn = sqlite3.connect(db_name)
+    conn = connect_db()
     return conn
 
-def verify_token(token):
-    """Verify JWT token by calling user service"""
-    try:
-        resp = requests.get('http://user:5000/internal/verify_jwt', params={'token': token}, timeout=2)
-        return resp.json()
-    except:
-        return {"valid": 0}
+changes_feed = ChangesFeed(change_notifier, get_db, changes_max_wait, changes_poll_interval, changes_batch_size,
+                           changes_max_waiters)
+changes_feed.install(app)
 
+def get_index():
+    """Get the listing index, creating the database if necessary"""
+    if not db_flag:
+        create_db()
+    return listing_index
 
-def get_post_param(param_name):
-    """Robustly extract a POST parameter from form, JSON, or raw body."""
-    # 1) Standard form field
-    value = request.form.get(param_name)
-    if value is not None and value != "":
-        return value
-    # 2) JSON body
+
+async def get_ratings(drivers):
+    """Get ratings from user service, one call per distinct driver, concurrent on the event loop"""
+    drivers = list(dict.fromkeys(drivers))
+    return dict(zip(drivers, await gather(*(get_rating(driver) for driver in drivers))))
+
+async def get_rating(driver_username):
+    """Get one driver's rating from user service, "0.00" if unavailable"""
     try:
-        json_body = request.get_json(silent=True)
-        if isinstance(json_body, dict) and param_name in json_body and json_body[param_name] != "":
-            return json_body[param_name]
-    except:
+        user_url = upstream.service_url('user', '/get_rating')
+        rating_response = await upstream.request_async('POST', 'user', user_url, coalesce=True,
+                                                       data={'username': driver_username})
+        if rating_response.status_code == 200:
+            rating_data = response_body(rating_response)
+            if rating_data.get('status') == 1:
+                return rating_data.get('rating', '0.00')
+    except Exception:
         pass
-    # 3) URL-encoded raw body fallback
+    return "0.00"
+
+def rating_value(rating):
+    """A driver rating as a number for ranking, 0 if it is not a finite number"""
     try:
-        from urllib.parse import parse_qs
-        raw = request.get_data(as_text=True) or ""
-        parsed = parse_qs(raw, keep_blank_values=True)
-        if param_name in parsed and len(parsed[param_name]) > 0:
-            return parsed[param_name][0]
-    except:
-        pass
-    return None
+        value = float(rating)
+    except (TypeError, ValueError):
+        return 0.0
+    return value if math.isfinite(value) else 0.0
+
+def best_candidates(listings, options):
+    """The listings that can still make sort=best's top_k, cheapest first.
+
+    A rating adds at most rating_weight * max_rating, so a listing priced more
+    than that (in price_weight units) above the top_k-th cheapest scores below
+    all of the top_k cheapest and is dropped before its rating is looked up.
+    At most best_max_candidates are kept either way.
+    """
+    top_k, price_weight, rating_weight = options["top_k"], options["price_weight"], options["rating_weight"]
+    if not top_k:
+        return []
+    listings = sorted(listings, key=lambda listing: (listing[1], listing[0]))
+    if price_weight > 0 and rating_weight >= 0 and len(listings) > top_k:
+        ceiling = listings[top_k - 1][1] + rating_weight * max_rating / price_weight
+        listings = listings[:bisect_right([price for _, price, _ in listings], ceiling)]
+    return listings[:best_max_candidates]
+
+def rank_listings(listings, ratings, top_k, price_weight, rating_weight):
+    """Pick the top_k listings by rating_weight * rating - price_weight * price"""
+    def score(listing):
+        listingid, price, driver_username = listing
+        # Ties go to the lower listingid
+        return (rating_weight * rating_value(ratings[driver_username]) - price_weight * price, -listingid)
+    return heapq.nlargest(top_k, listings, key=score)
+
+
+app.json = WireJSONProvider(app)
+
 
 @app.route('/clear', methods=['GET'])
 def clear_db():
@@ -75,15 +445,16 @@ def clear_db():
         global db_flag
         db_flag = False
         
-        try:
+        if db_mode == 'file':
+            try:
+                if os.path.exists(db_name):
+                    temp_conn = sqlite3.connect(db_name)
+                    temp_conn.close()
+            except:
+                pass
+            
             if os.path.exists(db_name):
-                temp_conn = sqlite3.connect(db_name)
-                temp_conn.close()
-        except:
-            pass
-        
-        if os.path.exists(db_name):
-            os.remove(db_name)
+                os.remove(db_name)
         
         create_db()
         return jsonify({"status": 1})
@@ -94,7 +465,7 @@ def clear_db():
             except:
                 pass
         try:
-            if os.path.exists(db_name):
+            if db_mode == 'file' and os.path.exists(db_name):
                 os.remove(db_name)
             db_flag = False
             create_db()
@@ -113,7 +484,7 @@ def create_listing():
             return jsonify({"status": 2})
         
         # Verify JWT by calling user service
-        auth = verify_token(token)
+        auth = verifier.verify(token)
         if auth.get('valid') != 1:
             return jsonify({"status": 2})
         if auth.get('is_driver') != 1:
@@ -130,7 +501,6 @@ def create_listing():
             return jsonify({"status": 2})
         
         # Validate day is a valid day of week
-        valid_days = ['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday']
         if day not in valid_days:
             return jsonify({"status": 2})
         
@@ -150,11 +520,11 @@ def create_listing():
         
         # Verify user is a driver by calling user service
         try:
-            user_url = os.environ.get('USER_URL', 'http://user:5000/get_user_info')
-            user_response = requests.post(user_url, data={'username': username}, timeout=2)
+            user_url = upstream.service_url('user', '/get_user_info')
+            user_response = upstream.request('POST', 'user', user_url, data={'username': username})
             if user_response.status_code != 200:
                 return jsonify({"status": 2})
-            user_data = user_response.json()
+            user_data = response_body(user_response)
             if user_data.get('status') != 1 or not user_data.get('is_driver'):
                 return jsonify({"status": 2})
         except:
@@ -178,6 +548,8 @@ def create_listing():
         conn.commit()
         conn.close()
         
+        listing_index.add(listingid_int, day, price_float, username)
+        
         return jsonify({"status": 1})
         
     except Exception as e:
@@ -185,10 +557,67 @@ def create_listing():
             conn.close()
         return jsonify({"status": 2})
 
+def get_search_options():
+    """Parse the optional filter and ranking query parameters, None if invalid"""
+    try:
+        # Optional price range and "cheapest N" filters
+        min_price = request.args.get('min_price')
+        min_price = float(min_price) if min_price else None
+        max_price = request.args.get('max_price')
+        max_price = float(max_price) if max_price else None
+        limit = request.args.get('limit')
+        limit = int(limit) if limit else None
+        
+        # Optional ranking, e.g. sort=best&top_k=5&price_weight=1&rating_weight=10
+        sort = request.args.get('sort')
+        top_k = request.args.get('top_k')
+        top_k = int(top_k) if top_k else best_top_k
+        price_weight = request.args.get('price_weight')
+        price_weight = float(price_weight) if price_weight else best_price_weight
+        rating_weight = request.args.get('rating_weight')
+        rating_weight = float(rating_weight) if rating_weight else best_rating_weight
+    except:
+        return None
+    if limit is not None and limit < 0:
+        return None
+    # float() accepts "nan" and "inf", which would poison the ranking and price bounds
+    if not all(math.isfinite(value) for value in (min_price, max_price, price_weight, rating_weight)
+               if value is not None):
+        return None
+    if sort and sort != 'best':
+        return None
+    if top_k < 0:
+        return None
+    return {
+        "min_price": min_price,
+        "max_price": max_price,
+        "limit": limit,
+        "sort": sort,
+        "top_k": top_k,
+        "price_weight": price_weight,
+        "rating_weight": rating_weight
+    }
+
+def build_results(listings, ratings, options):
+    """Rank if requested and serialize listings with their driver ratings"""
+    if options["sort"] == 'best':
+        listings = rank_listings(listings, ratings, options["top_k"],
+                                 options["price_weight"], options["rating_weight"])
+    result_data = []
+    for listing in listings:
+        listingid, price, driver_username = listing
+        result_data.append({
+            "listingid": listingid,
+            "price": f"{price:.2f}",
+            "driver": driver_username,
+            "rating": ratings[driver_username]
+        })
+    return result_data
+
 @app.route('/search', methods=['GET'])
-def search_listings():
+@loop_view
+async def search_listings():
     """Search for driver availabilities by day"""
-    conn = None
     try:
         # Get JWT from Authorization header
         token = request.headers.get('Authorization')
@@ -196,72 +625,88 @@ def search_listings():
             return jsonify({"status": 2, "data": []})
         
         # Verify JWT by calling user service
-        auth = verify_token(token)
+        auth = await verifier.verify_async(token)
         if auth.get('valid') != 1:
             return jsonify({"status": 2, "data": []})
         if auth.get('is_driver') != 0:
             return jsonify({"status": 2, "data": []})
         
-        username = auth.get('username')
-        
         # Get day parameter
         day = request.args.get('day')
         if not day:
             return jsonify({"status": 2, "data": []})
         
         # Validate day
-        valid_days = ['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday']
         if day not in valid_days:
             return jsonify({"status": 2, "data": []})
         
-        conn = get_db()
-        cursor = conn.cursor()
+        options = get_search_options()
+        if options is None:
+            return jsonify({"status": 2, "data": []})
         
-        # Get all listings for the day
-        cursor.execute("""
-            SELECT listingid, price, driver_username
-            FROM listings
-            WHERE day = ?
-            ORDER BY listingid
-        """, (day,))
+        # Served from the in-memory index, no SQL on the read path
+        listings = get_index().search(day, options["min_price"], options["max_price"], options["limit"])
+        if options["sort"] == 'best':
+            listings = best_candidates(listings, options)
         
-        listings = cursor.fetchall()
+        # Get driver ratings from user service
+        ratings = await get_ratings(driver_username for _, _, driver_username in listings)
         
-        # Build response with ratings
-        result_data = []
-        for listing in listings:
-            listingid, price, driver_username = listing
-            
-            # Get driver rating from user service
-            rating = "0.00"
-            try:
-                user_url = os.environ.get('USER_URL', 'http://user:5000/get_rating')
-                rating_response = requests.post(user_url, data={'username': driver_username}, timeout=2)
-                if rating_response.status_code == 200:
-                    rating_data = rating_response.json()
-                    if rating_data.get('status') == 1:
-                        rating = rating_data.get('rating', '0.00')
-            except:
-                pass
-            
-            result_data.append({
-                "listingid": listingid,
-                "price": f"{price:.2f}",
-                "driver": driver_username,
-                "rating": rating
-            })
+        return jsonify({
+            "status": 1,
+            "data": build_results(listings, ratings, options)
+        })
         
-        conn.close()
+    except Exception as e:
+        return jsonify({"status": 2, "data": []})
+
+@app.route('/search_week', methods=['GET'])
+@loop_view
+async def search_week():
+    """Search several days at once, results grouped by day"""
+    try:
+        # Get JWT from Authorization header
+        token = request.headers.get('Authorization')
+        if not token:
+            return jsonify({"status": 2, "data": {}})
+        
+        # Verify JWT once for the whole week
+        auth = await verifier.verify_async(token)
+        if auth.get('valid') != 1:
+            return jsonify({"status": 2, "data": {}})
+        if auth.get('is_driver') != 0:
+            return jsonify({"status": 2, "data": {}})
+        
+        # days=Monday,Friday; missing or days=all means the whole week
+        days_param = request.args.get('days') or 'all'
+        if days_param == 'all':
+            days = list(valid_days)
+        else:
+            days = [day.strip() for day in days_param.split(',') if day.strip()]
+        if not days or any(day not in valid_days for day in days):
+            return jsonify({"status": 2, "data": {}})
+        
+        options = get_search_options()
+        if options is None:
+            return jsonify({"status": 2, "data": {}})
+        
+        # One pass over the index for every requested day
+        by_day = get_index().search_days(days, options["min_price"], options["max_price"], options["limit"])
+        if options["sort"] == 'best':
+            by_day = {day: best_candidates(listings, options) for day, listings in by_day.items()}
+        
+        # Ratings for the union of drivers, resolved once
+        ratings = await get_ratings(driver_username
+                                    for listings in by_day.values()
+                                    for _, _, driver_username in listings)
         
         return jsonify({
             "status": 1,
-            "data": result_data
+            "data": {day: build_results(listings, ratings, options) for day, listings in by_day.items()}
         })
         
     except Exception as e:
-        if conn:
-            conn.close()
-        return jsonify({"status": 2, "data": []})
+        return jsonify({"status": 2, "data": {}})
 
 @app.route('/get_listing', methods=['POST'])
 def get_listing():
@@ -328,6 +773,8 @@ def delete_listing():
         conn.commit()
         conn.close()
         
+        listing_index.remove(listingid_int)
+        
         return jsonify({"status": 1})
         
     except Exception as e:
@@ -335,6 +782,113 @@ def delete_listing():
             conn.close()
         return jsonify({"status": 2})
 
+@app.route('/claim_listings', methods=['POST'])
+def claim_listings():
+    """Internal endpoint to atomically fetch and delete several listings"""
+    conn = None
+    try:
+        listingids = get_post_param('listingids')
+        if not isinstance(listingids, list) or not listingids:
+            return jsonify({"status": 2, "data": []})
+        
+        try:
+            listingids = [int(listingid) for listingid in listingids]
+        except:
+            return jsonify({"status": 2, "data": []})
+        if len(set(listingids)) != len(listingids):
+            return jsonify({"status": 2, "data": []})
+        
+        conn = get_db()
+        cursor = conn.cursor()
+        
+        # All or nothing: every listing must still exist
+        cursor.execute("BEGIN IMMEDIATE")
+        claimed = []
+        for listingid in listingids:
+            cursor.execute("""
+                SELECT day, price, driver_username
+                FROM listings
+                WHERE listingid = ?
+            """, (listingid,))
+            listing_data = cursor.fetchone()
+            if not listing_data:
+                conn.rollback()
+                conn.close()
+                return jsonify({"status": 2, "data": []})
+            day, price, driver = listing_data
+            claimed.append({"listingid": listingid, "day": day, "price": f"{price:.2f}", "driver": driver})
+        
+        cursor.executemany("DELETE FROM listings WHERE listingid = ?", [(listingid,) for listingid in listingids])
+        
+        conn.commit()
+        conn.close()
+        
+        for listingid in listingids:
+            listing_index.remove(listingid)
+        
+        return jsonify({"status": 1, "data": claimed})
+        
+    except Exception as e:
+        if conn:
+            conn.close()
+        return jsonify({"status": 2, "data": []})
+
+@app.route('/release_listings', methods=['POST'])
+def release_listings():
+    """Internal endpoint to put back listings returned by /claim_listings"""
+    conn = None
+    try:
+        listings = get_post_param('listings')
+        if not isinstance(listings, list) or not listings:
+            return jsonify({"status": 2})
+        
+        try:
+            rows = [(int(listing['listingid']), listing['driver'], listing['day'], float(listing['price']))
+                    for listing in listings]
+        except:
+            return jsonify({"status": 2})
+        if any(day not in valid_days for _, _, day, _ in rows):
+            return jsonify({"status": 2})
+        
+        conn = get_db()
+        cursor = conn.cursor()
+        
+        # A retried release finds the listings it already put back and leaves them be
+        released = []
+        for row in rows:
+            cursor.execute("""
+                INSERT OR IGNORE INTO listings (listingid, driver_username, day, price)
+                VALUES (?, ?, ?, ?)
+            """, row)
+            if cursor.rowcount:
+                released.append(row)
+        
+        conn.commit()
+        conn.close()
+        
+        for listingid, driver, day, price in released:
+            listing_index.add(listingid, day, price, driver)
+        
+        return jsonify({"status": 1})
+        
+    except Exception as e:
+        if conn:
+            conn.close()
+        return jsonify({"status": 2})
+
+
+asgi_app = AsgiApp(app, upstream, verifier, asgi_threads, asgi_max_connections) if server_mode == 'asgi' else None
+
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=5000, debug=False)
+    memory.start()
+    # Create the schema and load the listing index before serving
+    create_db()
+    if backup_interval > 0:
+        backups.start()
+    if server_mode == 'asgi':
+        asyncio.run(serve_asgi(asgi_app, port, unix_socket))
+    else:
+        if unix_socket:
+            serve_unix_socket(app, unix_socket)
+        app.run(host='0.0.0.0', port=port, debug=False)
 
@@ -1,3 +1,5 @@
+DROP TABLE IF EXISTS changelog;
+DROP TABLE IF EXISTS changelog_epoch;
 DROP TABLE IF EXISTS listings;
 
 CREATE TABLE listings (
@@ -7,3 +9,42 @@ CREATE TABLE listings (
     price REAL NOT NULL
 );
 
+-- Change-data capture: every insert, update and delete on the tables below gets a
+-- row here (in commit order, as SQLite has one writer at a time), served by /changes
+CREATE TABLE changelog (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    table_name TEXT NOT NULL,
+    op TEXT NOT NULL,
+    row_key TEXT NOT NULL,
+    data TEXT,
+    changed_at REAL NOT NULL DEFAULT ((julianday('now') - 2440587.5) * 86400.0)
+);
+
+-- Identifies this incarnation of the database, so feed readers notice a reset
+CREATE TABLE changelog_epoch (
+    epoch TEXT NOT NULL
+);
+
+INSERT INTO changelog_epoch (epoch) VALUES (lower(hex(randomblob(8))));
+
+-- Keep a day of changes, pruning every 1000 entries
+CREATE TRIGGER changelog_prune AFTER INSERT ON changelog WHEN NEW.seq % 1000 = 0 BEGIN
+    DELETE FROM changelog WHERE changed_at < NEW.changed_at - 86400;
+END;
+
+CREATE TRIGGER listings_changelog_insert AFTER INSERT ON listings BEGIN
+    INSERT INTO changelog (table_name, op, row_key, data)
+    VALUES ('listings', 'insert', json_object('listingid', NEW.listingid),
+            json_object('listingid', NEW.listingid, 'driver_username', NEW.driver_username, 'day', NEW.day, 'price', NEW.price));
+END;
+
+CREATE TRIGGER listings_changelog_update AFTER UPDATE ON listings BEGIN
+    INSERT INTO changelog (table_name, op, row_key, data)
+    VALUES ('listings', 'update', json_object('listingid', NEW.listingid),
+            json_object('listingid', NEW.listingid, 'driver_username', NEW.driver_username, 'day', NEW.day, 'price', NEW.price));
+END;
+
+CREATE TRIGGER listings_changelog_delete AFTER DELETE ON listings BEGIN
+    INSERT INTO changelog (table_name, op, row_key, data)
+    VALUES ('listings', 'delete', json_object('listingid', OLD.listingid), NULL);
+END;
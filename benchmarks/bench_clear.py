@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+"""
+Benchmark /clear in file mode against DB_MODE=memory for every service.
+
+Each service runs in-process through Flask's test client inside a scratch
+directory, so no database files are left behind.
+
+    python3 benchmarks/bench_clear.py [iterations]
+"""
+
+import importlib.util
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+# The services import the shared common package from the repository root
+sys.path.insert(0, ROOT)
+SERVICES = [
+    ('users', 'user.sql'),
+    ('availability', 'listings.sql'),
+    ('reservations', 'reservations.sql'),
+    ('payments', 'payments.sql'),
+]
+
+
+def load_service(name, mode):
+    os.environ['DB_MODE'] = mode
+    spec = importlib.util.spec_from_file_location(f"{name}_{mode}", os.path.join(ROOT, name, 'app.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    with tempfile.TemporaryDirectory() as tmp:
+        for name, sql in SERVICES:
+            shutil.copy(os.path.join(ROOT, name, sql), tmp)
+        shutil.copy(os.path.join(ROOT, 'key.txt'), tmp)
+        os.chdir(tmp)
+
+        print(f"{'service':<14}{'file (ms)':>12}{'memory (ms)':>14}{'speedup':>10}")
+        for name, _ in SERVICES:
+            timings = {}
+            for mode in ('file', 'memory'):
+                client = load_service(name, mode).app.test_client()
+                client.get('/clear')
+                start = time.perf_counter()
+                for _ in range(iterations):
+                    client.get('/clear')
+                timings[mode] = (time.perf_counter() - start) / iterations * 1000
+            print(f"{name:<14}{timings['file']:>12.3f}{timings['memory']:>14.3f}"
+                  f"{timings['file'] / timings['memory']:>9.1f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,288 @@
+#!/usr/bin/env python3
+"""
+Contention stress test of reservations and payments, with invariant checks.
+
+All four services run in this process on Flask's threaded server over loopback
+ports, with file databases in a temporary directory. Three phases run:
+
+  reserve   PASSENGERS threads race for the same few listings, each passenger
+            trying every listing in a shuffled order
+  storm     the same number of threads add credit to a handful of hot drivers
+            while passengers book those drivers' remaining listings, so /add
+            and /transfer update the same balances at once
+  timeouts  passengers race for new listings while TIMEOUT_RATE of /transfer
+            calls outlast reservations' upstream timeout, half of them before
+            committing and half after; bookings left pending are then settled
+            through /internal/reconcile
+
+Each phase reports throughput and latency, then the databases are checked:
+total money equals deposits plus credits, passengers paid exactly the price of
+their reservations, no listing is reserved twice or lost (every listing is
+either booked or available again), no booking is left pending and no balance
+is negative. The exit status is 1 if an invariant is broken.
+
+    python3 benchmarks/bench_contention.py [passengers] [listings]
+"""
+
+import importlib.util
+import logging
+import os
+import random
+import shutil
+import socket
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+
+import requests
+from werkzeug.serving import make_server
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+# The services import the shared common package from the repository root
+sys.path.insert(0, ROOT)
+
+SERVICES = (('user', 'users', 'user.sql'), ('availability', 'availability', 'listings.sql'),
+            ('reservations', 'reservations', 'reservations.sql'), ('payments', 'payments', 'payments.sql'))
+HOT_DRIVERS = 3
+DEPOSIT = 100.0
+CREDIT = 5.0
+PASSWORD = 'Pa55word!Zq9'
+# Share of /transfer calls delayed past the shortened upstream timeout in the timeouts phase
+TIMEOUT_RATE = 0.5
+TIMEOUT_UPSTREAM = 0.5
+TIMEOUT_DELAY = 1.0
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def start_services(tmp):
+    """Load and serve every service; returns {name: (module, base url)}"""
+    ports = {name: free_port() for name, _, _ in SERVICES}
+    for name, port in ports.items():
+        os.environ[f"{name.upper()}_URL"] = f"http://127.0.0.1:{port}"
+    os.environ['RATE_LIMIT_RATE'] = '1e9'
+    os.environ['RATE_LIMIT_BURST'] = '1e9'
+    os.environ['PUBLIC_CONCURRENCY'] = '100000'
+    os.environ['BACKUP_INTERVAL'] = '0'
+    # Injected timeouts should exercise the transfer retries, not trip the breaker
+    os.environ['BREAKER_FAILURE_THRESHOLD'] = '1000000'
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    services = {}
+    for name, directory, sql in SERVICES:
+        shutil.copy(os.path.join(ROOT, directory, sql), tmp)
+        spec = importlib.util.spec_from_file_location(f"{directory}_contention",
+                                                      os.path.join(ROOT, directory, 'app.py'))
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        server = make_server('127.0.0.1', ports[name], module.app, threaded=True)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        services[name] = (module, f"http://127.0.0.1:{ports[name]}")
+    return services
+
+
+session_local = threading.local()
+
+
+def call(method, url, token=None, **kwargs):
+    session = getattr(session_local, 'session', None)
+    if session is None:
+        session = session_local.session = requests.Session()
+    headers = {'Authorization': token} if token else {}
+    return session.request(method, url, headers=headers, timeout=60, **kwargs).json()
+
+
+def create_accounts(urls, prefix, count, driver):
+    tokens = {}
+    for i in range(count):
+        username = f"{prefix}{i}"
+        call('POST', f"{urls['user']}/create_user", data={
+            'first_name': 'Stress', 'last_name': 'Test', 'username': username,
+            'email_address': f"{username}@example.com", 'password': PASSWORD, 'salt': 'salt',
+            'driver': 'True' if driver else 'False', 'deposit': str(DEPOSIT)})
+        tokens[username] = call('POST', f"{urls['user']}/login",
+                                data={'username': username, 'password': PASSWORD})['jwt']
+    return tokens
+
+
+def run_threads(workers):
+    """Start every worker at once; returns the wall time until all have finished"""
+    barrier = threading.Barrier(len(workers) + 1)
+
+    def run(worker):
+        barrier.wait()
+        worker()
+
+    threads = [threading.Thread(target=run, args=(worker,)) for worker in workers]
+    for thread in threads:
+        thread.start()
+    barrier.wait()
+    start = time.perf_counter()
+    for thread in threads:
+        thread.join()
+    return time.perf_counter() - start
+
+
+def inject_transfer_timeouts(payments, rate, delay, seed):
+    """Delay a share of /transfer calls by delay seconds, half before running and half after"""
+    transfer = payments.app.view_functions['transfer']
+    rng = random.Random(seed)
+
+    def slow_transfer():
+        roll = rng.random()
+        if roll < rate / 2:
+            time.sleep(delay)
+        response = transfer()
+        if rate / 2 <= roll < rate:
+            time.sleep(delay)
+        return response
+    payments.app.view_functions['transfer'] = slow_transfer
+
+
+def report(phase, wall, samples):
+    """samples: (operation, seconds, ok) per request"""
+    print(f"\n{phase}: {len(samples)} requests in {wall:.2f} s ({len(samples) / wall:.0f} req/s)")
+    print(f"  {'operation':<10}{'requests':>10}{'ok':>8}{'p50 (ms)':>11}{'p99 (ms)':>11}{'max (ms)':>11}")
+    for operation in sorted({sample[0] for sample in samples}):
+        times = sorted(seconds * 1000 for name, seconds, _ in samples if name == operation)
+        ok = sum(1 for name, _, success in samples if name == operation and success)
+        print(f"  {operation:<10}{len(times):>10}{ok:>8}{times[len(times) // 2]:>11.1f}"
+              f"{times[int(len(times) * 0.99)]:>11.1f}{times[-1]:>11.1f}")
+
+
+def main():
+    passenger_count = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    listing_count = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    rng = random.Random(7)
+    with tempfile.TemporaryDirectory() as tmp:
+        shutil.copy(os.path.join(ROOT, 'key.txt'), tmp)
+        os.chdir(tmp)
+        services = start_services(tmp)
+        urls = {name: url for name, (_, url) in services.items()}
+        for url in urls.values():
+            call('GET', f"{url}/clear")
+
+        drivers = create_accounts(urls, 'driver', HOT_DRIVERS, True)
+        passengers = create_accounts(urls, 'rider', passenger_count, False)
+        driver_names = list(drivers)
+
+        def post_listings(first, count):
+            for listingid in range(first, first + count):
+                call('POST', f"{urls['availability']}/listing", drivers[driver_names[listingid % HOT_DRIVERS]],
+                     data={'day': 'Monday', 'price': f"{rng.uniform(10, 60):.2f}", 'listingid': str(listingid)})
+            return list(range(first, first + count))
+
+        samples = []
+        credited = []
+        pending = []
+        lock = threading.Lock()
+
+        def timed(operation, method, url, token, data):
+            start = time.perf_counter()
+            try:
+                status = call(method, url, token, data=data).get('status')
+            except (requests.RequestException, ValueError):
+                status = None
+            with lock:
+                samples.append((operation, time.perf_counter() - start, status == 1))
+                if status == 4:
+                    pending.append(operation)
+            return status == 1
+
+        def passenger(token, listing_ids, seed):
+            order = list(listing_ids)
+            random.Random(seed).shuffle(order)
+
+            def work():
+                for listingid in order:
+                    timed('reserve', 'POST', f"{urls['reservations']}/reserve", token,
+                          {'listingid': str(listingid)})
+            return work
+
+        def hot_driver_credit(token, rounds):
+            def work():
+                for _ in range(rounds):
+                    if timed('add', 'POST', f"{urls['payments']}/add", token, {'amount': str(CREDIT)}):
+                        with lock:
+                            credited.append(CREDIT)
+            return work
+
+        # Phase 1: every passenger goes after the same listings
+        listings = post_listings(0, listing_count)
+        wall = run_threads([passenger(token, listings, i) for i, token in enumerate(passengers.values())])
+        report('reserve', wall, samples)
+
+        # Phase 2: credit storm on the hot drivers while their new listings are booked
+        samples.clear()
+        listings = post_listings(listing_count, listing_count)
+        tokens = list(passengers.values())
+        workers = [passenger(token, listings, i) for i, token in enumerate(tokens[:passenger_count // 2])]
+        workers += [hot_driver_credit(drivers[driver_names[i % HOT_DRIVERS]], 5)
+                    for i in range(passenger_count - len(workers))]
+        wall = run_threads(workers)
+        report('storm', wall, samples)
+
+        # Phase 3: transfers that time out, some after they committed
+        samples.clear()
+        listings = post_listings(2 * listing_count, listing_count)
+        reservations = services['reservations'][0]
+        reservations.upstream.timeout = TIMEOUT_UPSTREAM
+        inject_transfer_timeouts(services['payments'][0], TIMEOUT_RATE, TIMEOUT_DELAY, 11)
+        wall = run_threads([passenger(token, listings, i) for i, token in enumerate(tokens)])
+        report('timeouts', wall, samples)
+        # Let delayed transfers land before their outcomes are settled
+        time.sleep(TIMEOUT_DELAY + 0.5)
+        settled = call('POST', f"{urls['reservations']}/internal/reconcile").get('settled')
+        print(f"  {len(pending)} bookings left pending, {settled} settled by /internal/reconcile")
+
+        print("\ninvariants:")
+        payments = services['payments'][0]
+        balances = {}
+        for file_name, _ in payments.backup_sources():
+            conn = sqlite3.connect(file_name)
+            balances.update(conn.execute("SELECT username, balance FROM balances"))
+            conn.close()
+        conn = sqlite3.connect(services['reservations'][0].db_name)
+        reservations = conn.execute("SELECT listingid, passenger_username, price FROM reservations").fetchall()
+        unsettled = conn.execute("SELECT COUNT(*) FROM pending_reservations").fetchone()[0]
+        conn.close()
+        conn = sqlite3.connect(services['availability'][0].db_name)
+        available = {listingid for listingid, in conn.execute("SELECT listingid FROM listings")}
+        conn.close()
+
+        account_count = len(drivers) + len(passengers)
+        expected_total = DEPOSIT * account_count + sum(credited)
+        paid = {}
+        booked = {}
+        for listingid, username, price in reservations:
+            paid[username] = paid.get(username, 0.0) + price
+            booked[listingid] = booked.get(listingid, 0) + 1
+        lost = [listingid for listingid in range(3 * listing_count) if listingid not in booked and listingid not in available]
+        overcharged = [username for username in passengers
+                       if abs(DEPOSIT - balances.get(username, 0.0) - paid.get(username, 0.0)) > 0.005]
+        checks = [
+            ("money conserved", abs(sum(balances.values()) - expected_total) < 0.005 * account_count,
+             f"total {sum(balances.values()):.2f}, expected {expected_total:.2f}"),
+            ("passengers paid for their bookings", not overcharged,
+             f"{len(overcharged)} passengers whose balance does not match their reservations"),
+            ("no listing reserved twice", all(count == 1 for count in booked.values()),
+             f"{len(booked)} listings reserved, {sum(1 for count in booked.values() if count > 1)} more than once "
+             f"({len(reservations)} reservations)"),
+            ("no listing lost", not lost, f"{len(lost)} listings neither booked nor available"),
+            ("no booking left pending", not unsettled, f"{unsettled} pending bookings"),
+            ("no negative balances", all(balance >= 0 for balance in balances.values()),
+             f"lowest balance {min(balances.values()):.2f}"),
+        ]
+        for name, passed, detail in checks:
+            print(f"  {'ok  ' if passed else 'FAIL'} {name:<36}{detail}")
+        if not all(passed for _, passed, _ in checks):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+"""
+Benchmark for the availability service's in-memory listing index.
+
+Reports memory per listing and compares /search style reads served from the
+index against the equivalent SQLite queries.
+
+    python3 benchmarks/bench_listing_index.py [num_listings]
+"""
+
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'availability'))
+
+import app as availability  # noqa: E402
+
+
+def build_database(path, count, seed=7):
+    rng = random.Random(seed)
+    drivers = [f"driver{i}" for i in range(max(1, count // 20))]
+    conn = sqlite3.connect(path)
+    conn.executescript("""
+        CREATE TABLE listings (
+            listingid INTEGER PRIMARY KEY,
+            driver_username TEXT NOT NULL,
+            day TEXT NOT NULL,
+            price REAL NOT NULL
+        );
+    """)
+    conn.executemany(
+        "INSERT INTO listings (listingid, driver_username, day, price) VALUES (?, ?, ?, ?)",
+        ((i, rng.choice(drivers), rng.choice(availability.valid_days), round(rng.uniform(5, 80), 2))
+         for i in range(count)))
+    conn.commit()
+    return conn
+
+
+def timed(fn, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    return (time.perf_counter() - start) / repeat * 1e6
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    with tempfile.TemporaryDirectory() as tmp:
+        conn = build_database(os.path.join(tmp, 'listings.db'), count)
+
+        tracemalloc.start()
+        before = tracemalloc.get_traced_memory()[0]
+        index = availability.ListingIndex()
+        index.load(conn)
+        after = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+
+        print(f"listings:            {len(index)}")
+        print(f"index memory:        {(after - before) / 1024 / 1024:.2f} MiB")
+        print(f"memory per listing:  {(after - before) / max(1, len(index)):.1f} bytes")
+
+        repeat = 200
+        cases = [
+            ("whole day", lambda: index.search('Monday'),
+             lambda: conn.execute("SELECT listingid, price, driver_username FROM listings "
+                                  "WHERE day = ? ORDER BY listingid", ('Monday',)).fetchall()),
+            ("price range", lambda: index.search('Monday', 20.0, 25.0),
+             lambda: conn.execute("SELECT listingid, price, driver_username FROM listings "
+                                  "WHERE day = ? AND price BETWEEN ? AND ? ORDER BY price, listingid",
+                                  ('Monday', 20.0, 25.0)).fetchall()),
+            ("cheapest 10", lambda: index.search('Monday', limit=10),
+             lambda: conn.execute("SELECT listingid, price, driver_username FROM listings "
+                                  "WHERE day = ? ORDER BY price, listingid LIMIT 10", ('Monday',)).fetchall()),
+        ]
+        print()
+        print(f"{'query':<14}{'index (us)':>12}{'sqlite (us)':>14}")
+        for name, from_index, from_sql in cases:
+            assert from_index() == from_sql()
+            print(f"{name:<14}{timed(from_index, repeat):>12.1f}{timed(from_sql, repeat):>14.1f}")
+        conn.close()
+
+
+if __name__ == '__main__':
+    main()
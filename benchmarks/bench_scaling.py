@@ -0,0 +1,199 @@
+#!/usr/bin/env python3
+"""
+Endpoint latency as the dataset grows.
+
+For each SCALE (default 10 100 1000; see generate_data.py for what a scale
+holds) a child process writes the dataset into a temporary directory, starts
+all four services on it in-process (KEEP_DB=1, Flask's threaded server on
+loopback ports) and times each endpoint below, for a random user per call.
+UPSTREAM_TIMEOUT and REQUEST_BUDGET are raised so slow queries show their full
+cost instead of timing out. An endpoint whose p50, extrapolated linearly
+from the previous scale, would exceed MAX_CALL_MS is skipped at larger scales.
+
+The report gives p50/p99 per endpoint and scale, then how much p50 grew per
+10x more data: about 10x means the request scans a table, about 1x means an
+index or an in-memory structure answers it.
+
+    python3 benchmarks/bench_scaling.py [SCALE ...]
+"""
+
+import importlib.util
+import logging
+import math
+import multiprocessing
+import os
+import random
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+import requests
+from werkzeug.serving import make_server
+
+import generate_data
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+# The services import the shared common package from the repository root
+sys.path.insert(0, ROOT)
+
+SERVICES = (('user', 'users', 'user.sql'), ('availability', 'availability', 'listings.sql'),
+            ('reservations', 'reservations', 'reservations.sql'), ('payments', 'payments', 'payments.sql'))
+LOGGED_IN = 20
+MIN_SAMPLES = 5
+MAX_SAMPLES = 50
+TIME_PER_ENDPOINT = 5.0
+# Skip an endpoint at a scale where its linearly extrapolated p50 would exceed this
+MAX_CALL_MS = 20000
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def start_services():
+    """Serve every service on the database files in the working directory; returns base URLs"""
+    ports = {name: free_port() for name, _, _ in SERVICES}
+    for name, port in ports.items():
+        os.environ[f"{name.upper()}_URL"] = f"http://127.0.0.1:{port}"
+    os.environ.update({'KEEP_DB': '1', 'RATE_LIMIT_RATE': '1e9', 'RATE_LIMIT_BURST': '1e9',
+                       'UPSTREAM_TIMEOUT': '120', 'REQUEST_BUDGET': '120', 'BACKUP_INTERVAL': '0'})
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    urls = {}
+    for name, directory, _ in SERVICES:
+        spec = importlib.util.spec_from_file_location(f"{directory}_scaling", os.path.join(ROOT, directory, 'app.py'))
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        # Slow-query warnings would drown the report; the point here is that queries get slow
+        module.app.logger.setLevel(logging.ERROR)
+        server = make_server('127.0.0.1', ports[name], module.app, threaded=True)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        urls[name] = f"http://127.0.0.1:{ports[name]}"
+    return urls
+
+
+def endpoints(urls, scale, rng):
+    """(name, function making one call) per measured endpoint"""
+    session = requests.Session()
+    user_count = generate_data.USERS * scale
+    driver_count = user_count // generate_data.DRIVER_EVERY
+    drivers = [rng.randrange(driver_count) * generate_data.DRIVER_EVERY for _ in range(LOGGED_IN)]
+    passengers = [index + 1 for index in drivers]
+
+    def login(index):
+        response = session.post(f"{urls['user']}/login", data={
+            'username': generate_data.username(index), 'password': generate_data.PASSWORD}).json()
+        return response['jwt']
+
+    passenger_tokens = [login(i) for i in passengers]
+    driver_tokens = [login(i) for i in drivers]
+
+    def post(service, path, data_for):
+        return lambda: session.post(f"{urls[service]}{path}", data=data_for())
+
+    def get(service, path, tokens):
+        return lambda: session.get(f"{urls[service]}{path}", headers={'Authorization': rng.choice(tokens)})
+
+    def any_user():
+        return generate_data.username(rng.randrange(user_count))
+
+    return [
+        ('user POST /login', lambda: login(rng.choice(passengers))),
+        ('user POST /get_rating', post('user', '/get_rating', lambda: {'username': any_user()})),
+        ('availability GET /search', get('availability', '/search?day=Monday&limit=10', passenger_tokens)),
+        ('availability GET /search best', get('availability', '/search?day=Monday&sort=best&top_k=10',
+                                              passenger_tokens)),
+        ('availability POST /get_listing', post('availability', '/get_listing', lambda: {
+            'listingid': rng.randint(1, generate_data.LISTINGS * scale)})),
+        ('reservations GET /view', get('reservations', '/view', passenger_tokens)),
+        ('reservations GET /view driver', get('reservations', '/view', driver_tokens)),
+        ('reservations GET /history', get('reservations', '/history', passenger_tokens)),
+        ('reservations POST /check_reservation', post('reservations', '/check_reservation', lambda: {
+            'rater': any_user(), 'rated': any_user()})),
+        ('payments GET /view', get('payments', '/view', passenger_tokens)),
+        ('payments POST /check_balance', post('payments', '/check_balance', lambda: {
+            'username': any_user(), 'amount': '10'})),
+    ]
+
+
+def measure(call):
+    """Milliseconds per call: one warm-up, then MIN_SAMPLES to MAX_SAMPLES within TIME_PER_ENDPOINT"""
+    call()
+    samples = []
+    deadline = time.perf_counter() + TIME_PER_ENDPOINT
+    while len(samples) < MIN_SAMPLES or (len(samples) < MAX_SAMPLES and time.perf_counter() < deadline):
+        start = time.perf_counter()
+        call()
+        samples.append((time.perf_counter() - start) * 1000)
+    samples.sort()
+    return samples[len(samples) // 2], samples[min(len(samples) - 1, int(len(samples) * 0.99))]
+
+
+def run_scale(scale, skip, results):
+    """Child process: generate, serve and measure one scale, except the endpoints in skip"""
+    with tempfile.TemporaryDirectory() as tmp:
+        shutil.copy(os.path.join(ROOT, 'key.txt'), tmp)
+        for _, directory, sql in SERVICES:
+            shutil.copy(os.path.join(ROOT, directory, sql), tmp)
+        os.chdir(tmp)
+        try:
+            start = time.perf_counter()
+            counts = generate_data.generate(tmp, scale)
+            generated = time.perf_counter() - start
+            print(f"scale {scale}x: {', '.join(f'{count} {table}' for table, count in counts.items())} "
+                  f"generated in {generated:.1f} s", flush=True)
+            urls = start_services()
+            rng = random.Random(scale)
+            results.put({name: None if name in skip else measure(call)
+                         for name, call in endpoints(urls, scale, rng)})
+        except BaseException:
+            results.put(None)
+            raise
+
+
+def main():
+    scales = [int(arg) for arg in sys.argv[1:]] or [10, 100, 1000]
+    context = multiprocessing.get_context('fork')
+    results = context.Queue()
+    timings = {}
+    previous = None
+    for scale in scales:
+        skip = set()
+        if previous:
+            skip = {name for name, timing in timings[previous].items()
+                    if timing is None or timing[0] * scale / previous > MAX_CALL_MS}
+        # A fresh process per scale, so no cache or index outlives its dataset
+        child = context.Process(target=run_scale, args=(scale, skip, results))
+        child.start()
+        timings[scale] = results.get()
+        child.join()
+        if timings[scale] is None:
+            sys.exit(f"scale {scale}x failed")
+        previous = scale
+
+    names = list(timings[scales[0]])
+    width = max(len(name) for name in names) + 2
+    print()
+    print(f"{'endpoint':<{width}}" + "".join(f"{f'{scale}x p50':>12}{f'{scale}x p99':>12}" for scale in scales)
+          + (f"{'growth/10x':>12}" if len(scales) > 1 else ""))
+    for name in names:
+        row = f"{name:<{width}}"
+        for scale in scales:
+            timing = timings[scale][name]
+            row += f"{timing[0]:>12.2f}{timing[1]:>12.2f}" if timing else f"{'skipped':>12}{'':>12}"
+        measured = [scale for scale in scales if timings[scale][name]]
+        if len(measured) > 1:
+            # Geometric growth of p50 per tenfold increase in data, over the scales measured
+            first, last = timings[measured[0]][name][0], timings[measured[-1]][name][0]
+            decades = math.log10(measured[-1] / measured[0])
+            row += f"{(last / first) ** (1 / decades):>11.1f}x"
+        print(row)
+    print("\nlatencies in ms")
+
+
+if __name__ == '__main__':
+    main()
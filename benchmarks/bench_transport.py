@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+"""
+Benchmark internal-call latency over TCP keep-alive vs a Unix domain socket.
+
+The availability service runs under uvicorn (SERVER_MODE=asgi) in a child
+process, listening on a loopback TCP port and on a Unix socket. Calls go
+through the services' shared upstream session, so both transports reuse their
+connections. (Flask's threaded development server closes the connection after
+every response, so keep-alive needs the ASGI mode.)
+
+    python3 benchmarks/bench_transport.py [iterations]
+"""
+
+import asyncio
+import importlib.util
+import multiprocessing
+import os
+import shutil
+import socket
+import statistics
+import sys
+import tempfile
+import time
+
+import uvicorn
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+# The services import the shared common package from the repository root
+sys.path.insert(0, ROOT)
+
+
+def load_availability(unix_socket):
+    os.environ['DB_MODE'] = 'memory'
+    os.environ['SERVER_MODE'] = 'asgi'
+    os.environ['UNIX_SOCKET'] = unix_socket
+    spec = importlib.util.spec_from_file_location('availability_transport',
+                                                  os.path.join(ROOT, 'availability', 'app.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def serve(availability, port):
+    """Run uvicorn on port and on the Unix socket until the process is terminated"""
+    servers = [
+        uvicorn.Server(uvicorn.Config(availability.asgi_app, host='127.0.0.1', port=port,
+                                      lifespan='on', log_level='warning')),
+        uvicorn.Server(uvicorn.Config(availability.asgi_app, uds=availability.unix_socket,
+                                      lifespan='off', log_level='warning')),
+    ]
+
+    async def run():
+        await asyncio.gather(*(server.serve() for server in servers))
+
+    asyncio.run(run())
+
+
+def wait_until_listening(port, path):
+    while True:
+        try:
+            socket.create_connection(('127.0.0.1', port)).close()
+            with socket.socket(socket.AF_UNIX) as sock:
+                sock.connect(path)
+            return
+        except OSError:
+            time.sleep(0.05)
+
+
+def latencies(session, urls, iterations, rounds=20):
+    """Microsecond samples per URL, measured in interleaved batches so drift hits all of them"""
+    for url in urls:
+        for _ in range(100):
+            session.get(url)
+    samples = {url: [] for url in urls}
+    for _ in range(rounds):
+        for url in urls:
+            for _ in range(max(1, iterations // rounds)):
+                start = time.perf_counter()
+                session.get(url)
+                samples[url].append((time.perf_counter() - start) * 1e6)
+    return samples
+
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    with tempfile.TemporaryDirectory() as tmp:
+        shutil.copy(os.path.join(ROOT, 'availability', 'listings.sql'), tmp)
+        os.chdir(tmp)
+
+        availability = load_availability(os.path.join(tmp, 'availability.sock'))
+        port = free_port()
+        # A separate process, so the server does not compete with the client for the GIL
+        server = multiprocessing.get_context('fork').Process(target=serve, args=(availability, port), daemon=True)
+        server.start()
+        wait_until_listening(port, availability.unix_socket)
+
+        # Point two upstream targets at the same service, one per transport
+        availability.upstream.service_urls['tcp'] = f"http://127.0.0.1:{port}"
+        availability.upstream.service_urls['unix'] = f"unix://{availability.unix_socket}"
+        path = '/internal/circuit_breakers'
+
+        urls = {label: availability.upstream.service_url(transport, path)
+                for transport, label in (('tcp', 'tcp keep-alive'), ('unix', 'unix socket'))}
+        samples = latencies(availability.upstream.session, list(urls.values()), iterations)
+
+        print(f"{'transport':<16}{'mean (us)':>11}{'p50 (us)':>10}{'p99 (us)':>10}")
+        for label, url in urls.items():
+            times = sorted(samples[url])
+            print(f"{label:<16}{statistics.mean(times):>11.1f}{times[len(times) // 2]:>10.1f}"
+                  f"{times[int(len(times) * 0.99)]:>10.1f}")
+        server.terminate()
+        server.join()
+
+
+if __name__ == '__main__':
+    main()
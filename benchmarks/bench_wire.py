@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+"""
+Benchmark CPU time per request of request decoding and the internal wire format.
+
+"before" runs the user service with the old per-parameter decoder (form, then
+JSON, then the raw body, for every parameter) and form/JSON bodies; "after"
+uses the single-pass decoder, and for internal calls MessagePack both ways.
+The service runs in-process through Flask's test client with DB_MODE=memory,
+and CPU time is measured with time.process_time().
+
+    python3 benchmarks/bench_wire.py [iterations]
+"""
+
+import importlib.util
+import os
+import shutil
+import sys
+import tempfile
+import time
+from urllib.parse import parse_qs
+
+from flask import request
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+# The services import the shared common package from the repository root
+sys.path.insert(0, ROOT)
+
+from common.wire import MSGPACK_MIMETYPE
+
+
+def legacy_get_post_param(param_name):
+    """The decoder every service used before the single-pass one"""
+    value = request.form.get(param_name)
+    if value is not None and value != "":
+        return value
+    try:
+        json_body = request.get_json(silent=True)
+        if isinstance(json_body, dict) and param_name in json_body and json_body[param_name] != "":
+            return json_body[param_name]
+    except:
+        pass
+    try:
+        raw = request.get_data(as_text=True) or ""
+        parsed = parse_qs(raw, keep_blank_values=True)
+        if param_name in parsed and len(parsed[param_name]) > 0:
+            return parsed[param_name][0]
+    except:
+        pass
+    return None
+
+
+def load_users():
+    os.environ['DB_MODE'] = 'memory'
+    os.environ['RATE_LIMIT_RATE'] = '1e9'
+    os.environ['RATE_LIMIT_BURST'] = '1e9'
+    spec = importlib.util.spec_from_file_location('users_wire', os.path.join(ROOT, 'users', 'app.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    # /create_user deposits through the payments service; it is not running here
+    module.upstream.request = lambda *args, **kwargs: None
+    return module
+
+
+def cpu_per_request(iterations, before, after, rounds=20):
+    """CPU microseconds per request of before and after, interleaved so drift hits both"""
+    cpu = {before: 0.0, after: 0.0}
+    batch = max(1, iterations // rounds)
+    for round_number in range(rounds):
+        for send in (before, after):
+            start = time.process_time()
+            for i in range(round_number * batch, (round_number + 1) * batch):
+                send(i)
+            cpu[send] += time.process_time() - start
+    return [cpu[send] / (batch * rounds) * 1e6 for send in (before, after)]
+
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    with tempfile.TemporaryDirectory() as tmp:
+        shutil.copy(os.path.join(ROOT, 'users', 'user.sql'), tmp)
+        shutil.copy(os.path.join(ROOT, 'key.txt'), tmp)
+        os.chdir(tmp)
+
+        users = load_users()
+        single_pass = users.get_post_param
+        client = users.app.test_client()
+        msgpack = users.msgpack
+
+        def create_user(prefix, json_body):
+            def send(i):
+                body = {
+                    'first_name': 'Bench', 'last_name': 'Mark', 'username': f"{prefix}{i}",
+                    'email_address': f"{prefix}{i}@example.com", 'password': 'Pa55word!Zq9',
+                    'salt': 'salt', 'driver': 'True', 'deposit': '10',
+                }
+                resp = client.post('/create_user', **({'json': body} if json_body else {'data': body}))
+                assert resp.get_json()['status'] == 1
+            return send
+
+        def get_rating_form(i):
+            client.post('/get_rating', data={'username': 'form0'}).get_json()
+
+        def get_rating_msgpack(i):
+            resp = client.post('/get_rating', data=msgpack.packb({'username': 'form0'}),
+                               headers={'Content-Type': MSGPACK_MIMETYPE, 'Accept': MSGPACK_MIMETYPE})
+            msgpack.unpackb(resp.data)
+
+        scenarios = [
+            ('create_user (form)', create_user('form', False), create_user('formx', False), None),
+            ('create_user (JSON)', create_user('json', True), create_user('jsonx', True), None),
+            ('get_rating (internal)', get_rating_form, get_rating_form, get_rating_msgpack),
+        ]
+
+        client.get('/clear')
+        print(f"{'request':<24}{'before (us)':>14}{'after (us)':>13}{'change':>9}")
+        for name, before, after, after_msgpack in scenarios:
+            if after_msgpack and msgpack:
+                after = after_msgpack
+
+            def run_before(i, send=before):
+                users.get_post_param = legacy_get_post_param
+                send(i)
+
+            def run_after(i, send=after):
+                users.get_post_param = single_pass
+                send(i)
+
+            before_cpu, after_cpu = cpu_per_request(iterations, run_before, run_after)
+            print(f"{name:<24}{before_cpu:>14.1f}{after_cpu:>13.1f}{(after_cpu / before_cpu - 1) * 100:>8.1f}%")
+
+
+if __name__ == '__main__':
+    main()
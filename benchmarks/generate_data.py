@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+"""
+Deterministic synthetic dataset for all four services.
+
+Writes user.db, listings.db, reservations.db and payments.db (one file per
+shard with PAYMENTS_SHARDS) into DIRECTORY, replacing any that are there.
+SCALE 1 is 1,000 users (every tenth a driver), 10,000 ratings, 500 listings
+and 2,000 reservations, and every count grows linearly with SCALE: 1000 gives
+1M users, 10M ratings and 500k listings. The same SCALE and SEED give the same
+rows; timestamps fall in the HISTORY_DAYS before the day of generation.
+Every user's password is PASSWORD, hashed with DIRECTORY/key.txt as the user
+service does.
+
+Each file is created from the service's schema and filled in one transaction
+with journaling off. The changelog triggers are dropped for the load and
+recreated afterwards, so the change feeds start empty. Start the services
+with KEEP_DB=1 so they serve the files instead of recreating them.
+
+    python3 benchmarks/generate_data.py SCALE [DIRECTORY] [SEED]
+"""
+
+import hashlib
+import hmac
+import os
+import random
+import sqlite3
+import sys
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+# The payments shard layout comes from the shared common package at the repository root
+sys.path.insert(0, ROOT)
+
+from common.shards import shard_of, shard_file  # noqa: E402
+
+USERS = 1000
+RATINGS = 10000
+LISTINGS = 500
+RESERVATIONS = 2000
+DRIVER_EVERY = 10
+HISTORY_DAYS = 150
+PASSWORD = 'Pa55word!Zq9'
+VALID_DAYS = ['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday']
+FIRST_NAMES = ['Ama', 'Kofi', 'Lena', 'Omar', 'Priya', 'Sam', 'Tariq', 'Yuki', 'Zoe', 'Mateo']
+LAST_NAMES = ['Agyeman', 'Brown', 'Chen', 'Diaz', 'Ekström', 'Fischer', 'Garcia', 'Haddad', 'Ito', 'Kowalski']
+
+
+def username(index):
+    return f"user{index}"
+
+
+def is_driver(index):
+    return index % DRIVER_EVERY == 0
+
+
+def timestamps(rng, now):
+    """Endless 'YYYY-MM-DD HH:MM:SS' UTC times spread over the last HISTORY_DAYS"""
+    while True:
+        yield time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(now - rng.random() * HISTORY_DAYS * 86400))
+
+
+def bulk_load(path, sql_path, fill):
+    """Create path from the schema in sql_path and fill it with fill(conn) in one transaction"""
+    if os.path.exists(path):
+        os.remove(path)
+    conn = sqlite3.connect(path, isolation_level=None)
+    with open(sql_path, 'r') as sql_startup:
+        conn.executescript(sql_startup.read())
+    triggers = conn.execute("SELECT name, sql FROM sqlite_master WHERE type = 'trigger'").fetchall()
+    conn.execute("PRAGMA journal_mode = OFF")
+    conn.execute("PRAGMA synchronous = OFF")
+    conn.execute("BEGIN")
+    for name, _ in triggers:
+        conn.execute(f"DROP TRIGGER {name}")
+    fill(conn)
+    for _, sql in triggers:
+        conn.execute(sql)
+    conn.execute("COMMIT")
+    conn.execute("PRAGMA journal_mode = DELETE")
+    conn.close()
+
+
+def generate(directory, scale, seed=1):
+    """Write the dataset into directory; returns the row count per table"""
+    with open(os.path.join(directory, 'key.txt'), 'r') as f:
+        secret_key = f.read().strip().encode()
+    now = time.time() // 86400 * 86400
+    user_count = USERS * scale
+    drivers = [i for i in range(user_count) if is_driver(i)]
+    passengers = [i for i in range(user_count) if not is_driver(i)]
+    counts = {}
+
+    def fill_users(conn):
+        rng = random.Random(f"{seed}:users")
+
+        registered = time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(now - HISTORY_DAYS * 86400))
+
+        def users():
+            for i in range(user_count):
+                salt = f"{rng.getrandbits(64):016x}"
+                pass_hash = hmac.new(secret_key, (salt + PASSWORD).encode(), hashlib.sha256).hexdigest()
+                yield (i + 1, rng.choice(FIRST_NAMES), rng.choice(LAST_NAMES), username(i),
+                       f"{username(i)}@example.com", pass_hash, salt, 1 if is_driver(i) else 0, registered)
+        conn.executemany("""
+            INSERT INTO users (id, first_name, last_name, username, email_address, pass_hash, salt, is_driver,
+                               password_created_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """, users())
+        conn.execute("""
+            INSERT INTO password_history (user_id, pass_hash, created_at)
+            SELECT id, pass_hash, password_created_at FROM users
+        """)
+
+        rng = random.Random(f"{seed}:ratings")
+        created = timestamps(rng, now)
+
+        def ratings():
+            for _ in range(RATINGS * scale):
+                # Passengers rate drivers and drivers rate passengers, mostly good rides
+                passenger, driver = rng.choice(passengers), rng.choice(drivers)
+                rater, rated = (passenger, driver) if rng.random() < 0.7 else (driver, passenger)
+                yield rater + 1, rated + 1, rng.choices((1, 2, 3, 4, 5), (1, 1, 3, 8, 12))[0], next(created)
+        conn.executemany("INSERT INTO ratings (rater_id, rated_id, rating, created_at) VALUES (?, ?, ?, ?)",
+                         ratings())
+        counts['users'] = user_count
+        counts['ratings'] = RATINGS * scale
+
+    def fill_listings(conn):
+        rng = random.Random(f"{seed}:listings")
+        conn.executemany("INSERT INTO listings (listingid, driver_username, day, price) VALUES (?, ?, ?, ?)",
+                         ((listingid, username(rng.choice(drivers)), rng.choice(VALID_DAYS),
+                           round(rng.uniform(5, 80), 2)) for listingid in range(1, LISTINGS * scale + 1)))
+        counts['listings'] = LISTINGS * scale
+
+    def fill_reservations(conn):
+        rng = random.Random(f"{seed}:reservations")
+        created = timestamps(rng, now)
+        # Booked listings have left availability, so their ids come after the live ones
+        first_id = LISTINGS * scale + 1
+        conn.executemany("""
+            INSERT INTO reservations (listingid, passenger_username, driver_username, price, created_at)
+            VALUES (?, ?, ?, ?, ?)
+        """, ((listingid, username(rng.choice(passengers)), username(rng.choice(drivers)),
+               round(rng.uniform(5, 80), 2), next(created))
+              for listingid in range(first_id, first_id + RESERVATIONS * scale)))
+        counts['reservations'] = RESERVATIONS * scale
+
+    bulk_load(os.path.join(directory, 'user.db'), os.path.join(ROOT, 'users', 'user.sql'), fill_users)
+    bulk_load(os.path.join(directory, 'listings.db'), os.path.join(ROOT, 'availability', 'listings.sql'),
+              fill_listings)
+    bulk_load(os.path.join(directory, 'reservations.db'), os.path.join(ROOT, 'reservations', 'reservations.sql'),
+              fill_reservations)
+
+    # The same shard count the payments service will be started with
+    shard_count = int(os.environ.get('PAYMENTS_SHARDS', '1'))
+    rng = random.Random(f"{seed}:balances")
+    balances = [(username(i), round(rng.uniform(0, 500), 2)) for i in range(user_count)]
+    for shard in range(shard_count):
+        bulk_load(os.path.join(directory, shard_file(shard, shard_count)),
+                  os.path.join(ROOT, 'payments', 'payments.sql'),
+                  lambda conn, shard=shard: conn.executemany(
+                      "INSERT INTO balances (username, balance) VALUES (?, ?)",
+                      (row for row in balances if shard_of(row[0], shard_count) == shard)))
+    counts['balances'] = user_count
+    return counts
+
+
+def main():
+    if len(sys.argv) < 2 or len(sys.argv) > 4:
+        sys.exit(__doc__)
+    scale = int(sys.argv[1])
+    directory = sys.argv[2] if len(sys.argv) > 2 else '.'
+    seed = int(sys.argv[3]) if len(sys.argv) > 3 else 1
+    start = time.perf_counter()
+    counts = generate(directory, scale, seed)
+    elapsed = time.perf_counter() - start
+    rows = sum(counts.values())
+    print(", ".join(f"{count} {table}" for table, count in counts.items()))
+    print(f"{rows} rows in {elapsed:.1f} s ({rows / elapsed:.0f} rows/s)")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,3 @@
+"""
+Helpers shared by every service: each Dockerfile copies this package next to app.py.
+"""
@@ -0,0 +1,59 @@
+"""
+Async views that also run without an event loop.
+
+Under SERVER_MODE=asgi an async view awaits on uvicorn's event loop. Under
+Flask's threaded server there is no loop: threaded_view drives the view's
+coroutine on the request's own thread, and the helpers below complete every
+await at once by blocking that thread, as a sync view would. One view body
+serves both modes, and the threaded server needs neither flask[async] nor an
+event loop per request.
+"""
+
+import asyncio
+import functools
+
+
+def on_event_loop():
+    """Whether the caller runs on an event loop (and must not block)"""
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return False
+    return True
+
+
+async def blocking(fn, *args, **kwargs):
+    """Run blocking fn in a worker thread when on the event loop, else right here"""
+    if on_event_loop():
+        return await asyncio.to_thread(fn, *args, **kwargs)
+    return fn(*args, **kwargs)
+
+
+async def gather(*awaitables):
+    """asyncio.gather on the event loop; one after another without one"""
+    if on_event_loop():
+        return await asyncio.gather(*awaitables)
+    return [await awaitable for awaitable in awaitables]
+
+
+def run_inline(coroutine):
+    """Run a coroutine that never suspends to completion on this thread"""
+    try:
+        coroutine.send(None)
+    except StopIteration as done:
+        return done.value
+    coroutine.close()
+    raise RuntimeError("coroutine suspended outside an event loop")
+
+
+def threaded_view(view):
+    """Sync Flask view running the async view on the request's thread"""
+    @functools.wraps(view)
+    def run(*args, **kwargs):
+        return run_inline(view(*args, **kwargs))
+    return run
+
+
+def loop_views(asgi):
+    """Decorator for async views: left async for the ASGI event loop when asgi, else made threaded views"""
+    return (lambda view: view) if asgi else threaded_view
@@ -0,0 +1,128 @@
+"""
+Monthly archive databases for rows past a service's retention horizon.
+
+A table's archive is one SQLite file per month, <table>-<YYYY-MM>.db in
+archive_dir. Backups copy them under archive/ (see backup.py).
+"""
+
+import os
+import sqlite3
+import threading
+import time
+
+
+class Archives:
+    """Moves old rows of a service's tables into monthly archives and reads them back.
+
+    Rows older than horizon_days move every `interval` seconds, under lock; the
+    service's backups hold the same lock, so no row moves while one is copied.
+    connect() opens the live database, and archives are read through
+    connections of class read_factory.
+    """
+
+    def __init__(self, archive_dir, horizon_days, interval, lock, connect, read_factory, logger):
+        self.archive_dir = archive_dir
+        self.horizon_days = horizon_days
+        self.interval = interval
+        self.lock = lock
+        self.connect = connect
+        self.read_factory = read_factory
+        self.logger = logger
+
+    def cutoff(self, conn):
+        """created_at value before which rows belong in the archive"""
+        return conn.execute("SELECT datetime('now', ?)", (f"-{self.horizon_days} days",)).fetchone()[0]
+
+    def partitions(self, table, since_month=None):
+        """Archive database paths for table, newest month first, optionally from since_month on"""
+        if not os.path.isdir(self.archive_dir):
+            return []
+        months = sorted((name[len(table) + 1:-3] for name in os.listdir(self.archive_dir)
+                         if name.startswith(f"{table}-") and name.endswith('.db')), reverse=True)
+        return [os.path.join(self.archive_dir, f"{table}-{month}.db") for month in months
+                if since_month is None or month >= since_month]
+
+    def query(self, table, sql, parameters, since_month=None, first=False):
+        """Run a read against archive partitions, newest first.
+
+        With first=True stop at the first partition that returns rows.
+        """
+        rows = []
+        for path in self.partitions(table, since_month):
+            conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True, factory=self.read_factory)
+            try:
+                result = conn.execute(sql, parameters).fetchall()
+            finally:
+                conn.close()
+            if first and result:
+                return result
+            rows.extend(result)
+        return rows
+
+    def move_old_rows(self, table, schema, on_move=None):
+        """Move rows of table older than the horizon into monthly archive databases.
+
+        Each month is copied and deleted in one transaction spanning the live and
+        archive databases (ATTACH), so every row is in exactly one of them.
+        on_move(cursor, where, parameters) runs inside that transaction first, and
+        the changelog records the deletes as 'archive'.
+        """
+        os.makedirs(self.archive_dir, exist_ok=True)
+        moved = 0
+        with self.lock:
+            conn = self.connect()
+            try:
+                cutoff = self.cutoff(conn)
+                cursor = conn.cursor()
+                cursor.execute(f"SELECT DISTINCT strftime('%Y-%m', created_at) FROM {table} WHERE created_at < ?",
+                               (cutoff,))
+                months = [row[0] for row in cursor.fetchall()]
+                for month in months:
+                    conn.execute("ATTACH DATABASE ? AS archive",
+                                 (os.path.join(self.archive_dir, f"{table}-{month}.db"),))
+                    try:
+                        conn.execute(schema)
+                        where = "created_at < ? AND strftime('%Y-%m', created_at) = ?"
+                        cursor.execute("BEGIN IMMEDIATE")
+                        cursor.execute(f"INSERT INTO archive.{table} SELECT * FROM main.{table} WHERE {where}",
+                                       (cutoff, month))
+                        if on_move:
+                            on_move(cursor, where, (cutoff, month))
+                        cursor.execute("INSERT INTO main.archiving (active) VALUES (1)")
+                        cursor.execute(f"DELETE FROM main.{table} WHERE {where}", (cutoff, month))
+                        moved += cursor.rowcount
+                        cursor.execute("DELETE FROM main.archiving")
+                        conn.commit()
+                    except:
+                        conn.rollback()
+                        raise
+                    finally:
+                        conn.execute("DETACH DATABASE archive")
+            finally:
+                conn.close()
+        return moved
+
+    def remove(self, table):
+        """Delete every archive partition of table"""
+        for path in self.partitions(table):
+            os.remove(path)
+
+    def backup_sources(self, table):
+        """(file name under archive/, connect function) for each archive partition of table"""
+        return [(os.path.join('archive', os.path.basename(path)), lambda path=path: sqlite3.connect(path))
+                for path in self.partitions(table)]
+
+    def run(self, archive):
+        """Call archive() every `interval` seconds, forever"""
+        while True:
+            time.sleep(self.interval)
+            try:
+                moved = archive()
+                if moved:
+                    self.logger.info("archived %d rows", moved)
+            except Exception:
+                self.logger.exception("archival failed")
+
+    def start(self, archive):
+        """Start archiving in a background thread"""
+        threading.Thread(target=self.run, args=(archive,), daemon=True).start()
@@ -0,0 +1,148 @@
+"""
+Serving a Flask app under uvicorn (SERVER_MODE=asgi).
+
+Async views run on the event loop and await upstream calls through
+Upstream.request_async; every other view runs unchanged through asgiref's
+WsgiToAsgi on a bounded set of threads. Several private asgiref details are
+relied on here, so the images pin its version.
+"""
+
+import asyncio
+import contextvars
+import inspect
+import io
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import request
+from werkzeug.exceptions import HTTPException
+
+try:
+    import uvicorn
+    from asgiref.sync import SyncToAsync
+    from asgiref.wsgi import WsgiToAsgi, WsgiToAsgiInstance
+except ImportError:  # only needed for SERVER_MODE=asgi
+    uvicorn = SyncToAsync = WsgiToAsgi = WsgiToAsgiInstance = None
+
+
+class ThreadedWorker:
+    """Thread-sensitive context key (asgiref holds its executors weakly by key)"""
+
+
+class AsgiApp:
+    """ASGI entry point: async views on the event loop, every other view on one of `threads` threads.
+
+    The lifespan opens upstream's async clients with max_connections each, and
+    async views find their caller verified through verifier.
+    """
+
+    def __init__(self, app, upstream, verifier, threads, max_connections):
+        self.app = app
+        self.upstream = upstream
+        self.verifier = verifier
+        self.threads = threads
+        self.max_connections = max_connections
+        self.threaded_app = WsgiToAsgi(app)
+        # asgiref runs sync code on one shared thread, or on one thread per thread-sensitive
+        # context; each worker is such a context, so its thread serves request after request
+        self.threaded_workers = asyncio.Queue()
+        for _ in range(threads):
+            self.threaded_workers.put_nowait(ThreadedWorker())
+
+    def environ(self, scope, body):
+        """WSGI environ for an ASGI HTTP request, built as asgiref's WsgiToAsgi builds it"""
+        instance = WsgiToAsgiInstance(self.app)
+        instance.scope = scope
+        return instance.build_environ(scope, io.BytesIO(body))
+
+    def async_view(self, scope):
+        """The async view serving an ASGI HTTP request, or None if it is a threaded one"""
+        try:
+            endpoint, _ = self.app.url_map.bind('localhost').match(scope['path'], method=scope['method'])
+        except HTTPException:
+            return None
+        view = self.app.view_functions.get(endpoint)
+        return view if inspect.iscoroutinefunction(view) else None
+
+    async def dispatch(self, environ):
+        """Run an async view and the app's request hooks on the event loop"""
+        app = self.app
+        with app.request_context(environ):
+            self.upstream.set_deadline()
+            # Verify the caller first so admission control finds it memoized instead of blocking the loop
+            token = request.headers.get('Authorization') or request.args.get('token')
+            if token:
+                await self.verifier.verify_async(token)
+            try:
+                # As Flask's full_dispatch_request, with the view awaited
+                try:
+                    rv = app.preprocess_request()
+                    if rv is None:
+                        rv = await app.view_functions[request.endpoint](**request.view_args)
+                except Exception as e:
+                    rv = app.handle_user_exception(e)
+                # after_request hooks may write to the database, so they run off the loop
+                return await asyncio.to_thread(app.finalize_request, rv)
+            except Exception as e:
+                return app.handle_exception(e)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                # Threaded views and to_thread work share this pool
+                asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(max_workers=self.threads))
+                self.upstream.open_async_clients(self.max_connections)
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await self.upstream.close_async_clients()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def run_threaded(self, scope, receive, send):
+        """Serve a request with a sync view through asgiref, on the thread of a free worker"""
+        worker = await self.threaded_workers.get()
+        token = SyncToAsync.thread_sensitive_context.set(worker)
+        try:
+            await self.threaded_app(scope, receive, send)
+        finally:
+            SyncToAsync.thread_sensitive_context.reset(token)
+            self.threaded_workers.put_nowait(worker)
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self.lifespan(receive, send)
+            return
+        if scope['type'] != 'http' or self.async_view(scope) is None:
+            # An empty context: asgiref leaks its per-request executor into the context uvicorn
+            # starts the connection's next request in, which then fails on the dead executor
+            await asyncio.create_task(self.run_threaded(scope, receive, send), context=contextvars.Context())
+            return
+        body = b''
+        while True:
+            message = await receive()
+            body += message.get('body', b'')
+            if not message.get('more_body'):
+                break
+        response = await self.dispatch(self.environ(scope, body))
+        await send({
+            'type': 'http.response.start',
+            'status': response.status_code,
+            'headers': [(name.lower().encode('latin-1'), value.encode('latin-1'))
+                        for name, value in response.headers.items()]
+        })
+        await send({'type': 'http.response.body', 'body': response.get_data()})
+
+
+async def serve_asgi(asgi_app, port, unix_socket):
+    """Run uvicorn on TCP port and, if unix_socket is set, on that socket"""
+    servers = [uvicorn.Server(uvicorn.Config(asgi_app, host='0.0.0.0', port=port, lifespan='on'))]
+    if unix_socket:
+        if os.path.exists(unix_socket):
+            os.remove(unix_socket)
+        servers.append(uvicorn.Server(uvicorn.Config(asgi_app, uds=unix_socket, lifespan='off')))
+    tasks = [asyncio.create_task(server.serve()) for server in servers]
+    await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+    for server in servers:
+        server.should_exit = True
+    await asyncio.gather(*tasks)
@@ -0,0 +1,214 @@
+"""
+Token verification against the user service, for every service but users.
+
+Answers are cached while the revocation filter, polled from the user service,
+is fresh. Behind the gateway a signed X-Identity header vouches for a token
+so the service need not ask at all.
+"""
+
+import base64
+import hashlib
+import hmac
+import json
+import threading
+import time
+from collections import OrderedDict
+
+import requests
+from flask import request, g, has_request_context
+
+from common.wire import response_body
+from common.revocation import RevocationFilter
+
+
+def sign_identity(secret, token, auth):
+    """X-Identity value vouching that token verified as auth.
+
+    "<unix time>:<base64url JSON identity>:<hex HMAC-SHA256 of '<unix time>:<base64url
+    JSON identity>:<hex SHA-256 of token>' with IDENTITY_SECRET>", so a header only
+    vouches for the token it was signed with.
+    """
+    issued = str(int(time.time()))
+    payload = base64.urlsafe_b64encode(json.dumps(auth, separators=(',', ':')).encode()).decode().rstrip('=')
+    message = f"{issued}:{payload}:{hashlib.sha256(token.encode()).hexdigest()}"
+    return f"{issued}:{payload}:{hmac.new(secret.encode(), message.encode(), hashlib.sha256).hexdigest()}"
+
+
+def read_identity(secret, token, header, ttl):
+    """The identity a sign_identity header vouches for, or None if it is forged, stale or for another token"""
+    try:
+        issued, payload, signature = header.split(':')
+        message = f"{issued}:{payload}:{hashlib.sha256(token.encode()).hexdigest()}"
+        expected = hmac.new(secret.encode(), message.encode(), hashlib.sha256).hexdigest()
+        if not hmac.compare_digest(signature, expected) or abs(time.time() - float(issued)) > ttl:
+            return None
+        return json.loads(base64.urlsafe_b64decode(payload + '=' * (-len(payload) % 4)))
+    except Exception:
+        return None
+
+
+def client_address(secret, ttl):
+    """The caller's address: the one a gateway's X-Identity vouches for, else the connection's own.
+
+    Behind the gateway every request arrives from the gateway, so it signs the
+    client's address into X-Identity, with the request's token (or none).
+    """
+    header = request.headers.get('X-Identity')
+    if secret and header:
+        token = request.headers.get('Authorization') or request.args.get('token') or ''
+        identity = read_identity(secret, token, header, ttl)
+        if identity and identity.get('client'):
+            return identity['client']
+    return request.remote_addr
+
+
+class TokenVerifier:
+    """Verifies bearer tokens with the user service through upstream.
+
+    Verified identities are cached (the newest cache_size) and trusted while
+    the revocation filter was refreshed within max_staleness seconds. With an
+    identity_secret, X-Identity headers signed by the gateway are accepted for
+    identity_ttl seconds. A failed call to the user service makes the token
+    invalid, unless propagate_unavailable: then CircuitOpen and DeadlineExceeded
+    propagate so the caller can answer 503/504 rather than 401.
+    """
+
+    def __init__(self, upstream, poll_interval, max_staleness, cache_size, identity_secret='', identity_ttl=30,
+                 propagate_unavailable=False):
+        self.upstream = upstream
+        self.poll_interval = poll_interval
+        self.max_staleness = max_staleness
+        self.cache_size = cache_size
+        self.identity_secret = identity_secret
+        self.identity_ttl = identity_ttl
+        self.propagate_unavailable = propagate_unavailable
+        self.revocations = RevocationFilter()
+        self.verified_tokens = OrderedDict()
+        self.verified_tokens_lock = threading.Lock()
+        self.poller = None
+        self.poller_lock = threading.Lock()
+
+    def refresh_revocations(self):
+        """Pull the revocation entries added since our last version"""
+        params = {'since': self.revocations.version}
+        if self.revocations.epoch is not None:
+            params['epoch'] = self.revocations.epoch
+        revocations_url = self.upstream.service_url('user', '/internal/revocations')
+        resp = self.upstream.request('GET', 'user', revocations_url, params=params)
+        data = response_body(resp)
+        if data.get('status') == 1:
+            self.revocations.apply(data)
+
+    def poll_revocations(self):
+        while True:
+            try:
+                self.refresh_revocations()
+            except Exception:
+                pass
+            time.sleep(self.poll_interval)
+
+    def start_poller(self):
+        """Start the background revocation poll on first use"""
+        if self.poller is not None:
+            return
+        with self.poller_lock:
+            if self.poller is None:
+                self.poller = threading.Thread(target=self.poll_revocations, daemon=True)
+                self.poller.start()
+
+    def gateway_identity(self, token):
+        """The identity the gateway already verified for token, or None to verify it ourselves"""
+        header = request.headers.get('X-Identity') if self.identity_secret and has_request_context() else None
+        if not header:
+            return None
+        auth = read_identity(self.identity_secret, token, header, self.identity_ttl)
+        if auth is None or auth.get('valid') != 1 or auth.get('exp', 0) <= time.time():
+            return None
+        if self.revocations.is_revoked(auth):
+            return {"valid": 0}
+        return auth
+
+    def verify(self, token):
+        """Verify JWT token, at most once per request"""
+        # Admission control may already have verified this token for the request
+        if has_request_context() and g.get('auth_token') == token:
+            return g.auth
+        auth = self.verify_uncached(token)
+        if has_request_context():
+            g.auth_token = token
+            g.auth = auth
+        return auth
+
+    def verify_uncached(self, token):
+        """Verify JWT token, reusing earlier answers from the user service"""
+        auth, fresh = self.cached(token)
+        if auth is not None:
+            return auth
+        unavailable = (requests.RequestException, ValueError) if self.propagate_unavailable else Exception
+        try:
+            resp = self.upstream.request('GET', 'user', self.upstream.service_url('user', '/internal/verify_jwt'),
+                                         coalesce=True, params={'token': token})
+            auth = response_body(resp)
+        except unavailable:
+            return {"valid": 0}
+        return self.remember(token, auth, fresh)
+
+    async def verify_async(self, token):
+        """verify for async views, sharing its per-request memo and cache"""
+        if g.get('auth_token') == token:
+            return g.auth
+        auth, fresh = self.cached(token)
+        if auth is None:
+            try:
+                resp = await self.upstream.request_async('GET', 'user',
+                                                         self.upstream.service_url('user', '/internal/verify_jwt'),
+                                                         coalesce=True, params={'token': token})
+                auth = self.remember(token, response_body(resp), fresh)
+            except Exception:
+                auth = {"valid": 0}
+        g.auth_token = token
+        g.auth = auth
+        return auth
+
+    def cached(self, token):
+        """(identity, fresh) from X-Identity or the cache; identity is None when the user service must be asked.
+
+        A cached identity is only trusted while the revocation filter is fresher
+        than max_staleness.
+        """
+        self.start_poller()
+        auth = self.gateway_identity(token)
+        if auth is not None:
+            return auth, True
+        now = time.time()
+        fresh = now - self.revocations.refreshed_at <= self.max_staleness
+        if fresh:
+            with self.verified_tokens_lock:
+                auth = self.verified_tokens.get(token)
+                if auth is not None:
+                    self.verified_tokens.move_to_end(token)
+            if auth is not None and auth['exp'] > now:
+                if self.revocations.is_revoked(auth):
+                    return {"valid": 0}, fresh
+                return auth, fresh
+        return None, fresh
+
+    def remember(self, token, auth, fresh):
+        """Apply revocations to the user service's answer and cache it while fresh"""
+        if auth.get('valid') == 1 and self.revocations.is_revoked(auth):
+            return {"valid": 0}
+        if fresh and auth.get('valid') == 1 and auth.get('exp'):
+            with self.verified_tokens_lock:
+                self.verified_tokens[token] = auth
+                while len(self.verified_tokens) > self.cache_size:
+                    self.verified_tokens.popitem(last=False)
+        return auth
+
+    def client_key(self):
+        """Rate-limit key: the verified user, or the client's address without a valid token"""
+        token = request.headers.get('Authorization') or request.args.get('token')
+        if token:
+            auth = self.verify(token)
+            if auth.get('valid') == 1:
+                return f"user:{auth.get('username')}"
+        return f"ip:{client_address(self.identity_secret, self.identity_ttl)}"
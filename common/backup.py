@@ -0,0 +1,270 @@
+"""
+Online SQLite backups, taken while the service keeps serving.
+
+Each service builds one Backups with its configuration and a backup_sources
+hook naming the database files to copy; restore.py reads the result offline.
+"""
+
+import contextlib
+import os
+import shutil
+import sqlite3
+import threading
+import time
+
+from flask import request, jsonify, g
+
+from common.metrics import metric_lines, LatencyHistogram
+
+
+class BackupRestarted(Exception):
+    """Concurrent writes restarted an online backup too many times"""
+
+
+class BackupStats:
+    """Outcome and timing of online backups, for /metrics and /internal/backups"""
+
+    def __init__(self):
+        self.running = False
+        self.succeeded = 0
+        self.failed = 0
+        self.pages = 0
+        self.restarts = 0
+        self.single_steps = 0
+        self.seconds_total = 0.0
+        self.last = None
+        self.lock = threading.Lock()
+
+    def record_success(self, backup, seconds, pages, restarts, single_steps):
+        with self.lock:
+            self.succeeded += 1
+            self.pages += pages
+            self.restarts += restarts
+            self.single_steps += single_steps
+            self.seconds_total += seconds
+            self.last = {
+                "backup": backup,
+                "seconds": round(seconds, 4),
+                "pages": pages,
+                "restarts": restarts,
+                "finished_at": time.time()
+            }
+
+    def record_failure(self):
+        with self.lock:
+            self.failed += 1
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                "running": self.running,
+                "succeeded": self.succeeded,
+                "failed": self.failed,
+                "pages": self.pages,
+                "restarts": self.restarts,
+                "single_steps": self.single_steps,
+                "seconds_total": round(self.seconds_total, 4),
+                "last": self.last
+            }
+
+
+def copy_online(source, path, pages, sleep, max_restarts):
+    """Copy source into a new database file at path; returns (pages, restarts, single_step).
+
+    Each step copies `pages` pages under a short read lock, then sleeps `sleep`
+    seconds so writers get in. A write through another connection makes SQLite
+    restart the copy from the first page. After max_restarts restarts the
+    remainder is copied in one step, which holds the read lock until it
+    finishes. The file is a consistent snapshot either way.
+    """
+    state = {"remaining": None, "restarts": 0, "pages": 0}
+
+    def progress(status, remaining, total):
+        if state["remaining"] is not None and remaining > state["remaining"]:
+            state["restarts"] += 1
+            if state["restarts"] > max_restarts:
+                raise BackupRestarted()
+        state["remaining"] = remaining
+        state["pages"] = total
+        if remaining:
+            time.sleep(sleep)
+
+    dest = sqlite3.connect(path)
+    try:
+        try:
+            source.backup(dest, pages=pages, progress=progress)
+            return state["pages"], state["restarts"], 0
+        except BackupRestarted:
+            source.backup(dest)
+            return source.execute("PRAGMA page_count").fetchone()[0], state["restarts"] - 1, 1
+    finally:
+        dest.close()
+
+
+def list_backups(backup_dir):
+    """Names of the finished backups in backup_dir, oldest first"""
+    if not os.path.isdir(backup_dir):
+        return []
+    return sorted(name for name in os.listdir(backup_dir)
+                  if not name.endswith('.partial') and os.path.isdir(os.path.join(backup_dir, name)))
+
+
+class Backups:
+    """Scheduled and on-demand online backups of one service's database files.
+
+    backup_sources() returns (file name, connect function) for each file a
+    backup covers; prepare() runs before each backup. hold, if given, is held
+    while the files are copied, and each of directories is created in every
+    backup even when nothing is copied into it.
+    """
+
+    def __init__(self, backup_dir, pages, sleep, max_restarts, keep, interval, latency_buckets, logger,
+                 backup_sources, prepare=None, hold=None, directories=()):
+        self.backup_dir = backup_dir
+        self.pages = pages
+        self.sleep = sleep
+        self.max_restarts = max_restarts
+        self.keep = keep
+        self.interval = interval
+        self.logger = logger
+        self.backup_sources = backup_sources
+        self.prepare = prepare
+        self.hold = hold
+        self.directories = directories
+        self.stats = BackupStats()
+        self.lock = threading.Lock()
+        self.request_latency = LatencyHistogram(latency_buckets)
+
+    def list(self):
+        return list_backups(self.backup_dir)
+
+    def rotate(self):
+        """Delete all but the newest `keep` backups, and unfinished ones"""
+        for name in os.listdir(self.backup_dir):
+            if name.endswith('.partial'):
+                shutil.rmtree(os.path.join(self.backup_dir, name), ignore_errors=True)
+        backups = self.list()
+        for name in backups[:max(0, len(backups) - self.keep)]:
+            shutil.rmtree(os.path.join(self.backup_dir, name), ignore_errors=True)
+
+    def take(self):
+        """Take an online backup into backup_dir/<UTC time>/ and rotate; returns its name.
+
+        Returns None without doing anything if a backup is already running.
+        """
+        if not self.lock.acquire(blocking=False):
+            return None
+        try:
+            if self.prepare is not None:
+                self.prepare()
+            now = time.time()
+            name = time.strftime('%Y%m%dT%H%M%S', time.gmtime(now)) + f".{int(now * 1000) % 1000:03d}Z"
+            work = os.path.join(self.backup_dir, f"{name}.partial")
+            os.makedirs(work)
+            for directory in self.directories:
+                os.makedirs(os.path.join(work, directory))
+            self.stats.running = True
+            started = time.perf_counter()
+            pages = restarts = single_steps = 0
+            try:
+                with self.hold if self.hold is not None else contextlib.nullcontext():
+                    for file_name, connect in self.backup_sources():
+                        source = connect()
+                        try:
+                            copied, restarted, single_step = copy_online(
+                                source, os.path.join(work, file_name), self.pages, self.sleep, self.max_restarts)
+                        finally:
+                            source.close()
+                        pages += copied
+                        restarts += restarted
+                        single_steps += single_step
+                os.rename(work, os.path.join(self.backup_dir, name))
+            except Exception:
+                shutil.rmtree(work, ignore_errors=True)
+                self.stats.record_failure()
+                raise
+            finally:
+                self.stats.running = False
+            self.stats.record_success(name, time.perf_counter() - started, pages, restarts, single_steps)
+            self.rotate()
+            return name
+        finally:
+            self.lock.release()
+
+    def run(self):
+        """Take a backup every `interval` seconds, forever"""
+        while True:
+            time.sleep(self.interval)
+            try:
+                name = self.take()
+                if name:
+                    self.logger.info("backup %s written", name)
+            except Exception:
+                self.logger.exception("backup failed")
+
+    def start(self):
+        """Start the backup schedule in a background thread"""
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def backup_metrics(self):
+        stats = self.stats.snapshot()
+        last = stats["last"] or {}
+        return (
+            metric_lines('sqlite_backup_running', 'gauge', 'Whether an online backup is in progress',
+                         [({}, int(stats["running"]))])
+            + metric_lines('sqlite_backups_total', 'counter', 'Online backups by result',
+                           [({'result': 'success'}, stats["succeeded"]), ({'result': 'failure'}, stats["failed"])])
+            + metric_lines('sqlite_backup_seconds_total', 'counter', 'Time spent taking successful backups',
+                           [({}, stats["seconds_total"])])
+            + metric_lines('sqlite_backup_last_seconds', 'gauge', 'Duration of the last successful backup',
+                           [({}, last.get("seconds", 0))])
+            + metric_lines('sqlite_backup_last_success_timestamp_seconds', 'gauge', 'When the last backup finished',
+                           [({}, last.get("finished_at", 0))])
+            + metric_lines('sqlite_backup_pages_total', 'counter', 'Database pages copied by backups',
+                           [({}, stats["pages"])])
+            + metric_lines('sqlite_backup_restarts_total', 'counter', 'Backup copies restarted by concurrent writes',
+                           [({}, stats["restarts"])])
+            + metric_lines('sqlite_backup_single_steps_total', 'counter',
+                           'Backups finished in one locked step after too many restarts', [({}, stats["single_steps"])])
+        )
+
+    def request_metrics(self):
+        return self.request_latency.lines('http_request_duration_seconds',
+                                          'Request latency by endpoint and whether a backup was running',
+                                          ('endpoint', 'backup'))
+
+    def install(self, app, metrics):
+        """Add /internal/backups, request timing and the backup metrics to app"""
+        def backups_report():
+            """Internal endpoint listing the finished backups with backup statistics"""
+            return jsonify({"status": 1, "backups": self.list(), **self.stats.snapshot()})
+
+        def take_backup():
+            """Internal endpoint taking an online backup now"""
+            try:
+                name = self.take()
+            except Exception as e:
+                return jsonify({"status": 2})
+            if name is None:
+                return jsonify({"status": 2, "error": "backup_running"})
+            return jsonify({"status": 1, "backup": name})
+
+        def start_request_timer():
+            g.request_started = time.perf_counter()
+            g.during_backup = self.stats.running
+
+        def record_request_latency(response):
+            """Time the request, labelled by whether a backup ran at any point during it"""
+            started = g.get('request_started')
+            if started is not None and request.endpoint:
+                during = g.get('during_backup') or self.stats.running
+                self.request_latency.observe((request.endpoint, 'running' if during else 'idle'),
+                                             time.perf_counter() - started)
+            return response
+
+        app.add_url_rule('/internal/backups', 'backups_report', backups_report, methods=['GET'])
+        app.add_url_rule('/internal/backups', 'take_backup', take_backup, methods=['POST'])
+        app.before_request(start_request_timer)
+        app.after_request(record_request_latency)
+        metrics.add(self.backup_metrics)
+        metrics.add(self.request_metrics)
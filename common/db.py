@@ -0,0 +1,255 @@
+"""
+SQLite statement timing, commit notification and the /changes feed.
+"""
+
+import json
+import sqlite3
+import threading
+import time
+
+from flask import request, jsonify
+
+
+class QueryStats:
+    """Per-statement count, total and max execution time.
+
+    Statements slower than slow_query_ms are logged with their query plan.
+    """
+
+    def __init__(self, slow_query_ms, logger):
+        self.slow_query_ms = slow_query_ms
+        self.logger = logger
+        self.stats = {}
+        self.lock = threading.Lock()
+
+    def record(self, sql, elapsed, plan=None):
+        with self.lock:
+            entry = self.stats.get(sql)
+            if entry is None:
+                entry = self.stats[sql] = {"count": 0, "total": 0.0, "max": 0.0, "slow": 0, "plan": None}
+            entry["count"] += 1
+            entry["total"] += elapsed
+            entry["max"] = max(entry["max"], elapsed)
+            if plan is not None:
+                entry["slow"] += 1
+                entry["plan"] = plan
+
+    def record_query(self, conn, sql, parameters, elapsed):
+        normalized = ' '.join(sql.split())
+        plan = None
+        if elapsed * 1000 >= self.slow_query_ms and \
+                normalized.split(' ', 1)[0].upper() in ('SELECT', 'INSERT', 'UPDATE', 'DELETE'):
+            try:
+                rows = sqlite3.Connection.execute(conn, f"EXPLAIN QUERY PLAN {sql}", parameters).fetchall()
+                plan = [row[-1] for row in rows]
+            except sqlite3.Error:
+                plan = []
+            self.logger.warning("slow query %.1f ms: %s params=%s plan=%s",
+                                elapsed * 1000, normalized, parameter_shape(parameters), plan)
+        self.record(normalized, elapsed, plan)
+
+    def snapshot(self):
+        with self.lock:
+            return [{
+                "sql": sql,
+                "count": entry["count"],
+                "total_ms": round(entry["total"] * 1000, 3),
+                "avg_ms": round(entry["total"] * 1000 / entry["count"], 3),
+                "max_ms": round(entry["max"] * 1000, 3),
+                "slow": entry["slow"],
+                "plan": entry["plan"]
+            } for sql, entry in sorted(self.stats.items(), key=lambda item: item[1]["total"], reverse=True)]
+
+    def reset(self):
+        with self.lock:
+            self.stats = {}
+
+    def install(self, app):
+        """Serve GET /internal/query_stats as endpoint 'query_stats_report'"""
+        def query_stats_report():
+            """Internal endpoint with per-statement timings; ?reset=1 clears them"""
+            stats = self.snapshot()
+            if request.args.get('reset') == '1':
+                self.reset()
+            return jsonify({"status": 1, "slow_query_ms": self.slow_query_ms, "queries": stats})
+
+        app.add_url_rule('/internal/query_stats', 'query_stats_report', query_stats_report, methods=['GET'])
+
+
+def parameter_shape(parameters):
+    """Types of the bound parameters, without their values"""
+    if isinstance(parameters, dict):
+        return {key: type(value).__name__ for key, value in parameters.items()}
+    return [type(value).__name__ for value in parameters]
+
+
+class ChangeNotifier:
+    """Wakes /changes long-polls when this process commits a write.
+
+    Commits by other processes sharing the database are only picked up by the
+    waiters' periodic re-read.
+    """
+
+    def __init__(self):
+        self.generation = 0
+        self.condition = threading.Condition()
+
+    def notify(self):
+        with self.condition:
+            self.generation += 1
+            self.condition.notify_all()
+
+    def wait(self, generation, timeout):
+        with self.condition:
+            self.condition.wait_for(lambda: self.generation != generation, timeout)
+
+
+def read_changes(conn, since, epoch, limit):
+    """Up to limit changelog entries after since, from the oldest one kept if the caller must reset"""
+    cursor = conn.cursor()
+    cursor.execute("SELECT epoch FROM changelog_epoch")
+    current_epoch = cursor.fetchone()[0]
+    cursor.execute("SELECT seq FROM sqlite_sequence WHERE name = 'changelog'")
+    row = cursor.fetchone()
+    latest = row[0] if row else 0
+    cursor.execute("SELECT MIN(seq) FROM changelog")
+    oldest = cursor.fetchone()[0] or latest + 1
+    reset = (epoch is not None and epoch != current_epoch) or since > latest or since < oldest - 1
+    if reset:
+        since = oldest - 1
+    cursor.execute("""
+        SELECT seq, table_name, op, row_key, data, changed_at
+        FROM changelog
+        WHERE seq > ?
+        ORDER BY seq
+        LIMIT ?
+    """, (since, limit))
+    changes = [{"seq": seq, "table": table_name, "op": op, "key": json.loads(row_key),
+                "data": json.loads(data) if data is not None else None, "changed_at": changed_at}
+               for seq, table_name, op, row_key, data, changed_at in cursor.fetchall()]
+    return {
+        "epoch": current_epoch,
+        "reset": reset,
+        "changes": changes,
+        "next": changes[-1]["seq"] if changes else since,
+        "latest": latest
+    }
+
+
+class ChangesFeed:
+    """GET /changes, a long-poll feed of a service's changelog.
+
+    connect() opens a connection to the database. With shard_count set, each
+    of that many shards keeps its own changelog: the caller picks one with
+    `shard` and connect(shard) opens it.
+    """
+
+    def __init__(self, change_notifier, connect, max_wait, poll_interval, batch_size, max_waiters,
+                 shard_count=None):
+        self.change_notifier = change_notifier
+        self.connect = connect
+        self.max_wait = max_wait
+        self.poll_interval = poll_interval
+        self.batch_size = batch_size
+        self.waiters = threading.Semaphore(max_waiters)
+        self.shard_count = shard_count
+
+    def changes_feed(self):
+        """Long-poll feed of the inserts, updates and deletes numbered above `since`.
+
+        Waits up to `wait` seconds (at most max_wait) for a change, or answers
+        503 if max_waiters requests are waiting already. Callers send back
+        `next` as `since` and `epoch` as `epoch`. `reset` means the
+        database was recreated or pruned past `since`, so whatever the caller built
+        from the feed must be rebuilt.
+        """
+        try:
+            try:
+                since = int(request.args.get('since', '0'))
+                wait = max(0.0, min(float(request.args.get('wait', self.max_wait)), self.max_wait))
+                limit = max(1, min(int(request.args.get('limit', self.batch_size)), self.batch_size))
+                shard = int(request.args.get('shard', '0'))
+            except ValueError:
+                return jsonify({"status": 2})
+            if not 0 <= shard < (self.shard_count or 1):
+                return jsonify({"status": 2})
+            deadline = time.time() + wait
+            waiting = wait > 0
+            if waiting and not self.waiters.acquire(blocking=False):
+                response = jsonify({"status": 2, "error": "too_many_waiters"})
+                response.status_code = 503
+                response.headers['Retry-After'] = str(max(1, int(self.poll_interval + 0.999)))
+                return response
+
+            try:
+                while True:
+                    generation = self.change_notifier.generation
+                    # A connection per read, so a waiting request holds none while it sleeps
+                    conn = self.connect(shard) if self.shard_count else self.connect()
+                    try:
+                        feed = read_changes(conn, since, request.args.get('epoch'), limit)
+                    finally:
+                        conn.close()
+                    remaining = deadline - time.time()
+                    if feed["changes"] or feed["reset"] or remaining <= 0:
+                        break
+                    self.change_notifier.wait(generation, min(remaining, self.poll_interval))
+            finally:
+                if waiting:
+                    self.waiters.release()
+
+            if self.shard_count:
+                return jsonify({"status": 1, "shard": shard, "shards": self.shard_count, **feed})
+            return jsonify({"status": 1, **feed})
+
+        except Exception as e:
+            return jsonify({"status": 2})
+
+    def install(self, app):
+        """Serve GET /changes on app as endpoint 'changes_feed'"""
+        app.add_url_rule('/changes', 'changes_feed', self.changes_feed, methods=['GET'])
+
+
+class TimedCursor(sqlite3.Cursor):
+    """Cursor that times every statement into its connection's query stats"""
+
+    def execute(self, sql, parameters=()):
+        start = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            self.connection.query_stats.record_query(self.connection, sql, parameters, time.perf_counter() - start)
+
+    def executemany(self, sql, seq_of_parameters):
+        start = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            self.connection.query_stats.record_query(self.connection, sql, (), time.perf_counter() - start)
+
+
+class TimedConnection(sqlite3.Connection):
+    """Connection whose cursors (including conn.execute) are TimedCursors.
+
+    Each service gets a subclass from timed_connection.
+    """
+    query_stats = None
+    change_notifier = None
+
+    def cursor(self, factory=TimedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def commit(self):
+        wrote = self.in_transaction
+        super().commit()
+        if wrote:
+            self.change_notifier.notify()
+
+
+def timed_connection(query_stats, change_notifier):
+    """TimedConnection class timing into query_stats and notifying change_notifier on commit"""
+    return type('TimedConnection', (TimedConnection,),
+                {'query_stats': query_stats, 'change_notifier': change_notifier})
@@ -0,0 +1,225 @@
+"""
+Memory diagnostics: cache sizes, RSS and tracemalloc snapshots of a worker.
+
+Each service registers its caches and in-memory indexes by name; the sizes
+are reported at /internal/memory and /metrics.
+"""
+
+import gc
+import os
+import sys
+import threading
+import time
+import tracemalloc
+import types
+from collections import OrderedDict
+
+from flask import request, jsonify
+
+from common.metrics import metric_lines
+
+
+def approximate_size(obj):
+    """Bytes held by obj and everything it references, counting shared objects once"""
+    seen = set()
+    size = 0
+    pending = [obj]
+    while pending:
+        item = pending.pop()
+        if id(item) in seen or isinstance(item, (type, types.ModuleType, types.FunctionType)):
+            continue
+        seen.add(id(item))
+        size += sys.getsizeof(item)
+        pending.extend(gc.get_referents(item))
+    return size
+
+
+def resident_memory():
+    """Resident set size of this worker process in bytes, or None without /proc"""
+    try:
+        with open('/proc/self/status', 'r') as status:
+            for line in status:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+class MemorySnapshots:
+    """tracemalloc snapshots kept for diffing, the newest `keep` by id"""
+
+    def __init__(self, keep):
+        self.keep = keep
+        self.snapshots = OrderedDict()
+        self.next_id = 1
+        self.lock = threading.Lock()
+
+    def take(self):
+        # Allocations made by tracemalloc and the import machinery are noise here
+        snapshot = tracemalloc.take_snapshot().filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+            tracemalloc.Filter(False, '<frozen importlib._bootstrap_external>'),
+            tracemalloc.Filter(False, '<unknown>')
+        ))
+        with self.lock:
+            snapshot_id = self.next_id
+            self.next_id += 1
+            self.snapshots[snapshot_id] = (time.time(), snapshot)
+            while len(self.snapshots) > self.keep:
+                self.snapshots.popitem(last=False)
+        return snapshot_id, snapshot
+
+    def get(self, snapshot_id):
+        with self.lock:
+            entry = self.snapshots.get(snapshot_id)
+        return entry[1] if entry else None
+
+    def summary(self):
+        with self.lock:
+            items = list(self.snapshots.items())
+        return [{"id": snapshot_id, "taken_at": taken_at,
+                 "traced_bytes": sum(trace.size for trace in snapshot.traces)}
+                for snapshot_id, (taken_at, snapshot) in items]
+
+
+def allocation_sites(stats, top):
+    """JSON rows for the first `top` tracemalloc Statistic or StatisticDiff entries.
+
+    "site" is the allocating line; "traceback" (with more than one traced frame) runs oldest call first.
+    """
+    rows = []
+    for stat in stats[:top]:
+        row = {
+            "site": f"{stat.traceback[-1].filename}:{stat.traceback[-1].lineno}",
+            "size": stat.size,
+            "count": stat.count
+        }
+        if isinstance(stat, tracemalloc.StatisticDiff):
+            row["size_diff"] = stat.size_diff
+            row["count_diff"] = stat.count_diff
+        if len(stat.traceback) > 1:
+            row["traceback"] = [f"{frame.filename}:{frame.lineno}" for frame in stat.traceback]
+        rows.append(row)
+    return rows
+
+
+class MemoryDiagnostics:
+    """/internal/memory endpoints and memory metrics for one service.
+
+    caches maps a name to a function returning (object, number of entries).
+    With diagnostics on, tracemalloc traces trace_frames frames per allocation
+    and /metrics adds cache sizes in bytes.
+    """
+
+    def __init__(self, caches, diagnostics, trace_frames, snapshots_kept):
+        self.caches = caches
+        self.diagnostics = diagnostics
+        self.trace_frames = trace_frames
+        self.snapshots = MemorySnapshots(snapshots_kept)
+
+    def start(self):
+        """Start tracing allocations if diagnostics are on"""
+        if self.diagnostics:
+            tracemalloc.start(self.trace_frames)
+
+    def cache_sizes(self, measure_bytes):
+        """{name: {"entries", and "bytes" when measure_bytes}} for every registered cache"""
+        sizes = {}
+        for name, describe in self.caches.items():
+            obj, entries = describe()
+            sizes[name] = {"entries": entries}
+            if measure_bytes:
+                sizes[name]["bytes"] = approximate_size(obj)
+        return sizes
+
+    def snapshot_options(self):
+        """(top, key_type) from the query string, or None if invalid"""
+        try:
+            top = int(request.args.get('top', '20'))
+        except ValueError:
+            return None
+        key_type = request.args.get('group_by', 'traceback' if self.trace_frames > 1 else 'lineno')
+        if top < 1 or key_type not in ('lineno', 'filename', 'traceback'):
+            return None
+        return top, key_type
+
+    def memory_metrics(self):
+        lines = metric_lines('process_resident_memory_bytes', 'gauge', 'Resident memory of this worker process',
+                             [({'pid': os.getpid()}, resident_memory() or 0)])
+        sizes = self.cache_sizes(self.diagnostics)
+        lines += metric_lines('cache_entries', 'gauge', 'Entries in each in-memory cache or index',
+                              [({'cache': name}, size["entries"]) for name, size in sizes.items()])
+        if self.diagnostics:
+            lines += metric_lines('cache_size_bytes', 'gauge', 'Approximate memory held by each cache or index',
+                                  [({'cache': name}, size["bytes"]) for name, size in sizes.items()])
+        if tracemalloc.is_tracing():
+            traced, peak = tracemalloc.get_traced_memory()
+            lines += metric_lines('tracemalloc_traced_bytes', 'gauge', 'Memory currently traced by tracemalloc',
+                                  [({}, traced)])
+            lines += metric_lines('tracemalloc_peak_bytes', 'gauge', 'Peak memory traced by tracemalloc',
+                                  [({}, peak)])
+        return lines
+
+    def install(self, app, metrics):
+        """Add the /internal/memory endpoints and the memory metrics to app"""
+        def memory_report():
+            """Internal endpoint reporting RSS, cache sizes and tracemalloc state of this worker"""
+            try:
+                traced, peak = tracemalloc.get_traced_memory()
+                return jsonify({
+                    "status": 1,
+                    "pid": os.getpid(),
+                    "rss_bytes": resident_memory(),
+                    "caches": self.cache_sizes(True),
+                    "tracing": tracemalloc.is_tracing(),
+                    "traced_bytes": traced,
+                    "peak_traced_bytes": peak,
+                    "snapshots": self.snapshots.summary()
+                })
+            except Exception as e:
+                return jsonify({"status": 2})
+
+        def take_memory_snapshot():
+            """Internal endpoint taking a tracemalloc snapshot; returns its id and top allocation sites"""
+            if not tracemalloc.is_tracing():
+                return jsonify({"status": 2, "error": "tracing_off"})
+            options = self.snapshot_options()
+            if options is None:
+                return jsonify({"status": 2})
+            top, key_type = options
+            snapshot_id, snapshot = self.snapshots.take()
+            return jsonify({"status": 1, "snapshot": snapshot_id,
+                            "top": allocation_sites(snapshot.statistics(key_type), top)})
+
+        def memory_diff():
+            """Internal endpoint diffing snapshot `from` against `to` (default: a new snapshot now)"""
+            if not tracemalloc.is_tracing():
+                return jsonify({"status": 2, "error": "tracing_off"})
+            options = self.snapshot_options()
+            if options is None:
+                return jsonify({"status": 2})
+            top, key_type = options
+            try:
+                from_id = int(request.args.get('from', ''))
+                to_id = int(request.args['to']) if 'to' in request.args else None
+            except ValueError:
+                return jsonify({"status": 2})
+            old = self.snapshots.get(from_id)
+            if old is None:
+                return jsonify({"status": 2, "error": "unknown_snapshot"})
+            if to_id is None:
+                to_id, new = self.snapshots.take()
+            else:
+                new = self.snapshots.get(to_id)
+                if new is None:
+                    return jsonify({"status": 2, "error": "unknown_snapshot"})
+            return jsonify({"status": 1, "from": from_id, "to": to_id,
+                            "top": allocation_sites(new.compare_to(old, key_type), top)})
+
+        app.add_url_rule('/internal/memory', 'memory_report', memory_report, methods=['GET'])
+        app.add_url_rule('/internal/memory/snapshots', 'take_memory_snapshot', take_memory_snapshot,
+                         methods=['POST'])
+        app.add_url_rule('/internal/memory/diff', 'memory_diff', memory_diff, methods=['GET'])
+        metrics.add(self.memory_metrics)
@@ -0,0 +1,72 @@
+"""
+Prometheus text-format metrics served at /metrics.
+"""
+
+import threading
+
+from flask import Response
+
+
+def metric_lines(name, kind, help_text, samples):
+    """Prometheus text-format lines for one metric; samples are (labels dict, value) pairs"""
+    lines = [f"# HELP {name} {help_text}", f"# TYPE {name} {kind}"]
+    for labels, value in samples:
+        label_text = ",".join(f'{key}="{label}"' for key, label in labels.items())
+        lines.append(f"{name}{{{label_text}}} {value}" if label_text else f"{name} {value}")
+    return lines
+
+
+class LatencyHistogram:
+    """Request durations per label tuple in cumulative buckets"""
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.series = {}
+        self.lock = threading.Lock()
+
+    def observe(self, labels, seconds):
+        with self.lock:
+            series = self.series.get(labels)
+            if series is None:
+                series = self.series[labels] = [[0] * len(self.buckets), 0, 0.0]
+            for i, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    series[0][i] += 1
+            series[1] += 1
+            series[2] += seconds
+
+    def lines(self, name, help_text, label_names):
+        lines = [f"# HELP {name} {help_text}", f"# TYPE {name} histogram"]
+        with self.lock:
+            series = sorted(self.series.items())
+        for labels, (counts, count, total) in series:
+            label_text = ",".join(f'{key}="{value}"' for key, value in zip(label_names, labels))
+            for bound, bucket_count in zip(self.buckets, counts):
+                lines.append(f'{name}_bucket{{{label_text},le="{bound}"}} {bucket_count}')
+            lines.append(f'{name}_bucket{{{label_text},le="+Inf"}} {count}')
+            lines.append(f"{name}_sum{{{label_text}}} {total}")
+            lines.append(f"{name}_count{{{label_text}}} {count}")
+        return lines
+
+
+class Metrics:
+    """The /metrics endpoint; each subsystem adds a function returning its lines"""
+
+    def __init__(self):
+        self.collectors = []
+
+    def add(self, collect):
+        self.collectors.append(collect)
+
+    def lines(self):
+        lines = []
+        for collect in self.collectors:
+            lines.extend(collect())
+        return lines
+
+    def install(self, app):
+        """Serve GET /metrics on app as endpoint 'metrics'"""
+        def metrics():
+            """Prometheus text-format metrics from every registered collector"""
+            return Response("\n".join(self.lines()) + "\n", mimetype='text/plain; version=0.0.4')
+        app.add_url_rule('/metrics', 'metrics', metrics, methods=['GET'])
@@ -0,0 +1,125 @@
+"""
+Opt-in cProfile profiling of individual requests.
+"""
+
+import cProfile
+import hashlib
+import hmac
+import os
+import pstats
+import random
+import threading
+import time
+
+from flask import request, jsonify, g
+
+from common.aio import on_event_loop
+
+
+class Profiling:
+    """Runs selected requests under cProfile and saves them to profile_dir.
+
+    A request is profiled if it carries a valid X-Profile signature (with
+    secret) or, with sample_rate > 0, at random. The newest max_files
+    profiles are kept.
+    """
+
+    def __init__(self, enabled, secret, sample_rate, profile_dir, max_files):
+        self.enabled = enabled
+        self.secret = secret
+        self.sample_rate = sample_rate
+        self.profile_dir = profile_dir
+        self.max_files = max_files
+        self.counter = 0
+        self.lock = threading.Lock()
+
+    def requested(self):
+        """Whether to profile this request: a valid X-Profile signature or a sampling hit.
+
+        X-Profile is "<unix time>:<hex HMAC-SHA256 of '<unix time>:<path>' with PROFILE_SECRET>"
+        and is accepted for five minutes.
+        """
+        if not self.enabled:
+            return False
+        # cProfile is per thread, and the event loop interleaves many requests on one
+        if on_event_loop():
+            return False
+        header = request.headers.get('X-Profile')
+        if header and self.secret:
+            timestamp, _, signature = header.partition(':')
+            expected = hmac.new(self.secret.encode(), f"{timestamp}:{request.path}".encode(),
+                                hashlib.sha256).hexdigest()
+            try:
+                fresh = abs(time.time() - float(timestamp)) < 300
+            except ValueError:
+                fresh = False
+            if fresh and hmac.compare_digest(signature, expected):
+                return True
+        return self.sample_rate > 0 and random.random() < self.sample_rate
+
+    def start_profile(self):
+        if not self.requested():
+            return
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError:
+            # Another request on a different thread is already being profiled
+            return
+        g.profiler = profiler
+
+    def save_profile(self, response):
+        """Write the request's profile to profile_dir, keeping the newest max_files"""
+        profiler = g.pop('profiler', None)
+        if profiler is None:
+            return response
+        profiler.disable()
+        profile_dir = self.profile_dir
+        try:
+            with self.lock:
+                self.counter += 1
+                os.makedirs(profile_dir, exist_ok=True)
+                path = os.path.join(profile_dir, f"{int(time.time() * 1000)}-{os.getpid()}-{self.counter}-"
+                                                 f"{request.endpoint}.pstats")
+                profiler.dump_stats(path)
+                profiles = sorted(os.listdir(profile_dir),
+                                  key=lambda name: os.path.getmtime(os.path.join(profile_dir, name)))
+                for name in profiles[:-self.max_files]:
+                    os.remove(os.path.join(profile_dir, name))
+        except OSError:
+            pass
+        return response
+
+    def profile_summary(self):
+        """Internal endpoint listing the top cumulative functions across saved profiles"""
+        profile_dir = self.profile_dir
+        try:
+            top = int(request.args.get('top', '20'))
+            endpoint = request.args.get('endpoint')
+            with self.lock:
+                names = [name for name in os.listdir(profile_dir) if name.endswith('.pstats')] \
+                    if os.path.isdir(profile_dir) else []
+                if endpoint:
+                    names = [name for name in names if name.endswith(f"-{endpoint}.pstats")]
+                if not names:
+                    return jsonify({"status": 1, "profiles": 0, "functions": []})
+                stats = pstats.Stats(*[os.path.join(profile_dir, name) for name in names])
+            rows = sorted(stats.stats.items(), key=lambda item: item[1][3], reverse=True)[:top]
+            return jsonify({
+                "status": 1,
+                "profiles": len(names),
+                "functions": [{
+                    "function": f"{filename}:{line}({function})",
+                    "calls": calls,
+                    "tottime": round(tottime, 6),
+                    "cumtime": round(cumtime, 6)
+                } for (filename, line, function), (_, calls, tottime, cumtime, _) in rows]
+            })
+        except Exception as e:
+            return jsonify({"status": 2, "profiles": 0, "functions": []})
+
+    def install(self, app):
+        """Profile app's requests and serve GET /internal/profiles as endpoint 'profile_summary'"""
+        app.before_request(self.start_profile)
+        app.after_request(self.save_profile)
+        app.add_url_rule('/internal/profiles', 'profile_summary', self.profile_summary, methods=['GET'])
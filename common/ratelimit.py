@@ -0,0 +1,97 @@
+"""
+Token-bucket rate limiting keyed by (client, endpoint).
+"""
+
+import threading
+import time
+from collections import OrderedDict
+
+from flask import request, jsonify, g
+
+
+class TokenBucket:
+    """Refills at `rate` tokens per second up to `burst`"""
+    __slots__ = ('tokens', 'updated')
+
+    def __init__(self, burst, now):
+        self.tokens = burst
+        self.updated = now
+
+
+class RateLimiter:
+    """Token buckets keyed by (client, endpoint), least recently used evicted first"""
+
+    def __init__(self, rate, burst, max_keys):
+        self.rate = rate
+        self.burst = burst
+        self.max_keys = max_keys
+        self.buckets = OrderedDict()
+        self.rejected = 0
+        self.lock = threading.Lock()
+
+    def acquire(self, key):
+        """Take a token; returns 0 if admitted, else seconds until one is available"""
+        now = time.monotonic()
+        with self.lock:
+            bucket = self.buckets.get(key)
+            if bucket is None:
+                bucket = self.buckets[key] = TokenBucket(self.burst, now)
+                if len(self.buckets) > self.max_keys:
+                    self.buckets.popitem(last=False)
+            else:
+                self.buckets.move_to_end(key)
+                bucket.tokens = min(self.burst, bucket.tokens + (now - bucket.updated) * self.rate)
+                bucket.updated = now
+            if bucket.tokens >= 1:
+                bucket.tokens -= 1
+                return 0
+            self.rejected += 1
+            return (1 - bucket.tokens) / self.rate if self.rate > 0 else 60
+
+
+def rate_limited(retry_after):
+    response = jsonify({"status": 2, "error": "rate_limited"})
+    response.status_code = 429
+    response.headers['Retry-After'] = str(max(1, int(retry_after + 0.999)))
+    return response
+
+
+class Admission:
+    """Admission control for a service's public endpoints.
+
+    Internal endpoints take a separate lane with no limits, so public traffic
+    can never starve them. Public requests must get one of `concurrency` slots
+    and a token from the bucket for (client_key(), endpoint), or get 429.
+    """
+
+    def __init__(self, rate_limiter, concurrency, internal_endpoints, client_key):
+        self.rate_limiter = rate_limiter
+        self.public_lane = threading.BoundedSemaphore(concurrency)
+        self.internal_endpoints = internal_endpoints
+        self.client_key = client_key
+
+    def admit_request(self):
+        if request.endpoint is None or request.endpoint in self.internal_endpoints:
+            return None
+        if not self.public_lane.acquire(blocking=False):
+            with self.rate_limiter.lock:
+                self.rate_limiter.rejected += 1
+            return rate_limited(1)
+        g.public_lane = True
+        retry_after = self.rate_limiter.acquire((self.client_key(), request.endpoint))
+        if retry_after:
+            return rate_limited(retry_after)
+        return None
+
+    def release_public_lane(self):
+        """Give back the request's public lane slot (long-lived responses call this early)"""
+        if g.pop('public_lane', False):
+            self.public_lane.release()
+
+    def release_admission(self, exc):
+        self.release_public_lane()
+
+    def install(self, app):
+        """Run admission control before each of app's requests"""
+        app.before_request(self.admit_request)
+        app.teardown_request(self.release_admission)
@@ -0,0 +1,170 @@
+"""
+Circuit breakers and single-flight coalescing for upstream calls.
+"""
+
+import asyncio
+import threading
+import time
+
+
+class DeadlineExceeded(Exception):
+    """The request's deadline passed before an upstream call could be made"""
+
+
+class CircuitOpen(Exception):
+    """The target's circuit breaker is open, so the call fails fast"""
+
+
+class CircuitBreaker:
+    """Per-target breaker: closed -> open after consecutive failures -> half-open probe.
+
+    While open every call fails immediately. After reset_timeout one probe
+    call is let through; its outcome closes or re-opens the breaker.
+    """
+
+    def __init__(self, target, failure_threshold, reset_timeout, logger):
+        self.target = target
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.logger = logger
+        self.state = 'closed'
+        self.failures = 0
+        self.opened_at = 0.0
+        self.probing = False
+        self.trips = 0
+        self.rejected = 0
+        self.lock = threading.Lock()
+
+    def before_call(self):
+        with self.lock:
+            if self.state == 'closed':
+                return
+            if self.state == 'open' and time.time() - self.opened_at >= self.reset_timeout:
+                self.state = 'half_open'
+                self.probing = False
+            if self.state == 'half_open' and not self.probing:
+                self.probing = True
+                return
+            self.rejected += 1
+        raise CircuitOpen(self.target)
+
+    def record_success(self):
+        with self.lock:
+            self.state = 'closed'
+            self.failures = 0
+            self.probing = False
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            self.probing = False
+            if self.state == 'half_open' or self.failures >= self.failure_threshold:
+                if self.state != 'open':
+                    self.trips += 1
+                    self.logger.warning("circuit breaker for %s opened after %d failures", self.target, self.failures)
+                self.state = 'open'
+                self.opened_at = time.time()
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                "state": self.state,
+                "failures": self.failures,
+                "trips": self.trips,
+                "rejected": self.rejected
+            }
+
+
+class InFlightCall:
+    __slots__ = ('done', 'result', 'error')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """Shares one upstream call among concurrent identical requests.
+
+    The first caller for a key makes the call; callers arriving while it is in
+    flight wait (up to their own deadline) and get the same result or error.
+    """
+
+    def __init__(self):
+        self.calls = {}
+        self.issued = 0
+        self.coalesced = 0
+        self.timeouts = 0
+        self.lock = threading.Lock()
+
+    def do(self, key, fn, timeout):
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.calls[key] = InFlightCall()
+                self.issued += 1
+            else:
+                self.coalesced += 1
+        if leader:
+            try:
+                call.result = fn()
+            except Exception as e:
+                call.error = e
+            finally:
+                with self.lock:
+                    del self.calls[key]
+                call.done.set()
+        elif not call.done.wait(timeout):
+            with self.lock:
+                self.timeouts += 1
+            raise DeadlineExceeded(key[1])
+        if call.error is not None:
+            raise call.error
+        return call.result
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                "issued": self.issued,
+                "coalesced": self.coalesced,
+                "timeouts": self.timeouts,
+                "in_flight": len(self.calls)
+            }
+
+
+class AsyncSingleFlight(SingleFlight):
+    """SingleFlight for coroutines on the ASGI event loop; followers await the leader's future"""
+
+    async def do(self, key, fn, timeout):
+        call = self.calls.get(key)
+        if call is None:
+            call = self.calls[key] = asyncio.get_running_loop().create_future()
+            self.issued += 1
+            try:
+                call.set_result(await fn())
+            except Exception as e:
+                call.set_exception(e)
+            finally:
+                del self.calls[key]
+                if not call.done():
+                    # The leader was cancelled: fail its followers now rather than at their timeouts
+                    call.set_exception(DeadlineExceeded(key[1]))
+                    call.exception()
+        else:
+            self.coalesced += 1
+        try:
+            return await asyncio.wait_for(asyncio.shield(call), timeout)
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+            raise DeadlineExceeded(key[1])
+
+
+def freeze(value):
+    """Hashable form of request params/data for single-flight keys"""
+    if isinstance(value, dict):
+        return tuple(sorted((key, freeze(item)) for key, item in value.items()))
+    if isinstance(value, (list, tuple)):
+        return tuple(freeze(item) for item in value)
+    return value
@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+"""
+Restore a service's databases from an online backup.
+
+Stop the service, then run this in the directory holding its database files
+(outside the image, with the repository root on PYTHONPATH):
+
+    python3 -m common.restore [BACKUP]
+
+BACKUP is a directory name under BACKUP_DIR (default: the newest backup).
+Every database file in the backup (each payments shard is one) replaces the
+file of the same name. Every file is integrity-checked before anything is
+replaced, and each restored file gets a new changelog epoch so /changes
+consumers resynchronize. Start the service with KEEP_DB=1, or it recreates
+the database empty; payments must run with the PAYMENTS_SHARDS the backup was
+taken with (then reshard.py to change the count).
+
+A backup with an archive/ directory (users, reservations) replaces the
+partitions under ARCHIVE_DIR with its own. One without (taken before archives
+were backed up, or of a service without any) leaves ARCHIVE_DIR as it is.
+
+Only the backup layout in common/backup.py is imported, not the service.
+"""
+
+import os
+import shutil
+import sqlite3
+import sys
+
+from common.backup import list_backups
+
+backup_dir = os.environ.get('BACKUP_DIR', 'backups')
+archive_dir = os.environ.get('ARCHIVE_DIR', 'archive')
+
+
+def main():
+    if len(sys.argv) > 2:
+        sys.exit(__doc__)
+    backups = list_backups(backup_dir)
+    name = sys.argv[1] if len(sys.argv) == 2 else (backups[-1] if backups else None)
+    if name is None or name not in backups:
+        sys.exit(f"no backup {name or 'found'} in {backup_dir}")
+    source_dir = os.path.join(backup_dir, name)
+
+    files = sorted(file_name for file_name in os.listdir(source_dir)
+                   if file_name.endswith('.db') and os.path.isfile(os.path.join(source_dir, file_name)))
+    if not files:
+        sys.exit(f"backup {name} has no database files; found {', '.join(sorted(os.listdir(source_dir)))}")
+    archive_source = os.path.join(source_dir, 'archive')
+    archives = sorted(os.listdir(archive_source)) if os.path.isdir(archive_source) else None
+    for file_name in files + [os.path.join('archive', archive) for archive in archives or []]:
+        conn = sqlite3.connect(os.path.join(source_dir, file_name))
+        result = conn.execute("PRAGMA integrity_check").fetchone()[0]
+        conn.close()
+        if result != 'ok':
+            sys.exit(f"backup {name}: {file_name} failed the integrity check: {result}")
+
+    for file_name in files:
+        temp_path = f"{file_name}.restoring"
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        source = sqlite3.connect(os.path.join(source_dir, file_name))
+        dest = sqlite3.connect(temp_path)
+        source.backup(dest)
+        source.close()
+        dest.execute("UPDATE changelog_epoch SET epoch = lower(hex(randomblob(8)))")
+        dest.commit()
+        dest.close()
+        for suffix in ('-journal', '-wal', '-shm'):
+            if os.path.exists(file_name + suffix):
+                os.remove(file_name + suffix)
+        os.replace(temp_path, file_name)
+    if archives is not None:
+        if os.path.isdir(archive_dir):
+            for archive in os.listdir(archive_dir):
+                if archive.endswith('.db'):
+                    os.remove(os.path.join(archive_dir, archive))
+        os.makedirs(archive_dir, exist_ok=True)
+        for archive in archives:
+            shutil.copyfile(os.path.join(archive_source, archive), os.path.join(archive_dir, archive))
+        files += [f"{len(archives)} archive partitions"]
+    print(f"restored {', '.join(files)} from backup {name}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,84 @@
+"""
+Token revocation list kept in sync with the user service's /internal/revocations feed.
+"""
+
+import hashlib
+import threading
+import time
+
+
+class RevocationFilter:
+    """Revoked token IDs and users, checked before trusting a token.
+
+    Entries are "jti:<token id>" (one token) or "user:<user id>" (every token
+    issued to that user before the second of revoked_at). A Bloom filter
+    answers the common "not revoked" case without touching the exact dict
+    behind it.
+    """
+
+    def __init__(self, bits=1 << 16, hashes=4):
+        self.bits = bits
+        self.hashes = hashes
+        self.bloom = bytearray(bits // 8)
+        self.entries = {}
+        self.epoch = None
+        self.version = 0
+        self.refreshed_at = 0.0
+        self.lock = threading.Lock()
+
+    def _positions(self, entry):
+        digest = hashlib.sha256(entry.encode()).digest()
+        for i in range(self.hashes):
+            yield int.from_bytes(digest[i * 4:i * 4 + 4], 'big') % self.bits
+
+    def _add(self, entry, revoked_at, expires_at):
+        self.entries[entry] = (revoked_at, expires_at)
+        for position in self._positions(entry):
+            self.bloom[position >> 3] |= 1 << (position & 7)
+
+    def _contains(self, entry):
+        for position in self._positions(entry):
+            if not self.bloom[position >> 3] & (1 << (position & 7)):
+                return None
+        return self.entries.get(entry)
+
+    def _rebuild(self, now):
+        """Drop expired entries and resize the Bloom filter to fit the rest"""
+        live = [(entry, value) for entry, value in self.entries.items() if value[1] > now]
+        bits = 1 << 16
+        while bits < len(live) * 16:
+            bits <<= 1
+        self.bits = bits
+        self.bloom = bytearray(bits // 8)
+        self.entries = {}
+        for entry, (revoked_at, expires_at) in live:
+            self._add(entry, revoked_at, expires_at)
+
+    def add(self, entry, revoked_at, expires_at):
+        with self.lock:
+            self._add(entry, revoked_at, expires_at)
+            if len(self.entries) * 16 > self.bits:
+                self._rebuild(time.time())
+
+    def apply(self, delta):
+        """Apply a delta from the user service's /internal/revocations feed"""
+        now = time.time()
+        with self.lock:
+            if delta.get('epoch') != self.epoch:
+                self.entries = {}
+                self.bloom = bytearray(self.bits // 8)
+            for item in delta.get('entries', []):
+                self._add(item['entry'], item['revoked_at'], item['expires_at'])
+            self._rebuild(now)
+            self.epoch = delta.get('epoch')
+            self.version = delta.get('version', self.version)
+            self.refreshed_at = now
+
+    def is_revoked(self, claims):
+        with self.lock:
+            if self._contains(f"jti:{claims.get('jti')}") is not None:
+                return True
+            user_revocation = self._contains(f"user:{claims.get('user_id')}")
+            # iat is in whole seconds, so a token from the second of the revocation
+            # counts as newer: a user may log in again right after being revoked
+            return user_revocation is not None and claims.get('iat', 0) < int(user_revocation[0])
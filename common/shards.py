@@ -0,0 +1,26 @@
+"""
+Layout of the payments database across shard files.
+
+Imported by the payments service and by the offline tools that read or write
+its files (reshard.py, the benchmark data generator) without loading the app.
+"""
+
+import hashlib
+import os
+
+db_name = "payments.db"
+sql_file = "payments.sql"
+
+
+def shard_of(username, count):
+    """Stable shard index of username among count shards"""
+    digest = hashlib.sha256(username.encode()).digest()
+    return int.from_bytes(digest[:8], 'big') % count
+
+
+def shard_file(index, count):
+    """Database file of shard index; a single shard keeps the unsharded name"""
+    if count == 1:
+        return db_name
+    base, ext = os.path.splitext(db_name)
+    return f"{base}-{index}-of-{count}{ext}"
@@ -0,0 +1,75 @@
+"""
+HTTP over Unix domain sockets: the requests adapter for http+unix://<target> URLs, and the server side.
+"""
+
+import os
+import socket
+import threading
+
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection
+from urllib3.connectionpool import HTTPConnectionPool
+from werkzeug.serving import make_server
+
+
+class UnixConnection(HTTPConnection):
+    def __init__(self, socket_path, **kwargs):
+        super().__init__('localhost', **kwargs)
+        self.socket_path = socket_path
+
+    def _new_conn(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        if isinstance(self.timeout, (int, float)):
+            sock.settimeout(self.timeout)
+        sock.connect(self.socket_path)
+        return sock
+
+
+class UnixConnectionPool(HTTPConnectionPool):
+    def __init__(self, socket_path, **kwargs):
+        super().__init__('localhost', **kwargs)
+        self.socket_path = socket_path
+
+    def _new_conn(self):
+        return UnixConnection(self.socket_path, timeout=self.timeout.connect_timeout)
+
+
+class UnixAdapter(HTTPAdapter):
+    """Sends http+unix://<target> requests over the target's Unix socket, keeping connections alive.
+
+    socket_path(url) names the socket file behind a URL.
+    """
+
+    def __init__(self, socket_path, **kwargs):
+        super().__init__(**kwargs)
+        self.socket_path = socket_path
+        self.pools = {}
+        self.pools_lock = threading.Lock()
+
+    def get_connection_with_tls_context(self, request, verify, proxies=None, cert=None):
+        return self.get_connection(request.url, proxies)
+
+    def get_connection(self, url, proxies=None):
+        socket_path = self.socket_path(url)
+        with self.pools_lock:
+            if socket_path not in self.pools:
+                self.pools[socket_path] = UnixConnectionPool(socket_path, maxsize=self._pool_maxsize)
+            return self.pools[socket_path]
+
+    def request_url(self, request, proxies):
+        return request.path_url
+
+    def close(self):
+        super().close()
+        with self.pools_lock:
+            for pool in self.pools.values():
+                pool.close()
+            self.pools.clear()
+
+
+def serve_unix_socket(app, path):
+    """Serve app on the Unix socket at path from a background thread"""
+    if os.path.exists(path):
+        os.remove(path)
+    server = make_server(f"unix://{path}", 0, app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
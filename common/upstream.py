@@ -0,0 +1,243 @@
+"""
+Service-to-service calls with request deadlines, circuit breakers and coalescing.
+"""
+
+import asyncio
+import threading
+import time
+from urllib.parse import urlsplit, urlunsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+from flask import request, jsonify, g, has_request_context
+
+from common.wire import MSGPACK_MIMETYPE, msgpack
+from common.resilience import DeadlineExceeded, CircuitOpen, CircuitBreaker, SingleFlight, AsyncSingleFlight, freeze
+from common.transport import UnixAdapter
+from common.aio import on_event_loop, blocking
+
+try:
+    import httpx
+except ImportError:  # only needed for SERVER_MODE=asgi
+    httpx = None
+
+
+class Upstream:
+    """One service's calls to the others.
+
+    service_urls maps each target to its base URL ("unix:///path/to.sock" for a
+    Unix socket). Every request gets a deadline from X-Request-Timeout, capped
+    by request_budget, and every upstream call is cut to what is left of it
+    (and to timeout) and goes through the target's circuit breaker. Bodies are
+    sent in wire_format; with relay_accept a caller's own Accept header is kept.
+    With async_views, async views await request_async; on the ASGI event loop
+    it goes through httpx clients opened by open_async_clients.
+    """
+
+    def __init__(self, service_urls, request_budget, timeout, failure_threshold, reset_timeout, wire_format,
+                 pool_size, logger, relay_accept=False, async_views=False):
+        self.service_urls = service_urls
+        self.request_budget = request_budget
+        self.timeout = timeout
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.wire_format = wire_format
+        self.logger = logger
+        self.relay_accept = relay_accept
+        self.single_flight = SingleFlight()
+        self.async_single_flight = AsyncSingleFlight() if async_views else None
+        self.breakers = {}
+        self.breakers_lock = threading.Lock()
+        # Every upstream call goes through one session, so connections are kept alive
+        self.session = requests.Session()
+        self.session.mount('http://', HTTPAdapter(pool_maxsize=pool_size))
+        self.session.mount('http+unix://', UnixAdapter(self.unix_socket_path, pool_maxsize=pool_size))
+        # Set while serving ASGI: the event loop and its shared non-blocking clients
+        self.async_loop = None
+        self.async_client = None
+        self.async_unix_clients = {}
+        self.async_max_connections = None
+
+    def get_breaker(self, target):
+        with self.breakers_lock:
+            if target not in self.breakers:
+                self.breakers[target] = CircuitBreaker(target, self.failure_threshold, self.reset_timeout,
+                                                       self.logger)
+            return self.breakers[target]
+
+    def set_deadline(self):
+        """Start the request's deadline from X-Request-Timeout (seconds left), capped by request_budget"""
+        budget = self.request_budget
+        try:
+            budget = min(budget, float(request.headers.get('X-Request-Timeout', budget)))
+        except ValueError:
+            pass
+        g.deadline = time.time() + budget
+
+    def request_deadline(self):
+        """Absolute deadline for upstream calls made by the current request"""
+        if has_request_context() and 'deadline' in g:
+            return g.deadline
+        return time.time() + self.timeout
+
+    def service_url(self, target, path):
+        """URL of path on an upstream service; http+unix://<target>/... if it is reached over a Unix socket"""
+        if self.service_urls[target].startswith('unix://'):
+            return f"http+unix://{target}{path}"
+        return self.service_urls[target].rstrip('/') + path
+
+    def unix_socket_path(self, url):
+        """Socket file behind an http+unix://<target> URL"""
+        return self.service_urls[urlsplit(url).hostname][len('unix://'):]
+
+    def request(self, method, target, url, coalesce=False, **kwargs):
+        """Call another service with the remaining deadline, through the target's breaker.
+
+        Raises DeadlineExceeded or CircuitOpen instead of calling when the request
+        is out of time or the target is failing, and passes the remaining budget on
+        in X-Request-Timeout so the next hop stops when we do. With coalesce=True,
+        concurrent identical read-only calls share a single upstream request.
+        """
+        remaining = self.request_deadline() - time.time()
+        if remaining <= 0:
+            raise DeadlineExceeded(target)
+        if coalesce:
+            key = (method, url, freeze(kwargs))
+            return self.single_flight.do(key, lambda: self.send(method, target, url, remaining, **kwargs), remaining)
+        return self.send(method, target, url, remaining, **kwargs)
+
+    def send(self, method, target, url, remaining, **kwargs):
+        breaker = self.get_breaker(target)
+        try:
+            breaker.before_call()
+        except CircuitOpen:
+            if has_request_context():
+                g.circuit_open = target
+            raise
+        headers = self.headers(remaining, kwargs)
+        timeout = min(remaining, self.timeout)
+        stream = kwargs.get('stream', False)
+        try:
+            # A streamed response (an event stream) may stay open as long as the service keeps it open
+            resp = self.session.request(method, url, headers=headers, timeout=(timeout, None) if stream else timeout,
+                                        **kwargs)
+        except requests.RequestException:
+            breaker.record_failure()
+            raise
+        if resp.status_code >= 500:
+            breaker.record_failure()
+        else:
+            breaker.record_success()
+        if not stream:
+            # Read the body now so callers sharing this response never race on the stream
+            resp.content
+        return resp
+
+    def headers(self, remaining, kwargs):
+        """Headers for an upstream call; moves the caller's headers out of kwargs and encodes its body"""
+        headers = dict(kwargs.pop('headers', None) or {})
+        headers['X-Request-Timeout'] = f"{remaining:.3f}"
+        if self.wire_format == 'msgpack' and msgpack:
+            # Send and ask for compact binary bodies (unless relaying a client's own Accept)
+            if self.relay_accept:
+                headers.setdefault('Accept', MSGPACK_MIMETYPE)
+            else:
+                headers['Accept'] = MSGPACK_MIMETYPE
+            for field in ('json', 'data'):
+                if isinstance(kwargs.get(field), dict):
+                    kwargs['data'] = msgpack.packb(kwargs.pop(field))
+                    headers['Content-Type'] = MSGPACK_MIMETYPE
+                    break
+        return headers
+
+    def open_async_clients(self, max_connections):
+        """Open the shared async clients for the running event loop"""
+        self.async_loop = asyncio.get_running_loop()
+        self.async_max_connections = max_connections
+        self.async_client = httpx.AsyncClient(limits=httpx.Limits(max_connections=max_connections))
+
+    async def close_async_clients(self):
+        await self.async_client.aclose()
+        self.async_client = None
+        for client in self.async_unix_clients.values():
+            await client.aclose()
+        self.async_unix_clients.clear()
+
+    def unix_async_client(self, target):
+        """Shared async client for a target reached over its Unix socket"""
+        if target not in self.async_unix_clients:
+            transport = httpx.AsyncHTTPTransport(uds=self.service_urls[target][len('unix://'):])
+            self.async_unix_clients[target] = httpx.AsyncClient(
+                transport=transport, limits=httpx.Limits(max_connections=self.async_max_connections))
+        return self.async_unix_clients[target]
+
+    async def request_async(self, method, target, url, coalesce=False, **kwargs):
+        """request for async views.
+
+        On the ASGI event loop the call awaits the shared non-blocking client, so a
+        request waiting on an upstream holds no thread. Under the threaded server
+        request runs on the request's own thread.
+        """
+        if self.async_client is None or not on_event_loop() or asyncio.get_running_loop() is not self.async_loop:
+            return await blocking(self.request, method, target, url, coalesce, **kwargs)
+        remaining = self.request_deadline() - time.time()
+        if remaining <= 0:
+            raise DeadlineExceeded(target)
+        if coalesce:
+            key = (method, url, freeze(kwargs))
+            return await self.async_single_flight.do(
+                key, lambda: self.send_async(method, target, url, remaining, **kwargs), remaining)
+        return await self.send_async(method, target, url, remaining, **kwargs)
+
+    async def send_async(self, method, target, url, remaining, **kwargs):
+        breaker = self.get_breaker(target)
+        try:
+            breaker.before_call()
+        except CircuitOpen:
+            g.circuit_open = target
+            raise
+        headers = self.headers(remaining, kwargs)
+        if isinstance(kwargs.get('data'), bytes):
+            kwargs['content'] = kwargs.pop('data')
+        client = self.async_client
+        if url.startswith('http+unix://'):
+            parts = urlsplit(url)
+            client = self.unix_async_client(parts.hostname)
+            url = urlunsplit(('http', parts.netloc, parts.path, parts.query, ''))
+        try:
+            resp = await client.request(method, url, headers=headers, timeout=min(remaining, self.timeout), **kwargs)
+        except httpx.HTTPError:
+            breaker.record_failure()
+            raise
+        if resp.status_code >= 500:
+            breaker.record_failure()
+        else:
+            breaker.record_success()
+        return resp
+
+    def report_open_circuit(self, response):
+        """Tell the caller which upstream we refused to call"""
+        target = g.get('circuit_open')
+        if target:
+            response.headers['X-Circuit-Open'] = target
+        return response
+
+    def circuit_breakers(self):
+        """Internal endpoint reporting the state of each upstream circuit breaker"""
+        with self.breakers_lock:
+            targets = list(self.breakers.items())
+        return jsonify({"status": 1, "breakers": {target: breaker.snapshot() for target, breaker in targets}})
+
+    def single_flight_stats(self):
+        """Internal endpoint reporting issued vs coalesced upstream lookups"""
+        if self.async_single_flight is not None:
+            return jsonify({"status": 1, **self.single_flight.snapshot(), "async": self.async_single_flight.snapshot()})
+        return jsonify({"status": 1, **self.single_flight.snapshot()})
+
+    def install(self, app):
+        """Give app's requests deadlines, report open circuits and serve the breaker and single-flight stats"""
+        app.before_request(self.set_deadline)
+        app.after_request(self.report_open_circuit)
+        app.add_url_rule('/internal/circuit_breakers', 'circuit_breakers', self.circuit_breakers, methods=['GET'])
+        app.add_url_rule('/internal/singleflight', 'single_flight_stats', self.single_flight_stats,
+                         methods=['GET'])
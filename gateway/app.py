@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+"""
+Flask app for Project 3 - Edge Gateway
+"""
+
+import os
+import sys
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+import requests
+from flask import Flask, Response, request, jsonify, stream_with_context
+
+from common.wire import msgpack, response_body
+from common.resilience import DeadlineExceeded, CircuitOpen
+from common.upstream import Upstream
+from common.auth import TokenVerifier, sign_identity
+
+app = Flask(__name__)
+
+# TCP port to serve on
+port = int(os.environ.get('PORT', '5000'))
+
+# End-to-end budget for a request without an X-Request-Timeout header, the cap on a
+# single upstream call, and when a target's circuit breaker opens and re-probes
+request_budget = float(os.environ.get('REQUEST_BUDGET', '10'))
+upstream_timeout = float(os.environ.get('UPSTREAM_TIMEOUT', '2'))
+breaker_failure_threshold = int(os.environ.get('BREAKER_FAILURE_THRESHOLD', '5'))
+breaker_reset_timeout = float(os.environ.get('BREAKER_RESET_TIMEOUT', '10'))
+
+# Encoding of the gateway's own service calls: "msgpack" (when installed) or "json".
+# Proxied requests keep the client's encoding
+wire_format = os.environ.get('WIRE_FORMAT', 'msgpack')
+
+# Base URL of each upstream service; "unix:///path/to.sock" reaches it over a Unix socket
+service_urls = {
+    'user': os.environ.get('USER_URL', 'http://user:5000'),
+    'availability': os.environ.get('AVAILABILITY_URL', 'http://availability:5000'),
+    'reservations': os.environ.get('RESERVATIONS_URL', 'http://reservations:5000'),
+    'payments': os.environ.get('PAYMENTS_URL', 'http://payments:5000')
+}
+
+# Kept-alive connections per upstream service, and threads for fanned-out calls
+upstream_pool_size = int(os.environ.get('UPSTREAM_POOL_SIZE', '64'))
+fanout_threads = int(os.environ.get('FANOUT_THREADS', '64'))
+
+# Secret shared with the services for signing X-Identity headers. The gateway
+# refuses to start without one; behind it the services trust the signed identity
+identity_secret = os.environ.get('IDENTITY_SECRET', '')
+
+# Revocation feed polling and how stale it may get before cached identities are distrusted
+revocation_poll_interval = float(os.environ.get('REVOCATION_POLL_INTERVAL', '5'))
+revocation_max_staleness = float(os.environ.get('REVOCATION_MAX_STALENESS', '30'))
+verify_cache_size = int(os.environ.get('VERIFY_CACHE_SIZE', '10000'))
+
+# Per-connection headers, never forwarded in either direction. Bodies are relayed
+# decoded, so their encoding and length are recomputed too
+hop_by_hop_headers = {'connection', 'keep-alive', 'proxy-authenticate', 'proxy-authorization', 'te', 'trailer',
+                      'transfer-encoding', 'upgrade', 'host', 'content-length', 'content-encoding',
+                      'accept-encoding'}
+
+
+upstream = Upstream(service_urls, request_budget, upstream_timeout, breaker_failure_threshold, breaker_reset_timeout,
+                    wire_format, upstream_pool_size, app.logger, relay_accept=True)
+upstream.install(app)
+
+verifier = TokenVerifier(upstream, revocation_poll_interval, revocation_max_staleness, verify_cache_size,
+                         propagate_unavailable=True)
+
+
+def identity_header(token, auth=None):
+    """X-Identity for a forwarded call: the client's address, plus the identity token verified as.
+
+    Every request reaches the services from the gateway, so they rate limit
+    unauthenticated callers by the address signed here.
+    """
+    return sign_identity(identity_secret, token or '', {**(auth or {}), "client": request.remote_addr})
+
+def forward_headers(token, verify=True):
+    """The client's headers for a proxied call, plus X-Identity (with the verified identity if verify)"""
+    headers = {name: value for name, value in request.headers.items()
+               if name.lower() not in hop_by_hop_headers and name.lower() not in ('x-identity', 'x-request-timeout')}
+    # Without an Accept the service would answer in the gateway's wire format
+    headers.setdefault('Accept', '*/*')
+    if identity_secret:
+        auth = verifier.verify(token) if token and verify else None
+        headers['X-Identity'] = identity_header(token, auth if auth and auth.get('valid') == 1 else None)
+    return headers
+
+def relay(resp):
+    """Pass a streamed upstream body through as it arrives"""
+    try:
+        for chunk in resp.iter_content(chunk_size=None):
+            yield chunk
+    finally:
+        resp.close()
+
+@app.route('/<service>/<path:path>', methods=['GET', 'POST'])
+def proxy(service, path):
+    """Forward /<service>/<path> to that service, verifying the caller's token once on the way"""
+    if service not in service_urls:
+        return jsonify({"status": 2}), 404
+    
+    # The user service checks tokens locally, so only the others get a verified identity
+    token = request.headers.get('Authorization') or request.args.get('token')
+    
+    # Event streams are relayed chunk by chunk instead of buffered
+    stream = 'text/event-stream' in request.headers.get('Accept', '')
+    try:
+        headers = forward_headers(token, verify=service != 'user')
+        resp = upstream.request(request.method, service, upstream.service_url(service, f"/{path}"),
+                                params=request.args.to_dict(flat=False), data=request.get_data(),
+                                headers=headers, stream=stream)
+    except CircuitOpen:
+        return jsonify({"status": 2}), 503
+    except DeadlineExceeded:
+        return jsonify({"status": 2}), 504
+    except requests.RequestException:
+        return jsonify({"status": 2}), 502
+    
+    response_headers = [(name, value) for name, value in resp.headers.items()
+                        if name.lower() not in hop_by_hop_headers]
+    if stream:
+        return Response(stream_with_context(relay(resp)), status=resp.status_code, headers=response_headers)
+    return Response(resp.content, status=resp.status_code, headers=response_headers)
+
+fanout_pool = ThreadPoolExecutor(max_workers=fanout_threads)
+
+def fan_out(*calls):
+    """Run calls concurrently, each in a copy of the request's context so deadlines carry over"""
+    futures = [fanout_pool.submit(contextvars.copy_context().run, call) for call in calls]
+    return [future.result() for future in futures]
+
+def fetch(method, target, path, **kwargs):
+    """Decoded body of an upstream call, or None if it failed"""
+    try:
+        return response_body(upstream.request(method, target, upstream.service_url(target, path), **kwargs))
+    except Exception:
+        return None
+
+@app.route('/search_with_balance', methods=['GET'])
+def search_with_balance():
+    """Availability search for a day plus the caller's balance, fetched in parallel"""
+    token = request.headers.get('Authorization')
+    if not token:
+        return jsonify({"status": 2, "data": [], "balance": "NULL"})
+    
+    # Verify once here; both services trust the signed identity
+    try:
+        auth = verifier.verify(token)
+    except CircuitOpen:
+        return jsonify({"status": 2, "data": [], "balance": "NULL"}), 503
+    except DeadlineExceeded:
+        return jsonify({"status": 2, "data": [], "balance": "NULL"}), 504
+    if auth.get('valid') != 1:
+        return jsonify({"status": 2, "data": [], "balance": "NULL"})
+    headers = {'Authorization': token}
+    if identity_secret:
+        headers['X-Identity'] = identity_header(token, auth)
+    
+    search, balance = fan_out(
+        partial(fetch, 'GET', 'availability', '/search', params=request.args.to_dict(flat=False), headers=headers),
+        partial(fetch, 'GET', 'payments', '/view', headers=headers))
+    search = search or {"status": 2, "data": []}
+    balance = balance or {"status": 2, "balance": "NULL"}
+    
+    return jsonify({
+        "status": 1 if search.get('status') == 1 and balance.get('status') == 1 else 2,
+        "data": search.get('data', []),
+        "balance": balance.get('balance', "NULL")
+    })
+
+
+if __name__ == '__main__':
+    if not identity_secret:
+        sys.exit("IDENTITY_SECRET must be set: it signs the X-Identity headers the services trust")
+    app.run(host='0.0.0.0', port=port, debug=False)
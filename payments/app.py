@@ -5,66 +5,304 @@ Flask app for Project 3 - Payments Microservice
 
 import sqlite3
 import os
+import time
 import json
-import requests
 from flask import Flask, request, jsonify
 
+import common.db
+from common.wire import msgpack, WireJSONProvider, get_post_param, request_body_hash
+from common.ratelimit import RateLimiter, Admission
+from common.upstream import Upstream
+from common.transport import serve_unix_socket
+from common.auth import TokenVerifier
+from common.shards import sql_file, shard_of, shard_file
+from common.db import QueryStats, ChangeNotifier, ChangesFeed
+from common.backup import Backups
+from common.profiling import Profiling
+from common.metrics import Metrics
+from common.memory import MemoryDiagnostics
+
 app = Flask(__name__)
-db_name = "payments.db"
-sql_file = "payments.sql"
 db_flag = False
 
+# "file" keeps the database in db_name; "memory" uses a shared-cache in-memory
+# database (for tests) that /clear resets from a pristine snapshot
+db_mode = os.environ.get('DB_MODE', 'file')
+memory_anchors = []
+memory_pristines = []
+
+# With KEEP_DB=1 a service starts on the database files already there (restored or
+# bulk-loaded) instead of recreating them; /clear still resets. File mode only
+keep_db = os.environ.get('KEEP_DB', '0') == '1'
+
+# Balances are split across shard_count SQLite files by a stable hash of the
+# username; change it offline with reshard.py
+shard_count = int(os.environ.get('PAYMENTS_SHARDS', '1'))
+
+# Statements slower than this are logged with their query plan
+slow_query_ms = float(os.environ.get('SLOW_QUERY_MS', '50'))
+
+# /changes long-polls wait at most CHANGES_MAX_WAIT seconds, re-reading the changelog every
+# CHANGES_POLL_INTERVAL for commits by other processes, and return up to CHANGES_BATCH_SIZE
+changes_max_wait = float(os.environ.get('CHANGES_MAX_WAIT', '25'))
+changes_poll_interval = float(os.environ.get('CHANGES_POLL_INTERVAL', '1'))
+changes_batch_size = int(os.environ.get('CHANGES_BATCH_SIZE', '1000'))
+# At most CHANGES_MAX_WAITERS /changes requests wait at once, each holding a thread; past
+# that a request that would wait gets 503 (wait=0 reads are never turned away)
+changes_max_waiters = int(os.environ.get('CHANGES_MAX_WAITERS', '32'))
+
+# Online backups: every BACKUP_INTERVAL seconds (0 turns the schedule off) the database is
+# copied into BACKUP_DIR/<UTC time>/, BACKUP_PAGES pages per step with BACKUP_SLEEP seconds
+# between steps. After BACKUP_MAX_RESTARTS restarts caused by concurrent writes, the rest
+# is copied in one step. The newest BACKUP_KEEP backups are kept
+backup_interval = float(os.environ.get('BACKUP_INTERVAL', '3600'))
+backup_dir = os.environ.get('BACKUP_DIR', 'backups')
+backup_pages = int(os.environ.get('BACKUP_PAGES', '64'))
+backup_sleep = float(os.environ.get('BACKUP_SLEEP', '0.005'))
+backup_max_restarts = int(os.environ.get('BACKUP_MAX_RESTARTS', '3'))
+backup_keep = int(os.environ.get('BACKUP_KEEP', '24'))
+
+# Memory diagnostics (opt-in): MEMORY_DIAGNOSTICS=1 starts tracemalloc with MEMORY_TRACE_FRAMES
+# frames per allocation, enables /internal/memory/snapshots and adds cache sizes in bytes to
+# /metrics. The newest MEMORY_SNAPSHOTS snapshots are kept for diffing
+memory_diagnostics = os.environ.get('MEMORY_DIAGNOSTICS', '0') == '1'
+memory_trace_frames = int(os.environ.get('MEMORY_TRACE_FRAMES', '1'))
+memory_snapshots_kept = int(os.environ.get('MEMORY_SNAPSHOTS', '8'))
+
+# Upper bounds (seconds) of the request latency histogram served at /metrics
+latency_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# End-to-end budget for a request without an X-Request-Timeout header, the cap on a
+# single upstream call, and when a target's circuit breaker opens and re-probes
+request_budget = float(os.environ.get('REQUEST_BUDGET', '10'))
+upstream_timeout = float(os.environ.get('UPSTREAM_TIMEOUT', '2'))
+breaker_failure_threshold = int(os.environ.get('BREAKER_FAILURE_THRESHOLD', '5'))
+breaker_reset_timeout = float(os.environ.get('BREAKER_RESET_TIMEOUT', '10'))
+
+# Encoding of service-to-service bodies: "msgpack" (when installed) or "json"
+wire_format = os.environ.get('WIRE_FORMAT', 'msgpack')
+
+# Base URL of each upstream service; "unix:///path/to.sock" reaches it over a Unix socket
+service_urls = {
+    'user': os.environ.get('USER_URL', 'http://user:5000')
+}
+
+# TCP port to serve on, and also this Unix socket path for co-located services
+port = int(os.environ.get('PORT', '5000'))
+unix_socket = os.environ.get('UNIX_SOCKET', '')
+
+# Token-bucket limits per (client, endpoint) and the cap on concurrent public requests
+rate_limit_rate = float(os.environ.get('RATE_LIMIT_RATE', '20'))
+rate_limit_burst = float(os.environ.get('RATE_LIMIT_BURST', '40'))
+rate_limit_max_clients = int(os.environ.get('RATE_LIMIT_MAX_CLIENTS', '100000'))
+public_concurrency = int(os.environ.get('PUBLIC_CONCURRENCY', '64'))
+
+# Opt-in profiling: requests signed with PROFILE_SECRET (X-Profile header) or a random
+# PROFILE_SAMPLE_RATE fraction are run under cProfile and saved to PROFILE_DIR
+profile_enabled = os.environ.get('PROFILE_ENABLED', '0') == '1'
+profile_secret = os.environ.get('PROFILE_SECRET', '')
+profile_sample_rate = float(os.environ.get('PROFILE_SAMPLE_RATE', '0'))
+profile_dir = os.environ.get('PROFILE_DIR', 'profiles')
+profile_max_files = int(os.environ.get('PROFILE_MAX_FILES', '200'))
+
+# Endpoints served on the internal lane, exempt from admission control
+internal_endpoints = {'initialize', 'check_balance', 'transfer', 'transfer_batch', 'transfer_outcome', 'circuit_breakers',
+                      'single_flight_stats', 'profile_summary', 'query_stats_report', 'changes_feed',
+                      'backups_report', 'take_backup', 'metrics', 'memory_report', 'take_memory_snapshot',
+                      'memory_diff', 'clear_db'}
+
+# Revocation feed polling and how stale it may get before cached identities are distrusted
+revocation_poll_interval = float(os.environ.get('REVOCATION_POLL_INTERVAL', '5'))
+revocation_max_staleness = float(os.environ.get('REVOCATION_MAX_STALENESS', '30'))
+verify_cache_size = int(os.environ.get('VERIFY_CACHE_SIZE', '10000'))
+
+# Shared secret for X-Identity headers signed by the gateway (empty ignores them),
+# and how long after signing such a header is accepted
+identity_secret = os.environ.get('IDENTITY_SECRET', '')
+identity_ttl = float(os.environ.get('IDENTITY_TTL', '30'))
+
+# How long a recorded Idempotency-Key response is replayed
+idempotency_ttl = float(os.environ.get('IDEMPOTENCY_TTL', '86400'))
+idempotency_purged_at = 0.0
+
+
+upstream = Upstream(service_urls, request_budget, upstream_timeout, breaker_failure_threshold, breaker_reset_timeout,
+                    wire_format, public_concurrency, app.logger)
+upstream.install(app)
+
+verifier = TokenVerifier(upstream, revocation_poll_interval, revocation_max_staleness, verify_cache_size,
+                         identity_secret, identity_ttl)
+
+
+rate_limiter = RateLimiter(rate_limit_rate, rate_limit_burst, rate_limit_max_clients)
+admission = Admission(rate_limiter, public_concurrency, internal_endpoints, verifier.client_key)
+admission.install(app)
+
+
+profiling = Profiling(profile_enabled, profile_secret, profile_sample_rate, profile_dir, profile_max_files)
+profiling.install(app)
+
+
+query_stats = QueryStats(slow_query_ms, app.logger)
+change_notifier = ChangeNotifier()
+TimedConnection = common.db.timed_connection(query_stats, change_notifier)
+query_stats.install(app)
+
+
+def shard_target(index):
+    """What to open or ATTACH for shard index"""
+    if db_mode == 'memory':
+        return f"file:{shard_file(index, shard_count)}?mode=memory&cache=shared"
+    return shard_file(index, shard_count)
+
+def backup_sources():
+    """(file name, connect function) for each database file a backup covers"""
+    return [(shard_file(shard, shard_count), lambda shard=shard: connect_db(shard)) for shard in range(shard_count)]
+
+def prepare_backup():
+    if not db_flag:
+        create_db()
+
+metrics = Metrics()
+backups = Backups(backup_dir, backup_pages, backup_sleep, backup_max_restarts, backup_keep, backup_interval,
+                  latency_buckets, app.logger, backup_sources, prepare=prepare_backup)
+backups.install(app, metrics)
+metrics.install(app)
+
+# Caches and in-memory indexes whose size /metrics and /internal/memory report;
+# name -> function returning (object, number of entries)
+memory_caches = {
+    'verified_tokens': lambda: (verifier.verified_tokens, len(verifier.verified_tokens)),
+    'revocations': lambda: (verifier.revocations, len(verifier.revocations.entries)),
+    'rate_limit_buckets': lambda: (rate_limiter.buckets, len(rate_limiter.buckets)),
+    'query_stats': lambda: (query_stats.stats, len(query_stats.stats))
+}
+
+memory = MemoryDiagnostics(memory_caches, memory_diagnostics, memory_trace_frames, memory_snapshots_kept)
+memory.install(app, metrics)
+
+def connect_db(shard=0):
+    """Open a connection to one shard of the service database"""
+    if db_mode == 'memory':
+        return sqlite3.connect(shard_target(shard), uri=True, check_same_thread=False, factory=TimedConnection)
+    return sqlite3.connect(shard_target(shard), factory=TimedConnection)
+
 def create_db():
-    """Create database from SQL file"""
-    conn = sqlite3.connect(db_name)
-    
-    with open(sql_file, 'r') as sql_startup:
-        init_db = sql_startup.read()
-    cursor = conn.cursor()
-    cursor.executescript(init_db)
-    conn.commit()
-    conn.close()
+    """Create every shard from SQL file"""
+    if db_mode == 'memory' and memory_anchors:
+        # Reset from the pristine snapshots instead of re-running the script
+        for anchor, pristine in zip(memory_anchors, memory_pristines):
+            pristine.backup(anchor)
+            # A restored snapshot restarts the changelog, so it gets a new epoch
+            anchor.execute("UPDATE changelog_epoch SET epoch = lower(hex(randomblob(8)))")
+            anchor.commit()
+    else:
+        with open(sql_file, 'r') as sql_startup:
+            init_db = sql_startup.read()
+        for shard in range(shard_count):
+            conn = connect_db(shard)
+            if not (keep_db and db_mode == 'file' and
+                    conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'changelog_epoch'").fetchone()):
+                cursor = conn.cursor()
+                cursor.executescript(init_db)
+                conn.commit()
+            if db_mode == 'memory':
+                # The in-memory database lives as long as this connection stays open
+                memory_anchors.append(conn)
+                pristine = sqlite3.connect(':memory:', check_same_thread=False)
+                conn.backup(pristine)
+                memory_pristines.append(pristine)
+            else:
+                conn.close()
     global db_flag
     db_flag = True
 
-def get_db():
-    """Get database connection, creating if necessary"""
+def get_db(shard=0):
+    """Get a connection to one shard, creating the database if necessary"""
     if not db_flag:
         create_db()
-    conn = sqlite3.connect(db_name)
+    conn = connect_db(shard)
     return conn
 
-def verify_token(token):
-    """Verify JWT token by calling user service"""
-    try:
-        resp = requests.get('http://user:5000/internal/verify_jwt', params={'token': token}, timeout=2)
-        return resp.json()
-    except:
-        return {"valid": 0}
-
-def get_post_param(param_name):
-    """Robustly extract a POST parameter from form, JSON, or raw body."""
-    # 1) Standard form field
-    value = request.form.get(param_name)
-    if value is not None and value != "":
-        return value
-    # 2) JSON body
-    try:
-        json_body = request.get_json(silent=True)
-        if isinstance(json_body, dict) and param_name in json_body and json_body[param_name] != "":
-            return json_body[param_name]
-    except:
-        pass
-    # 3) URL-encoded raw body fallback
+changes_feed = ChangesFeed(change_notifier, get_db, changes_max_wait, changes_poll_interval, changes_batch_size,
+                           changes_max_waiters, shard_count=shard_count)
+changes_feed.install(app)
+
+def get_user_db(username):
+    """Get a connection to the shard holding username's balance"""
+    return get_db(shard_of(username, shard_count))
+
+def get_users_db(usernames):
+    """One connection spanning the shards of usernames, and each user's schema name.
+
+    The lowest shard is opened as main and the others are attached in
+    ascending order, so every writer takes shard locks in the same order and
+    concurrent cross-shard transactions cannot deadlock. SQLite commits a
+    transaction over attached database files atomically.
+    """
+    user_shards = {username: shard_of(username, shard_count) for username in usernames}
+    shards = sorted(set(user_shards.values()))
+    conn = get_db(shards[0])
+    schemas = {shards[0]: 'main'}
     try:
-        from urllib.parse import parse_qs
-        raw = request.get_data(as_text=True) or ""
-        parsed = parse_qs(raw, keep_blank_values=True)
-        if param_name in parsed and len(parsed[param_name]) > 0:
-            return parsed[param_name][0]
+        for shard in shards[1:]:
+            schemas[shard] = f"shard{shard}"
+            conn.execute(f"ATTACH DATABASE ? AS {schemas[shard]}", (shard_target(shard),))
     except:
-        pass
-    return None
+        conn.close()
+        raise
+    return conn, {username: schemas[shard] for username, shard in user_shards.items()}
+
+
+def get_idempotency_key(scope):
+    """Scope the request's Idempotency-Key to the endpoint and caller"""
+    key = request.headers.get('Idempotency-Key')
+    if not key:
+        return None
+    return f"{request.path}:{scope}:{key}"
+
+def lookup_idempotent(cursor, key):
+    """(response, body hash) recorded for key within the TTL, or None.
+
+    Must run inside the same write transaction as the operation it guards so a
+    concurrent duplicate waits for the first request to commit.
+    """
+    global idempotency_purged_at
+    now = time.time()
+    if now - idempotency_purged_at > 60:
+        cursor.execute("DELETE FROM idempotency_keys WHERE created_at < ?", (now - idempotency_ttl,))
+        idempotency_purged_at = now
+    cursor.execute("""
+        SELECT response, body_hash FROM idempotency_keys
+        WHERE idempotency_key = ? AND created_at >= ?
+    """, (key, now - idempotency_ttl))
+    row = cursor.fetchone()
+    return (json.loads(row[0]), row[1]) if row else None
+
+def replay_idempotent(cursor, key):
+    """Answer for a request whose key was already used, or None to apply it.
+
+    The recorded response if the request carries the same parameters; a key
+    reused for a different request gets 422 rather than that request's response.
+    """
+    stored = lookup_idempotent(cursor, key)
+    if stored is None:
+        return None
+    response, body_hash = stored
+    if body_hash is not None and body_hash != request_body_hash():
+        return jsonify({"status": 2, "error": "idempotency_key_reused"}), 422
+    return jsonify(response)
+
+def record_idempotent(cursor, key, payload, body_hash=None):
+    """Record the response for key, and the request's body hash, in the current transaction"""
+    cursor.execute("""
+        INSERT OR REPLACE INTO idempotency_keys (idempotency_key, response, body_hash, created_at)
+        VALUES (?, ?, ?, ?)
+    """, (key, json.dumps(payload), body_hash, time.time()))
+
+
+app.json = WireJSONProvider(app)
+
 
 @app.route('/clear', methods=['GET'])
 def clear_db():
@@ -74,15 +312,10 @@ def clear_db():
         global db_flag
         db_flag = False
         
-        try:
-            if os.path.exists(db_name):
-                temp_conn = sqlite3.connect(db_name)
-                temp_conn.close()
-        except:
-            pass
-        
-        if os.path.exists(db_name):
-            os.remove(db_name)
+        if db_mode == 'file':
+            for shard in range(shard_count):
+                if os.path.exists(shard_file(shard, shard_count)):
+                    os.remove(shard_file(shard, shard_count))
         
         create_db()
         return jsonify({"status": 1})
@@ -93,8 +326,10 @@ def clear_db():
             except:
                 pass
         try:
-            if os.path.exists(db_name):
-                os.remove(db_name)
+            if db_mode == 'file':
+                for shard in range(shard_count):
+                    if os.path.exists(shard_file(shard, shard_count)):
+                        os.remove(shard_file(shard, shard_count))
             db_flag = False
             create_db()
         except:
@@ -119,7 +354,7 @@ def initialize():
         except:
             return jsonify({"status": 2})
         
-        conn = get_db()
+        conn = get_user_db(username)
         cursor = conn.cursor()
         
         # Insert or update balance
@@ -149,7 +384,7 @@ def add_money():
             return jsonify({"status": 2})
         
         # Verify JWT by calling user service
-        auth = verify_token(token)
+        auth = verifier.verify(token)
         if auth.get('valid') != 1:
             return jsonify({"status": 2})
         
@@ -167,8 +402,18 @@ def add_money():
         except:
             return jsonify({"status": 2})
         
-        conn = get_db()
+        conn = get_user_db(username)
         cursor = conn.cursor()
+        cursor.execute("BEGIN IMMEDIATE")
+        
+        # Replay a request we have already applied
+        idempotency_key = get_idempotency_key(username)
+        if idempotency_key:
+            replay = replay_idempotent(cursor, idempotency_key)
+            if replay is not None:
+                conn.commit()
+                conn.close()
+                return replay
         
         # Get current balance
         cursor.execute("SELECT balance FROM balances WHERE username = ?", (username,))
@@ -181,6 +426,9 @@ def add_money():
             # Initialize balance if doesn't exist
             cursor.execute("INSERT INTO balances (username, balance) VALUES (?, ?)", (username, amount_float))
         
+        if idempotency_key:
+            record_idempotent(cursor, idempotency_key, {"status": 1}, request_body_hash())
+        
         conn.commit()
         conn.close()
         
@@ -202,13 +450,13 @@ def view_balance():
             return jsonify({"status": 2, "balance": "NULL"})
         
         # Verify JWT by calling user service
-        auth = verify_token(token)
+        auth = verifier.verify(token)
         if auth.get('valid') != 1:
             return jsonify({"status": 2, "balance": "NULL"})
         
         username = auth.get('username')
         
-        conn = get_db()
+        conn = get_user_db(username)
         cursor = conn.cursor()
         
         # Get balance
@@ -250,7 +498,7 @@ def check_balance():
         except:
             return jsonify({"status": 2, "has_enough": False})
         
-        conn = get_db()
+        conn = get_user_db(username)
         cursor = conn.cursor()
         
         # Get balance
@@ -295,11 +543,22 @@ def transfer():
         except:
             return jsonify({"status": 2})
         
-        conn = get_db()
+        # Sender and receiver may live on different shards
+        conn, schemas = get_users_db([from_username, to_username])
         cursor = conn.cursor()
+        cursor.execute("BEGIN IMMEDIATE")
+        
+        # Replay a transfer we have already applied
+        idempotency_key = get_idempotency_key('')
+        if idempotency_key:
+            replay = replay_idempotent(cursor, idempotency_key)
+            if replay is not None:
+                conn.commit()
+                conn.close()
+                return replay
         
         # Get from user balance
-        cursor.execute("SELECT balance FROM balances WHERE username = ?", (from_username,))
+        cursor.execute(f"SELECT balance FROM {schemas[from_username]}.balances WHERE username = ?", (from_username,))
         from_balance_data = cursor.fetchone()
         
         if not from_balance_data:
@@ -314,17 +573,95 @@ def transfer():
         
         # Deduct from sender
         new_from_balance = from_balance - amount_float
-        cursor.execute("UPDATE balances SET balance = ? WHERE username = ?", (new_from_balance, from_username))
+        cursor.execute(f"UPDATE {schemas[from_username]}.balances SET balance = ? WHERE username = ?",
+                       (new_from_balance, from_username))
         
         # Add to receiver
-        cursor.execute("SELECT balance FROM balances WHERE username = ?", (to_username,))
+        cursor.execute(f"SELECT balance FROM {schemas[to_username]}.balances WHERE username = ?", (to_username,))
         to_balance_data = cursor.fetchone()
         
         if to_balance_data:
             new_to_balance = to_balance_data[0] + amount_float
-            cursor.execute("UPDATE balances SET balance = ? WHERE username = ?", (new_to_balance, to_username))
+            cursor.execute(f"UPDATE {schemas[to_username]}.balances SET balance = ? WHERE username = ?",
+                           (new_to_balance, to_username))
         else:
-            cursor.execute("INSERT INTO balances (username, balance) VALUES (?, ?)", (to_username, amount_float))
+            cursor.execute(f"INSERT INTO {schemas[to_username]}.balances (username, balance) VALUES (?, ?)",
+                           (to_username, amount_float))
+        
+        if idempotency_key:
+            record_idempotent(cursor, idempotency_key, {"status": 1}, request_body_hash())
+        
+        conn.commit()
+        conn.close()
+        
+        return jsonify({"status": 1})
+        
+    except Exception as e:
+        if conn:
+            conn.close()
+        return jsonify({"status": 2})
+
+@app.route('/transfer_batch', methods=['POST'])
+def transfer_batch():
+    """Internal endpoint to apply several transfers in one all-or-nothing transaction"""
+    conn = None
+    try:
+        transfers = get_post_param('transfers')
+        if not isinstance(transfers, list) or not transfers:
+            return jsonify({"status": 2})
+        
+        # Net change per user; each sender is checked once against their total
+        debits = {}
+        changes = {}
+        try:
+            for leg in transfers:
+                from_username = leg['from_username']
+                to_username = leg['to_username']
+                amount_float = float(leg['amount'])
+                if not from_username or not to_username or amount_float < 0:
+                    return jsonify({"status": 2})
+                debits[from_username] = debits.get(from_username, 0.0) + amount_float
+                changes[from_username] = changes.get(from_username, 0.0) - amount_float
+                changes[to_username] = changes.get(to_username, 0.0) + amount_float
+        except:
+            return jsonify({"status": 2})
+        
+        conn, schemas = get_users_db(changes)
+        cursor = conn.cursor()
+        
+        cursor.execute("BEGIN IMMEDIATE")
+        
+        # Replay a batch we have already applied
+        idempotency_key = get_idempotency_key('')
+        if idempotency_key:
+            replay = replay_idempotent(cursor, idempotency_key)
+            if replay is not None:
+                conn.commit()
+                conn.close()
+                return replay
+        
+        balances = {}
+        for username in changes:
+            cursor.execute(f"SELECT balance FROM {schemas[username]}.balances WHERE username = ?", (username,))
+            balance_data = cursor.fetchone()
+            balances[username] = balance_data[0] if balance_data else None
+        
+        for username, total in debits.items():
+            if balances[username] is None or balances[username] < total:
+                conn.rollback()
+                conn.close()
+                return jsonify({"status": 2})
+        
+        for username, change in changes.items():
+            if balances[username] is None:
+                cursor.execute(f"INSERT INTO {schemas[username]}.balances (username, balance) VALUES (?, ?)",
+                               (username, change))
+            else:
+                cursor.execute(f"UPDATE {schemas[username]}.balances SET balance = ? WHERE username = ?",
+                               (balances[username] + change, username))
+        
+        if idempotency_key:
+            record_idempotent(cursor, idempotency_key, {"status": 1}, request_body_hash())
         
         conn.commit()
         conn.close()
@@ -336,6 +673,54 @@ def transfer():
             conn.close()
         return jsonify({"status": 2})
 
+@app.route('/transfer_outcome', methods=['POST'])
+def transfer_outcome():
+    """Internal endpoint settling whether a transfer sent with an Idempotency-Key went through.
+
+    Takes the transfer's `operation` (/transfer or /transfer_batch) and every
+    username it touches, so the key is looked up on the same shard the
+    transfer recorded it on. Returns the transfer's recorded response; if there
+    is none, records a failure under the key first, so a late or retried copy
+    of the transfer replays that failure instead of applying.
+    """
+    conn = None
+    try:
+        operation = get_post_param('operation')
+        usernames = get_post_param('usernames')
+        key = request.headers.get('Idempotency-Key')
+        if operation not in ('/transfer', '/transfer_batch') or not key:
+            return jsonify({"status": 2})
+        if not isinstance(usernames, list) or not usernames:
+            return jsonify({"status": 2})
+        
+        conn, _ = get_users_db(usernames)
+        cursor = conn.cursor()
+        cursor.execute("BEGIN IMMEDIATE")
+        
+        # Scoped as get_idempotency_key('') scopes it on the transfer endpoint
+        idempotency_key = f"{operation}::{key}"
+        stored = lookup_idempotent(cursor, idempotency_key)
+        if stored is not None:
+            outcome = stored[0]
+        else:
+            outcome = {"status": 2}
+            record_idempotent(cursor, idempotency_key, outcome)
+        
+        conn.commit()
+        conn.close()
+        
+        return jsonify({"status": 1, "outcome": outcome})
+        
+    except Exception as e:
+        if conn:
+            conn.close()
+        return jsonify({"status": 2})
+
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=5000, debug=False)
+    memory.start()
+    if backup_interval > 0:
+        backups.start()
+    if unix_socket:
+        serve_unix_socket(app, unix_socket)
+    app.run(host='0.0.0.0', port=port, debug=False)
 
@@ -1,7 +1,57 @@
+DROP TABLE IF EXISTS changelog;
+DROP TABLE IF EXISTS changelog_epoch;
 DROP TABLE IF EXISTS balances;
+DROP TABLE IF EXISTS idempotency_keys;
 
 CREATE TABLE balances (
     username TEXT PRIMARY KEY,
     balance REAL NOT NULL DEFAULT 0.0
 );
 
+CREATE TABLE idempotency_keys (
+    idempotency_key TEXT PRIMARY KEY,
+    response TEXT,
+    -- SHA-256 of the request's parameters; NULL for outcomes recorded by /transfer_outcome
+    body_hash TEXT,
+    created_at REAL NOT NULL
+);
+
+-- Change-data capture: every insert, update and delete on the tables below gets a
+-- row here (in commit order, as SQLite has one writer at a time), served by /changes
+CREATE TABLE changelog (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    table_name TEXT NOT NULL,
+    op TEXT NOT NULL,
+    row_key TEXT NOT NULL,
+    data TEXT,
+    changed_at REAL NOT NULL DEFAULT ((julianday('now') - 2440587.5) * 86400.0)
+);
+
+-- Identifies this incarnation of the database, so feed readers notice a reset
+CREATE TABLE changelog_epoch (
+    epoch TEXT NOT NULL
+);
+
+INSERT INTO changelog_epoch (epoch) VALUES (lower(hex(randomblob(8))));
+
+-- Keep a day of changes, pruning every 1000 entries
+CREATE TRIGGER changelog_prune AFTER INSERT ON changelog WHEN NEW.seq % 1000 = 0 BEGIN
+    DELETE FROM changelog WHERE changed_at < NEW.changed_at - 86400;
+END;
+
+CREATE TRIGGER balances_changelog_insert AFTER INSERT ON balances BEGIN
+    INSERT INTO changelog (table_name, op, row_key, data)
+    VALUES ('balances', 'insert', json_object('username', NEW.username),
+            json_object('username', NEW.username, 'balance', NEW.balance));
+END;
+
+CREATE TRIGGER balances_changelog_update AFTER UPDATE ON balances BEGIN
+    INSERT INTO changelog (table_name, op, row_key, data)
+    VALUES ('balances', 'update', json_object('username', NEW.username),
+            json_object('username', NEW.username, 'balance', NEW.balance));
+END;
+
+CREATE TRIGGER balances_changelog_delete AFTER DELETE ON balances BEGIN
+    INSERT INTO changelog (table_name, op, row_key, data)
+    VALUES ('balances', 'delete', json_object('username', OLD.username), NULL);
+END;
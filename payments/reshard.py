@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+"""
+Offline resharding of the payments balances.
+
+Stop the payments service, then run this in the directory holding its
+database files (outside the image, with the repository root on PYTHONPATH):
+
+    python3 reshard.py OLD_SHARDS NEW_SHARDS
+
+Every balance is rehashed into NEW_SHARDS new files. The old files are only
+removed once the new ones hold the same number of users and the same total.
+Idempotency keys do not record which users they guarded, so each new shard
+gets a copy of all of them. Restart the service with PAYMENTS_SHARDS=NEW_SHARDS.
+"""
+
+import os
+import sqlite3
+import sys
+
+from common.shards import shard_of, shard_file, sql_file
+
+
+def main():
+    if len(sys.argv) != 3:
+        sys.exit(__doc__)
+    old_count, new_count = int(sys.argv[1]), int(sys.argv[2])
+    if old_count < 1 or new_count < 1 or old_count == new_count:
+        sys.exit("shard counts must be positive and different")
+
+    old_files = [shard_file(shard, old_count) for shard in range(old_count)]
+    missing = [path for path in old_files if not os.path.exists(path)]
+    if missing:
+        sys.exit(f"missing shard files: {', '.join(missing)}")
+
+    with open(sql_file, 'r') as sql_startup:
+        init_db = sql_startup.read()
+    new_files = [shard_file(shard, new_count) for shard in range(new_count)]
+    temp_files = [f"{path}.resharding" for path in new_files]
+    new_conns = []
+    for path in temp_files:
+        if os.path.exists(path):
+            os.remove(path)
+        conn = sqlite3.connect(path)
+        conn.executescript(init_db)
+        new_conns.append(conn)
+
+    users_before, total_before = 0, 0.0
+    for path in old_files:
+        old = sqlite3.connect(path)
+        for username, balance in old.execute("SELECT username, balance FROM balances"):
+            new_conns[shard_of(username, new_count)].execute(
+                "INSERT INTO balances (username, balance) VALUES (?, ?)", (username, balance))
+            users_before += 1
+            total_before += balance
+        keys = old.execute("SELECT idempotency_key, response, created_at FROM idempotency_keys").fetchall()
+        for conn in new_conns:
+            conn.executemany("""
+                INSERT OR REPLACE INTO idempotency_keys (idempotency_key, response, created_at)
+                VALUES (?, ?, ?)
+            """, keys)
+        old.close()
+
+    users_after, total_after = 0, 0.0
+    for conn in new_conns:
+        conn.commit()
+        users, total = conn.execute("SELECT COUNT(*), COALESCE(SUM(balance), 0) FROM balances").fetchone()
+        users_after += users
+        total_after += total
+        conn.close()
+
+    if users_after != users_before or abs(total_after - total_before) > 1e-6 * max(1.0, abs(total_before)):
+        for path in temp_files:
+            os.remove(path)
+        sys.exit(f"mismatch: {users_before} users / {total_before:.2f} before, "
+                 f"{users_after} users / {total_after:.2f} after; old shards left in place")
+
+    for temp_path, path in zip(temp_files, new_files):
+        os.replace(temp_path, path)
+    for path in old_files:
+        if path not in new_files:
+            os.remove(path)
+    print(f"moved {users_after} balances (total {total_after:.2f}) from {old_count} to {new_count} shards")
+
+
+if __name__ == '__main__':
+    main()
@@ -5,25 +5,550 @@ Flask app for Project 3 - Reservations Microservice
 
 import sqlite3
 import os
+import asyncio
+import secrets
+import time
 import json
+import queue
+import threading
 import requests
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, Response, stream_with_context, g
+
+import common.db
+from common.wire import msgpack, WireJSONProvider, response_body, get_post_param, request_body_hash
+from common.resilience import DeadlineExceeded, CircuitOpen
+from common.ratelimit import RateLimiter, Admission
+from common.upstream import Upstream
+from common.transport import serve_unix_socket
+from common.auth import TokenVerifier
+from common.db import QueryStats, ChangeNotifier, ChangesFeed
+from common.backup import Backups
+from common.archive import Archives
+from common.profiling import Profiling
+from common.metrics import Metrics
+from common.memory import MemoryDiagnostics
+from common.asgi import AsgiApp, serve_asgi
+from common.aio import blocking, loop_views
 
 app = Flask(__name__)
 db_name = "reservations.db"
 sql_file = "reservations.sql"
 db_flag = False
 
+# "file" keeps the database in db_name; "memory" uses a shared-cache in-memory
+# database (for tests) that /clear resets from a pristine snapshot
+db_mode = os.environ.get('DB_MODE', 'file')
+memory_anchor = None
+memory_pristine = None
+
+# With KEEP_DB=1 a service starts on the database files already there (restored or
+# bulk-loaded) instead of recreating them; /clear still resets. File mode only
+keep_db = os.environ.get('KEEP_DB', '0') == '1'
+
+# Statements slower than this are logged with their query plan
+slow_query_ms = float(os.environ.get('SLOW_QUERY_MS', '50'))
+
+# /changes long-polls wait at most CHANGES_MAX_WAIT seconds, re-reading the changelog every
+# CHANGES_POLL_INTERVAL for commits by other processes, and return up to CHANGES_BATCH_SIZE
+changes_max_wait = float(os.environ.get('CHANGES_MAX_WAIT', '25'))
+changes_poll_interval = float(os.environ.get('CHANGES_POLL_INTERVAL', '1'))
+changes_batch_size = int(os.environ.get('CHANGES_BATCH_SIZE', '1000'))
+# At most CHANGES_MAX_WAITERS /changes requests wait at once, each holding a thread; past
+# that a request that would wait gets 503 (wait=0 reads are never turned away)
+changes_max_waiters = int(os.environ.get('CHANGES_MAX_WAITERS', '32'))
+
+# Online backups: every BACKUP_INTERVAL seconds (0 turns the schedule off) the database is
+# copied into BACKUP_DIR/<UTC time>/, BACKUP_PAGES pages per step with BACKUP_SLEEP seconds
+# between steps. After BACKUP_MAX_RESTARTS restarts caused by concurrent writes, the rest
+# is copied in one step. The newest BACKUP_KEEP backups are kept
+backup_interval = float(os.environ.get('BACKUP_INTERVAL', '3600'))
+backup_dir = os.environ.get('BACKUP_DIR', 'backups')
+backup_pages = int(os.environ.get('BACKUP_PAGES', '64'))
+backup_sleep = float(os.environ.get('BACKUP_SLEEP', '0.005'))
+backup_max_restarts = int(os.environ.get('BACKUP_MAX_RESTARTS', '3'))
+backup_keep = int(os.environ.get('BACKUP_KEEP', '24'))
+
+# Memory diagnostics (opt-in): MEMORY_DIAGNOSTICS=1 starts tracemalloc with MEMORY_TRACE_FRAMES
+# frames per allocation, enables /internal/memory/snapshots and adds cache sizes in bytes to
+# /metrics. The newest MEMORY_SNAPSHOTS snapshots are kept for diffing
+memory_diagnostics = os.environ.get('MEMORY_DIAGNOSTICS', '0') == '1'
+memory_trace_frames = int(os.environ.get('MEMORY_TRACE_FRAMES', '1'))
+memory_snapshots_kept = int(os.environ.get('MEMORY_SNAPSHOTS', '8'))
+
+# Upper bounds (seconds) of the request latency histogram served at /metrics
+latency_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# End-to-end budget for a request without an X-Request-Timeout header, the cap on a
+# single upstream call, and when a target's circuit breaker opens and re-probes
+request_budget = float(os.environ.get('REQUEST_BUDGET', '10'))
+upstream_timeout = float(os.environ.get('UPSTREAM_TIMEOUT', '2'))
+breaker_failure_threshold = int(os.environ.get('BREAKER_FAILURE_THRESHOLD', '5'))
+breaker_reset_timeout = float(os.environ.get('BREAKER_RESET_TIMEOUT', '10'))
+
+# Encoding of service-to-service bodies: "msgpack" (when installed) or "json"
+wire_format = os.environ.get('WIRE_FORMAT', 'msgpack')
+
+# Base URL of each upstream service; "unix:///path/to.sock" reaches it over a Unix socket
+service_urls = {
+    'user': os.environ.get('USER_URL', 'http://user:5000'),
+    'availability': os.environ.get('AVAILABILITY_URL', 'http://availability:5000'),
+    'payments': os.environ.get('PAYMENTS_URL', 'http://payments:5000')
+}
+
+# TCP port to serve on, and also this Unix socket path for co-located services
+port = int(os.environ.get('PORT', '5000'))
+unix_socket = os.environ.get('UNIX_SOCKET', '')
+
+# "wsgi" runs Flask's threaded server, async views included; "asgi" runs uvicorn, serving async
+# views on one event loop with a non-blocking HTTP client and the others on up to asgi_threads threads
+server_mode = os.environ.get('SERVER_MODE', 'wsgi')
+asgi_threads = int(os.environ.get('ASGI_THREADS', '64'))
+asgi_max_connections = int(os.environ.get('ASGI_MAX_CONNECTIONS', '1000'))
+
+# Token-bucket limits per (client, endpoint) and the cap on concurrent public requests
+rate_limit_rate = float(os.environ.get('RATE_LIMIT_RATE', '20'))
+rate_limit_burst = float(os.environ.get('RATE_LIMIT_BURST', '40'))
+rate_limit_max_clients = int(os.environ.get('RATE_LIMIT_MAX_CLIENTS', '100000'))
+public_concurrency = int(os.environ.get('PUBLIC_CONCURRENCY', '4096' if server_mode == 'asgi' else '64'))
+
+# Opt-in profiling: requests signed with PROFILE_SECRET (X-Profile header) or a random
+# PROFILE_SAMPLE_RATE fraction are run under cProfile and saved to PROFILE_DIR
+profile_enabled = os.environ.get('PROFILE_ENABLED', '0') == '1'
+profile_secret = os.environ.get('PROFILE_SECRET', '')
+profile_sample_rate = float(os.environ.get('PROFILE_SAMPLE_RATE', '0'))
+profile_dir = os.environ.get('PROFILE_DIR', 'profiles')
+profile_max_files = int(os.environ.get('PROFILE_MAX_FILES', '200'))
+
+# Endpoints served on the internal lane, exempt from admission control
+internal_endpoints = {'check_reservation', 'circuit_breakers', 'single_flight_stats', 'profile_summary',
+                      'query_stats_report', 'changes_feed', 'backups_report', 'take_backup', 'metrics',
+                      'memory_report', 'take_memory_snapshot', 'memory_diff', 'run_archive', 'clear_db',
+                      'compensations_report', 'run_reconcile'}
+
+# Revocation feed polling and how stale it may get before cached identities are distrusted
+revocation_poll_interval = float(os.environ.get('REVOCATION_POLL_INTERVAL', '5'))
+revocation_max_staleness = float(os.environ.get('REVOCATION_MAX_STALENESS', '30'))
+verify_cache_size = int(os.environ.get('VERIFY_CACHE_SIZE', '10000'))
+
+# Shared secret for X-Identity headers signed by the gateway (empty ignores them),
+# and how long after signing such a header is accepted
+identity_secret = os.environ.get('IDENTITY_SECRET', '')
+identity_ttl = float(os.environ.get('IDENTITY_TTL', '30'))
+
+# Per-subscriber event buffer and keep-alive interval for /events
+events_buffer_size = int(os.environ.get('EVENTS_BUFFER_SIZE', '100'))
+events_heartbeat = float(os.environ.get('EVENTS_HEARTBEAT', '15'))
+
+# How long Idempotency-Key responses are replayed, and when an unfinished one may be retried
+idempotency_ttl = float(os.environ.get('IDEMPOTENCY_TTL', '86400'))
+idempotency_pending_timeout = float(os.environ.get('IDEMPOTENCY_PENDING_TIMEOUT', '30'))
+idempotency_purged_at = 0.0
+
+# Compensating calls (putting claimed listings back) get their own COMPENSATION_TIMEOUT,
+# outside the request deadline and circuit breakers. One that fails is kept in the
+# compensations table and retried in the background, backing off from
+# COMPENSATION_RETRY_INTERVAL seconds up to COMPENSATION_MAX_BACKOFF
+compensation_timeout = float(os.environ.get('COMPENSATION_TIMEOUT', '5'))
+compensation_retry_interval = float(os.environ.get('COMPENSATION_RETRY_INTERVAL', '10'))
+compensation_max_backoff = float(os.environ.get('COMPENSATION_MAX_BACKOFF', '600'))
+
+# A transfer that gets no answer is tried TRANSFER_ATTEMPTS times in all, TRANSFER_BACKOFF
+# seconds apart, doubling each time. If payments never answers, the booking is kept pending
+# with its listings claimed, and settled every RECONCILE_INTERVAL seconds from the outcome
+# payments recorded under the transfer's Idempotency-Key
+transfer_attempts = int(os.environ.get('TRANSFER_ATTEMPTS', '3'))
+transfer_backoff = float(os.environ.get('TRANSFER_BACKOFF', '0.1'))
+reconcile_interval = float(os.environ.get('RECONCILE_INTERVAL', '5'))
+
+# Rows older than the horizon are moved to monthly archive databases in archive_dir
+archive_horizon_days = int(os.environ.get('ARCHIVE_HORIZON_DAYS', '180'))
+archive_interval = float(os.environ.get('ARCHIVE_INTERVAL', '3600'))
+archive_dir = os.environ.get('ARCHIVE_DIR', 'archive')
+
+
+class ReservationEvents:
+    """In-process fan-out of reservation-created events to /events subscribers.
+
+    Each subscriber gets a bounded queue; when a slow client falls behind the
+    oldest buffered event is dropped so publishing never blocks a request.
+    """
+
+    def __init__(self, buffer_size):
+        self.buffer_size = buffer_size
+        self.subscribers = {}
+        self.dropped = 0
+        self.lock = threading.Lock()
+
+    def subscribe(self, username):
+        events = queue.Queue(maxsize=self.buffer_size)
+        with self.lock:
+            self.subscribers.setdefault(username, set()).add(events)
+        return events
+
+    def unsubscribe(self, username, events):
+        with self.lock:
+            subscribers = self.subscribers.get(username)
+            if subscribers is not None:
+                subscribers.discard(events)
+                if not subscribers:
+                    del self.subscribers[username]
+
+    def publish(self, username, event):
+        with self.lock:
+            targets = list(self.subscribers.get(username, ()))
+        for events in targets:
+            while True:
+                try:
+                    events.put_nowait(event)
+                    break
+                except queue.Full:
+                    try:
+                        events.get_nowait()
+                        with self.lock:
+                            self.dropped += 1
+                    except queue.Empty:
+                        pass
+
+
+reservation_events = ReservationEvents(events_buffer_size)
+
+def publish_reservation(reservation_id, listingid, passenger_username, driver_username, price):
+    """Push a reservation-created event to both the driver and the passenger"""
+    for username, other_username in ((driver_username, passenger_username), (passenger_username, driver_username)):
+        reservation_events.publish(username, {
+            "id": reservation_id,
+            "listingid": listingid,
+            "price": f"{price:.2f}",
+            "user": other_username
+        })
+
+
+upstream = Upstream(service_urls, request_budget, upstream_timeout, breaker_failure_threshold, breaker_reset_timeout,
+                    wire_format, public_concurrency, app.logger, async_views=True)
+upstream.install(app)
+
+verifier = TokenVerifier(upstream, revocation_poll_interval, revocation_max_staleness, verify_cache_size,
+                         identity_secret, identity_ttl)
+
+# Async views stay async on the ASGI event loop and run as sync views on the threaded server
+loop_view = loop_views(server_mode == 'asgi')
+
+
+def send_compensation(target, path, body, headers=None):
+    """One attempt at a compensating call; True once the target has applied it.
+
+    Compensations must go through even when the request that needs them is out
+    of time or the target's breaker is open, so they skip both and use
+    compensation_timeout instead.
+    """
+    resp = upstream.session.post(upstream.service_url(target, path), json=body, headers=headers,
+                                 timeout=compensation_timeout)
+    return resp.status_code == 200 and response_body(resp).get('status') == 1
+
+def compensate(target, path, body, headers=None):
+    """Run a compensating call now, or queue it for run_compensations if it fails"""
+    try:
+        if send_compensation(target, path, body, headers):
+            return True
+        error = "rejected"
+    except (requests.RequestException, ValueError) as e:
+        error = str(e)
+    app.logger.warning("compensation %s %s failed (%s), queued for retry", target, path, error)
+    now = time.time()
+    conn = get_db()
+    try:
+        conn.execute("""
+            INSERT INTO compensations (target, path, body, headers, attempts, last_error, next_attempt_at, created_at)
+            VALUES (?, ?, ?, ?, 1, ?, ?, ?)
+        """, (target, path, json.dumps(body), json.dumps(headers or {}), error,
+              now + compensation_retry_interval, now))
+        conn.commit()
+    finally:
+        conn.close()
+    return False
+
+def retry_compensations():
+    """Retry the queued compensations that are due; returns how many went through"""
+    now = time.time()
+    conn = get_db()
+    try:
+        due = conn.execute("""
+            SELECT id, target, path, body, headers, attempts FROM compensations
+            WHERE next_attempt_at <= ? ORDER BY id
+        """, (now,)).fetchall()
+    finally:
+        conn.close()
+    done = 0
+    for compensation_id, target, path, body, headers, attempts in due:
+        try:
+            ok = send_compensation(target, path, json.loads(body), json.loads(headers))
+            error = None if ok else "rejected"
+        except (requests.RequestException, ValueError) as e:
+            ok, error = False, str(e)
+        conn = get_db()
+        try:
+            if ok:
+                conn.execute("DELETE FROM compensations WHERE id = ?", (compensation_id,))
+                done += 1
+            else:
+                app.logger.warning("compensation %s %s failed again (%s) after %d attempts",
+                                   target, path, error, attempts + 1)
+                backoff = min(compensation_retry_interval * 2 ** attempts, compensation_max_backoff)
+                conn.execute("""
+                    UPDATE compensations SET attempts = attempts + 1, last_error = ?, next_attempt_at = ?
+                    WHERE id = ?
+                """, (error, time.time() + backoff, compensation_id))
+            conn.commit()
+        finally:
+            conn.close()
+    return done
+
+def run_compensations():
+    while True:
+        time.sleep(compensation_retry_interval)
+        try:
+            retry_compensations()
+        except Exception:
+            app.logger.exception("compensation retry failed")
+
+def transfer_with_retries(path, body, key):
+    """Send a transfer to payments under key, retrying with backoff while it does not answer.
+
+    Returns True or False once payments has answered, or None if no try got an
+    answer, since one of them may still have committed. Raises DeadlineExceeded
+    or CircuitOpen when the first try cannot be sent at all.
+    """
+    url = upstream.service_url('payments', path)
+    delay = transfer_backoff
+    for attempt in range(transfer_attempts):
+        if attempt:
+            if upstream.request_deadline() - time.time() <= delay:
+                break
+            time.sleep(delay)
+            delay *= 2
+        try:
+            response = upstream.request('POST', 'payments', url, json=body, headers={'Idempotency-Key': key})
+            if response.status_code == 200:
+                return response_body(response).get('status') == 1
+        except (DeadlineExceeded, CircuitOpen):
+            if not attempt:
+                raise
+            break
+        except Exception:
+            pass
+    return None
+
+async def transfer_async(path, body, key):
+    """transfer_with_retries for async views, off the event loop"""
+    return await blocking(transfer_with_retries, path, body, key)
+
+def refund_booking(transfer_key, passenger, listings):
+    """Undo a booking that was paid for but could not be stored: refund each driver's leg
+    and put the listings back, queueing whichever of the two fails"""
+    refunds = [{'from_username': listing['driver'], 'to_username': passenger, 'amount': listing['price']}
+               for listing in listings]
+    compensate('payments', '/transfer_batch', {'transfers': refunds}, {'Idempotency-Key': f"refund:{transfer_key}"})
+    compensate('availability', '/release_listings', {'listings': listings})
+
+def defer_reservation(operation, transfer_key, usernames, passenger, listings, response, idempotency_key):
+    """Keep a booking whose transfer outcome is unknown until reconcile_reservations settles it.
+
+    response is what the request answers if the transfer went through; the
+    listings stay claimed meanwhile.
+    """
+    now = time.time()
+    conn = get_db()
+    try:
+        conn.execute("""
+            INSERT OR REPLACE INTO pending_reservations
+                (transfer_key, operation, usernames, passenger_username, listings, response, idempotency_key,
+                 attempts, next_attempt_at, created_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?, 0, ?, ?)
+        """, (transfer_key, operation, json.dumps(usernames), passenger, json.dumps(listings), json.dumps(response),
+              idempotency_key, now + reconcile_interval, now))
+        conn.commit()
+    finally:
+        conn.close()
+    app.logger.warning("%s for %s got no answer; booking of %s pending", operation, passenger,
+                       [listing['listingid'] for listing in listings])
+
+def reconcile_reservations(everything=False):
+    """Settle pending bookings that are due (or all of them) from their transfers' outcomes.
+
+    Asking payments for the outcome also fences the transfer off, so once it
+    reports a failure the charge can no longer land. A paid booking gets its
+    reservations; an unpaid one has its listings put back. The replayed
+    response of the booking's Idempotency-Key is updated either way.
+    """
+    conn = get_db()
+    try:
+        due = conn.execute("""
+            SELECT transfer_key, operation, usernames, passenger_username, listings, response, idempotency_key,
+                   attempts
+            FROM pending_reservations WHERE next_attempt_at <= ? ORDER BY created_at
+        """, (float('inf') if everything else time.time(),)).fetchall()
+    finally:
+        conn.close()
+    settled = 0
+    for transfer_key, operation, usernames, passenger, listings, response, idempotency_key, attempts in due:
+        listings = json.loads(listings)
+        try:
+            outcome_response = upstream.session.post(
+                upstream.service_url('payments', '/transfer_outcome'),
+                json={'operation': operation, 'usernames': json.loads(usernames)},
+                headers={'Idempotency-Key': transfer_key}, timeout=compensation_timeout)
+            outcome = response_body(outcome_response) if outcome_response.status_code == 200 else {}
+        except (requests.RequestException, ValueError):
+            outcome = {}
+        conn = get_db()
+        try:
+            cursor = conn.cursor()
+            if outcome.get('status') != 1:
+                backoff = min(reconcile_interval * 2 ** attempts, compensation_max_backoff)
+                cursor.execute("""
+                    UPDATE pending_reservations SET attempts = attempts + 1, next_attempt_at = ?
+                    WHERE transfer_key = ?
+                """, (time.time() + backoff, transfer_key))
+                conn.commit()
+                continue
+            paid = outcome['outcome'].get('status') == 1
+            cursor.execute("BEGIN IMMEDIATE")
+            cursor.execute("DELETE FROM pending_reservations WHERE transfer_key = ?", (transfer_key,))
+            if not cursor.rowcount:
+                conn.rollback()
+                continue
+            created = []
+            if paid:
+                for listing in listings:
+                    cursor.execute("""
+                        INSERT INTO reservations (listingid, passenger_username, driver_username, price)
+                        VALUES (?, ?, ?, ?)
+                    """, (listing['listingid'], passenger, listing['driver'], float(listing['price'])))
+                    created.append((cursor.lastrowid, listing))
+            else:
+                response = json.dumps({"status": 3})
+            if idempotency_key:
+                cursor.execute("UPDATE idempotency_keys SET response = ? WHERE idempotency_key = ?",
+                               (response, idempotency_key))
+            conn.commit()
+        finally:
+            conn.close()
+        if paid:
+            for reservation_id, listing in created:
+                publish_reservation(reservation_id, listing['listingid'], passenger, listing['driver'],
+                                    float(listing['price']))
+        else:
+            compensate('availability', '/release_listings', {'listings': listings})
+        app.logger.info("pending booking of %s for %s settled: %s", [listing['listingid'] for listing in listings],
+                        passenger, "paid" if paid else "not paid")
+        settled += 1
+    return settled
+
+def run_reconciler():
+    while True:
+        time.sleep(reconcile_interval)
+        try:
+            reconcile_reservations()
+        except Exception:
+            app.logger.exception("reconciling pending bookings failed")
+
+@app.route('/internal/compensations', methods=['GET'])
+def compensations_report():
+    """Internal endpoint listing the compensating calls still waiting to go through"""
+    conn = get_db()
+    try:
+        rows = conn.execute("""
+            SELECT id, target, path, body, attempts, last_error, next_attempt_at, created_at
+            FROM compensations ORDER BY id
+        """).fetchall()
+    finally:
+        conn.close()
+    return jsonify({"status": 1, "compensations": [
+        {"id": row[0], "target": row[1], "path": row[2], "body": json.loads(row[3]), "attempts": row[4],
+         "last_error": row[5], "next_attempt_at": row[6], "created_at": row[7]} for row in rows]})
+
+
+rate_limiter = RateLimiter(rate_limit_rate, rate_limit_burst, rate_limit_max_clients)
+admission = Admission(rate_limiter, public_concurrency, internal_endpoints, verifier.client_key)
+admission.install(app)
+
+
+profiling = Profiling(profile_enabled, profile_secret, profile_sample_rate, profile_dir, profile_max_files)
+profiling.install(app)
+
+
+query_stats = QueryStats(slow_query_ms, app.logger)
+change_notifier = ChangeNotifier()
+TimedConnection = common.db.timed_connection(query_stats, change_notifier)
+query_stats.install(app)
+
+
+def backup_sources():
+    """(file name, connect function) for each database file a backup covers"""
+    return [(db_name, connect_db)] + archives.backup_sources('reservations')
+
+def prepare_backup():
+    if not db_flag:
+        create_db()
+
+# Held by archiving and by backups, so no row moves between the live copy and the archive copies
+archive_lock = threading.Lock()
+
+metrics = Metrics()
+# archive/ is in every backup, so restore can tell an empty archive from a backup without one
+backups = Backups(backup_dir, backup_pages, backup_sleep, backup_max_restarts, backup_keep, backup_interval,
+                  latency_buckets, app.logger, backup_sources, prepare=prepare_backup, hold=archive_lock,
+                  directories=('archive',))
+backups.install(app, metrics)
+metrics.install(app)
+
+# Caches and in-memory indexes whose size /metrics and /internal/memory report;
+# name -> function returning (object, number of entries)
+memory_caches = {
+    'reservation_events': lambda: (reservation_events.subscribers,
+                                   sum(len(queues) for queues in list(reservation_events.subscribers.values()))),
+    'verified_tokens': lambda: (verifier.verified_tokens, len(verifier.verified_tokens)),
+    'revocations': lambda: (verifier.revocations, len(verifier.revocations.entries)),
+    'rate_limit_buckets': lambda: (rate_limiter.buckets, len(rate_limiter.buckets)),
+    'query_stats': lambda: (query_stats.stats, len(query_stats.stats))
+}
+
+memory = MemoryDiagnostics(memory_caches, memory_diagnostics, memory_trace_frames, memory_snapshots_kept)
+memory.install(app, metrics)
+
+def connect_db():
+    """Open a connection to the service database"""
+    if db_mode == 'memory':
+        return sqlite3.connect(f"file:{db_name}?mode=memory&cache=shared", uri=True, check_same_thread=False,
+                               factory=TimedConnection)
+    return sqlite3.connect(db_name, factory=TimedConnection)
+
 def create_db():
     """Create database from SQL file"""
-    conn = sqlite3.connect(db_name)
-    
-    with open(sql_file, 'r') as sql_startup:
-        init_db = sql_startup.read()
-    cursor = conn.cursor()
-    cursor.executescript(init_db)
-    conn.commit()
-    conn.close()
+    global memory_anchor, memory_pristine
+    if db_mode == 'memory' and memory_anchor is not None:
+        # Reset from the pristine snapshot instead of re-running the script
+        memory_pristine.backup(memory_anchor)
+        # A restored snapshot restarts the changelog, so it gets a new epoch
+        memory_anchor.execute("UPDATE changelog_epoch SET epoch = lower(hex(randomblob(8)))")
+        memory_anchor.commit()
+    else:
+        conn = connect_db()
+        
+        if not (keep_db and db_mode == 'file' and
+                conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'changelog_epoch'").fetchone()):
+            with open(sql_file, 'r') as sql_startup:
+                init_db = sql_startup.read()
+            cursor = conn.cursor()
+            cursor.executescript(init_db)
+            conn.commit()
+        if db_mode == 'memory':
+            # The in-memory database lives as long as this connection stays open
+            memory_anchor = conn
+            memory_pristine = sqlite3.connect(':memory:', check_same_thread=False)
+            conn.backup(memory_pristine)
+        else:
+            conn.close()
     global db_flag
     db_flag = True
 
@@ -31,41 +556,118 @@ def get_db():
     """Get database connection, creating if necessary"""
     if not db_flag:
         create_db()
-    conn = sqlite3.connect(db_name)
+    conn = connect_db()
     return conn
 
-def verify_token(token):
-    """Verify JWT token by calling user service"""
-    try:
-        resp = requests.get('http://user:5000/internal/verify_jwt', params={'token': token}, timeout=2)
-        return resp.json()
-    except:
-        return {"valid": 0}
-
-def get_post_param(param_name):
-    """Robustly extract a POST parameter from form, JSON, or raw body."""
-    # 1) Standard form field
-    value = request.form.get(param_name)
-    if value is not None and value != "":
-        return value
-    # 2) JSON body
-    try:
-        json_body = request.get_json(silent=True)
-        if isinstance(json_body, dict) and param_name in json_body and json_body[param_name] != "":
-            return json_body[param_name]
-    except:
-        pass
-    # 3) URL-encoded raw body fallback
+changes_feed = ChangesFeed(change_notifier, get_db, changes_max_wait, changes_poll_interval, changes_batch_size,
+                           changes_max_waiters)
+changes_feed.install(app)
+
+archives = Archives(archive_dir, archive_horizon_days, archive_interval, archive_lock, get_db, TimedConnection,
+                    app.logger)
+
+
+def archive_reservations():
+    """Move reservations older than the horizon into monthly archives"""
+    return archives.move_old_rows('reservations', """
+        CREATE TABLE IF NOT EXISTS archive.reservations (
+            id INTEGER PRIMARY KEY,
+            listingid INTEGER NOT NULL,
+            passenger_username TEXT NOT NULL,
+            driver_username TEXT NOT NULL,
+            price REAL NOT NULL,
+            created_at DATETIME
+        )
+    """)
+
+def begin_idempotent(scope, failure):
+    """Claim the request's Idempotency-Key, or return the response to replay.
+
+    Returns None when the request should run. A key that already finished
+    replays its stored response; one still running gets `failure` with 409.
+    A key reused with different parameters gets 422 instead of either.
+    Handlers answer a final outcome with idempotent_result; anything else
+    releases the key so a retry runs again.
+    """
+    global idempotency_purged_at
+    key = request.headers.get('Idempotency-Key')
+    if not key:
+        return None
+    key = f"{request.path}:{scope}:{key}"
+    body_hash = request_body_hash()
+    now = time.time()
+    conn = get_db()
     try:
-        from urllib.parse import parse_qs
-        raw = request.get_data(as_text=True) or ""
-        parsed = parse_qs(raw, keep_blank_values=True)
-        if param_name in parsed and len(parsed[param_name]) > 0:
-            return parsed[param_name][0]
-    except:
-        pass
+        cursor = conn.cursor()
+        cursor.execute("BEGIN IMMEDIATE")
+        if now - idempotency_purged_at > 60:
+            cursor.execute("DELETE FROM idempotency_keys WHERE created_at < ?", (now - idempotency_ttl,))
+            idempotency_purged_at = now
+        cursor.execute("""
+            SELECT response, body_hash, created_at FROM idempotency_keys
+            WHERE idempotency_key = ?
+        """, (key,))
+        row = cursor.fetchone()
+        live = row and row[2] >= now - (idempotency_ttl if row[0] is not None else idempotency_pending_timeout)
+        if live and row[1] is not None and row[1] != body_hash:
+            conn.commit()
+            return jsonify({"status": 2, "error": "idempotency_key_reused"}), 422
+        if live and row[0] is not None:
+            conn.commit()
+            return jsonify(json.loads(row[0]))
+        if live:
+            conn.commit()
+            return jsonify(failure), 409
+        cursor.execute("""
+            INSERT OR REPLACE INTO idempotency_keys (idempotency_key, response, body_hash, created_at)
+            VALUES (?, NULL, ?, ?)
+        """, (key, body_hash, now))
+        conn.commit()
+    finally:
+        conn.close()
+    g.idempotency_key = key
     return None
 
+def downstream_idempotency_headers():
+    """Pass our Idempotency-Key on so upstream side effects are not repeated either"""
+    key = g.get('idempotency_key')
+    return {'Idempotency-Key': key} if key else {}
+
+def idempotent_result(payload):
+    """Respond with a final outcome (success or a deterministic rejection) that retries replay"""
+    if g.get('idempotency_key'):
+        g.idempotent_response = payload
+    return jsonify(payload)
+
+@app.after_request
+def store_idempotent_response(response):
+    """Record the final outcome of a request that claimed an Idempotency-Key.
+
+    The payload is the one passed to idempotent_result, whatever wire format
+    the response went out in. Without one the failure was transient (an
+    upstream error or timeout), so the pending key is dropped instead.
+    """
+    key = g.pop('idempotency_key', None)
+    if key is None:
+        return response
+    payload = g.pop('idempotent_response', None)
+    conn = get_db()
+    try:
+        if payload is None:
+            conn.execute("DELETE FROM idempotency_keys WHERE idempotency_key = ? AND response IS NULL", (key,))
+        else:
+            # A pending booking reconciled meanwhile has already stored its outcome
+            conn.execute("UPDATE idempotency_keys SET response = ? WHERE idempotency_key = ? AND response IS NULL",
+                         (json.dumps(payload), key))
+        conn.commit()
+    finally:
+        conn.close()
+    return response
+
+
+app.json = WireJSONProvider(app)
+
+
 @app.route('/clear', methods=['GET'])
 def clear_db():
     """Clear the database and recreate tables"""
@@ -74,15 +676,19 @@ def clear_db():
         global db_flag
         db_flag = False
         
-        try:
+        if db_mode == 'file':
+            try:
+                if os.path.exists(db_name):
+                    temp_conn = sqlite3.connect(db_name)
+                    temp_conn.close()
+            except:
+                pass
+            
             if os.path.exists(db_name):
-                temp_conn = sqlite3.connect(db_name)
-                temp_conn.close()
-        except:
-            pass
+                os.remove(db_name)
         
-        if os.path.exists(db_name):
-            os.remove(db_name)
+        # Archived partitions belong to the database being cleared
+        archives.remove('reservations')
         
         create_db()
         return jsonify({"status": 1})
@@ -93,7 +699,7 @@ def clear_db():
             except:
                 pass
         try:
-            if os.path.exists(db_name):
+            if db_mode == 'file' and os.path.exists(db_name):
                 os.remove(db_name)
             db_flag = False
             create_db()
@@ -102,9 +708,9 @@ def clear_db():
         return jsonify({"status": 1})
 
 @app.route('/reserve', methods=['POST'])
-def make_reservation():
+@loop_view
+async def make_reservation():
     """Make a ride sharing reservation"""
-    conn = None
     try:
         # Get JWT from Authorization header
         token = request.headers.get('Authorization')
@@ -112,7 +718,7 @@ def make_reservation():
             return jsonify({"status": 2})
         
         # Verify JWT by calling user service
-        auth = verify_token(token)
+        auth = await verifier.verify_async(token)
         if auth.get('valid') != 1:
             return jsonify({"status": 2})
         if auth.get('is_driver') != 0:
@@ -120,80 +726,209 @@ def make_reservation():
         
         username = auth.get('username')
         
+        # Replay a retried request instead of running it again
+        replay = await blocking(begin_idempotent, username, {"status": 3})
+        if replay is not None:
+            return replay
+        
         # Get listingid
         listingid = get_post_param('listingid')
         if not listingid:
-            return jsonify({"status": 3})
+            return idempotent_result({"status": 3})
         
         try:
             listingid_int = int(listingid)
-        except:
-            return jsonify({"status": 3})
+        except Exception:
+            return idempotent_result({"status": 3})
         
-        # Get listing information from availability service
+        # Claim the listing (fetch and remove it in one step) so nobody else can book it meanwhile
         try:
-            availability_url = os.environ.get('AVAILABILITY_URL', 'http://availability:5000/get_listing')
-            listing_response = requests.post(availability_url, data={'listingid': listingid}, timeout=2)
-            if listing_response.status_code != 200:
-                return jsonify({"status": 3})
-            listing_data = listing_response.json()
-            if listing_data.get('status') != 1:
-                return jsonify({"status": 3})
-            
-            driver_username = listing_data.get('driver')
-            price_str = listing_data.get('price')
-            
-            if not driver_username or not price_str:
+            availability_url = upstream.service_url('availability', '/claim_listings')
+            claim_response = await upstream.request_async('POST', 'availability', availability_url, json={'listingids': [listingid_int]})
+            if claim_response.status_code != 200:
                 return jsonify({"status": 3})
+            claim_data = response_body(claim_response)
+            if claim_data.get('status') != 1:
+                # The listing does not exist or is already booked
+                return idempotent_result({"status": 3})
+            claimed = claim_data.get('data')
             
+            driver_username = claimed[0].get('driver')
+            price_str = claimed[0].get('price')
             price_float = float(price_str)
-        except:
+        except Exception:
             return jsonify({"status": 3})
         
-        # Check if passenger has enough balance
+        # Check the passenger's balance, then transfer money from passenger to driver.
+        # declined means payments answered no; unsettled means it never answered the transfer
+        paid = False
+        declined = False
+        unsettled = False
         try:
-            payments_url = os.environ.get('PAYMENTS_URL', 'http://payments:5000/check_balance')
-            balance_response = requests.post(payments_url, data={'username': username, 'amount': price_str}, timeout=2)
-            if balance_response.status_code != 200:
-                return jsonify({"status": 3})
-            balance_data = balance_response.json()
-            if balance_data.get('status') != 1 or not balance_data.get('has_enough'):
-                return jsonify({"status": 3})
-        except:
+            payments_url = upstream.service_url('payments', '/check_balance')
+            balance_response = await upstream.request_async('POST', 'payments', payments_url, data={'username': username, 'amount': price_str})
+            balance_data = response_body(balance_response) if balance_response.status_code == 200 else {}
+            declined = balance_data.get('status') == 1 and not balance_data.get('has_enough')
+            if balance_data.get('status') == 1 and balance_data.get('has_enough'):
+                # A transfer that timed out may still have committed, so retry it under the
+                # same Idempotency-Key: payments replays a committed one instead of charging again
+                transfer_key = downstream_idempotency_headers().get('Idempotency-Key') or secrets.token_hex(16)
+                paid = await transfer_async('/transfer', {'from_username': username, 'to_username': driver_username,
+                                                          'amount': price_str}, transfer_key)
+                unsettled = paid is None
+                declined = paid is False
+        except Exception:
+            paid = False
+        
+        if unsettled:
+            # The charge may have gone through, so the listing stays claimed until
+            # reconcile_reservations learns the outcome; a retry replays status 4 until then
+            await blocking(defer_reservation, '/transfer', transfer_key, [username, driver_username],
+                                    username, claimed, {"status": 1}, g.get('idempotency_key'))
+            return idempotent_result({"status": 4})
+        
+        if not paid:
+            # Put the listing back
+            await blocking(compensate, 'availability', '/release_listings', {'listings': claimed})
+            return idempotent_result({"status": 3}) if declined else jsonify({"status": 3})
+        
+        # Create reservation, off the event loop in case the database is busy
+        def insert_reservation():
+            conn = get_db()
+            try:
+                cursor = conn.cursor()
+                cursor.execute("""
+                    INSERT INTO reservations (listingid, passenger_username, driver_username, price)
+                    VALUES (?, ?, ?, ?)
+                """, (listingid_int, username, driver_username, price_float))
+                conn.commit()
+                return cursor.lastrowid
+            finally:
+                conn.close()
+        
+        try:
+            reservation_id = await blocking(insert_reservation)
+        except Exception:
+            app.logger.exception("storing a paid reservation for %s failed; refunding", username)
+            await blocking(refund_booking, transfer_key, username, claimed)
+            # The transfer's key is spent, so a retry must not run it again
+            return idempotent_result({"status": 3})
+        
+        publish_reservation(reservation_id, listingid_int, username, driver_username, price_float)
+        
+        return idempotent_result({"status": 1})
+        
+    except Exception as e:
+        return jsonify({"status": 3})
+
+@app.route('/reserve_batch', methods=['POST'])
+def make_batch_reservation():
+    """Reserve several listings at once, all or nothing"""
+    conn = None
+    try:
+        # Get JWT from Authorization header
+        token = request.headers.get('Authorization')
+        if not token:
+            return jsonify({"status": 2})
+        
+        # Verify JWT by calling user service
+        auth = verifier.verify(token)
+        if auth.get('valid') != 1:
+            return jsonify({"status": 2})
+        if auth.get('is_driver') != 0:
             return jsonify({"status": 3})
         
-        # Transfer money from passenger to driver
+        username = auth.get('username')
+        
+        # Replay a retried request instead of running it again
+        replay = begin_idempotent(username, {"status": 3})
+        if replay is not None:
+            return replay
+        
+        # Get listingids as a JSON list or a comma-separated string
+        listingids = get_post_param('listingids')
+        if isinstance(listingids, str):
+            listingids = [listingid.strip() for listingid in listingids.split(',') if listingid.strip()]
+        if not isinstance(listingids, list) or not listingids:
+            return idempotent_result({"status": 3})
+        
+        try:
+            listingids = [int(listingid) for listingid in listingids]
+        except:
+            return idempotent_result({"status": 3})
+        if len(set(listingids)) != len(listingids):
+            return idempotent_result({"status": 3})
+        
+        # Claim every listing in one call so nobody else can book them meanwhile
         try:
-            payments_url = os.environ.get('PAYMENTS_URL', 'http://payments:5000/transfer')
-            transfer_response = requests.post(payments_url, 
-                data={'from_username': username, 'to_username': driver_username, 'amount': price_str}, 
-                timeout=2)
-            if transfer_response.status_code != 200 or transfer_response.json().get('status') != 1:
+            availability_url = upstream.service_url('availability', '/claim_listings')
+            claim_response = upstream.request('POST', 'availability', availability_url, json={'listingids': listingids})
+            if claim_response.status_code != 200:
                 return jsonify({"status": 3})
+            claim_data = response_body(claim_response)
+            if claim_data.get('status') != 1:
+                # A listing does not exist or is already booked
+                return idempotent_result({"status": 3})
+            claimed = claim_data.get('data')
+            total = sum(float(listing['price']) for listing in claimed)
         except:
             return jsonify({"status": 3})
         
-        # Delete the listing from availability service
+        # Charge the passenger once for the total and credit each driver, retrying a transfer
+        # that times out under the same Idempotency-Key so it cannot charge twice
+        transfers = [{'from_username': username, 'to_username': listing['driver'], 'amount': listing['price']}
+                     for listing in claimed]
+        transfer_key = downstream_idempotency_headers().get('Idempotency-Key') or secrets.token_hex(16)
         try:
-            availability_url = os.environ.get('AVAILABILITY_URL', 'http://availability:5000/delete_listing')
-            delete_response = requests.post(availability_url, data={'listingid': listingid}, timeout=2)
-            # Continue even if delete fails
-        except:
-            pass
+            paid = transfer_with_retries('/transfer_batch', {'transfers': transfers}, transfer_key)
+        except (DeadlineExceeded, CircuitOpen):
+            paid = False
+            transfer_key = None
         
-        # Create reservation
-        conn = get_db()
-        cursor = conn.cursor()
+        booked = {
+            "status": 1,
+            "total": f"{total:.2f}",
+            "data": [{"listingid": listing['listingid'], "price": listing['price'], "driver": listing['driver']}
+                     for listing in claimed]
+        }
         
-        cursor.execute("""
-            INSERT INTO reservations (listingid, passenger_username, driver_username, price)
-            VALUES (?, ?, ?, ?)
-        """, (listingid_int, username, driver_username, price_float))
+        if paid is None:
+            # The charge may have gone through, so the listings stay claimed until
+            # reconcile_reservations learns the outcome; a retry replays status 4 until then
+            defer_reservation('/transfer_batch', transfer_key, [username] + [listing['driver'] for listing in claimed],
+                              username, claimed, booked, g.get('idempotency_key'))
+            return idempotent_result({"status": 4})
         
-        conn.commit()
-        conn.close()
+        if not paid:
+            # Put the listings back; payments answering no is final, not being asked is not
+            compensate('availability', '/release_listings', {'listings': claimed})
+            return idempotent_result({"status": 3}) if transfer_key else jsonify({"status": 3})
         
-        return jsonify({"status": 1})
+        # Create every reservation in one transaction, refunding the charge if that fails
+        conn = get_db()
+        try:
+            cursor = conn.cursor()
+            reservation_ids = []
+            for listing in claimed:
+                cursor.execute("""
+                    INSERT INTO reservations (listingid, passenger_username, driver_username, price)
+                    VALUES (?, ?, ?, ?)
+                """, (listing['listingid'], username, listing['driver'], float(listing['price'])))
+                reservation_ids.append(cursor.lastrowid)
+            conn.commit()
+        except Exception:
+            app.logger.exception("storing paid reservations for %s failed; refunding", username)
+            refund_booking(transfer_key, username, claimed)
+            # The transfer's key is spent, so a retry must not run it again
+            return idempotent_result({"status": 3})
+        finally:
+            conn.close()
+            conn = None
+        
+        for reservation_id, listing in zip(reservation_ids, claimed):
+            publish_reservation(reservation_id, listing['listingid'], username, listing['driver'], float(listing['price']))
+        
+        return idempotent_result(booked)
         
     except Exception as e:
         if conn:
@@ -211,7 +946,7 @@ def view_reservation():
             return jsonify({"status": 2, "data": "NULL"})
         
         # Verify JWT by calling user service
-        auth = verify_token(token)
+        auth = verifier.verify(token)
         if auth.get('valid') != 1:
             return jsonify({"status": 2, "data": "NULL"})
         
@@ -223,24 +958,30 @@ def view_reservation():
         
         # Get latest reservation
         if is_driver:
-            cursor.execute("""
+            latest_sql = """
                 SELECT listingid, price, passenger_username
                 FROM reservations
                 WHERE driver_username = ?
                 ORDER BY created_at DESC, id DESC
                 LIMIT 1
-            """, (username,))
+            """
         else:
-            cursor.execute("""
+            latest_sql = """
                 SELECT listingid, price, driver_username
                 FROM reservations
                 WHERE passenger_username = ?
                 ORDER BY created_at DESC, id DESC
                 LIMIT 1
-            """, (username,))
+            """
+        cursor.execute(latest_sql, (username,))
         
         reservation_data = cursor.fetchone()
         
+        # Only look in the archives when there is nothing recent
+        if not reservation_data:
+            archived = archives.query('reservations', latest_sql, (username,), first=True)
+            reservation_data = archived[0] if archived else None
+        
         if not reservation_data:
             conn.close()
             return jsonify({"status": 2, "data": "NULL"})
@@ -250,10 +991,10 @@ def view_reservation():
         # Get rating for the other user
         rating = "0.00"
         try:
-            user_url = os.environ.get('USER_URL', 'http://user:5000/get_rating')
-            rating_response = requests.post(user_url, data={'username': other_username}, timeout=2)
+            user_url = upstream.service_url('user', '/get_rating')
+            rating_response = upstream.request('POST', 'user', user_url, coalesce=True, data={'username': other_username})
             if rating_response.status_code == 200:
-                rating_data = rating_response.json()
+                rating_data = response_body(rating_response)
                 if rating_data.get('status') == 1:
                     rating = rating_data.get('rating', '0.00')
         except:
@@ -276,6 +1017,74 @@ def view_reservation():
             conn.close()
         return jsonify({"status": 2, "data": "NULL"})
 
+@app.route('/events', methods=['GET'])
+def reservation_stream():
+    """Server-Sent Events stream of new reservations for the caller"""
+    # EventSource clients cannot set headers, so also accept ?token=
+    token = request.headers.get('Authorization') or request.args.get('token')
+    if not token:
+        return jsonify({"status": 2})
+    
+    # Verify JWT once, then re-check its expiry and revocation on every heartbeat
+    auth = verifier.verify(token)
+    if auth.get('valid') != 1:
+        return jsonify({"status": 2})
+    
+    # The stream is long-lived, so it must not hold a public lane slot
+    admission.release_public_lane()
+    
+    username = auth.get('username')
+    events = reservation_events.subscribe(username)
+    
+    # Replay anything committed after the client's last seen event
+    missed = []
+    last_event_id = request.headers.get('Last-Event-ID')
+    if last_event_id:
+        conn = None
+        try:
+            conn = get_db()
+            cursor = conn.cursor()
+            cursor.execute("""
+                SELECT id, listingid, price, passenger_username, driver_username
+                FROM reservations
+                WHERE id > ? AND (driver_username = ? OR passenger_username = ?)
+                ORDER BY id
+                LIMIT ?
+            """, (int(last_event_id), username, username, events_buffer_size))
+            for reservation_id, listingid, price, passenger_username, driver_username in cursor.fetchall():
+                other_username = passenger_username if driver_username == username else driver_username
+                missed.append({"id": reservation_id, "listingid": listingid, "price": f"{price:.2f}", "user": other_username})
+            conn.close()
+        except:
+            if conn:
+                conn.close()
+    
+    def stream():
+        try:
+            sent = 0
+            for event in missed:
+                sent = event["id"]
+                yield f"id: {event['id']}\nevent: reservation\ndata: {json.dumps(event)}\n\n"
+            while True:
+                try:
+                    event = events.get(timeout=events_heartbeat)
+                except queue.Empty:
+                    event = None
+                # The token was verified once, so end the stream once it expires or is revoked
+                if auth.get('exp', 0) <= time.time() or verifier.revocations.is_revoked(auth):
+                    return
+                if event is None:
+                    yield ": keep-alive\n\n"
+                    continue
+                if event["id"] <= sent:
+                    continue
+                yield f"id: {event['id']}\nevent: reservation\ndata: {json.dumps(event)}\n\n"
+        finally:
+            reservation_events.unsubscribe(username, events)
+    
+    return Response(stream_with_context(stream()), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
 @app.route('/check_reservation', methods=['POST'])
 def check_reservation():
     """Internal endpoint to check if a reservation exists between two users"""
@@ -301,6 +1110,15 @@ def check_reservation():
         reservation = cursor.fetchone()
         conn.close()
         
+        # Fall back to archived reservations
+        if not reservation:
+            reservation = archives.query('reservations', """
+                SELECT id FROM reservations
+                WHERE (passenger_username = ? AND driver_username = ?)
+                OR (passenger_username = ? AND driver_username = ?)
+                LIMIT 1
+            """, (rater, rated, rated, rater), first=True)
+        
         if reservation:
             return jsonify({"status": 1})
         else:
@@ -311,6 +1129,100 @@ def check_reservation():
             conn.close()
         return jsonify({"status": 2})
 
+@app.route('/history', methods=['GET'])
+def reservation_history():
+    """List the caller's reservations since a date, newest first"""
+    conn = None
+    try:
+        # Get JWT from Authorization header
+        token = request.headers.get('Authorization')
+        if not token:
+            return jsonify({"status": 2, "data": []})
+        
+        # Verify JWT by calling user service
+        auth = verifier.verify(token)
+        if auth.get('valid') != 1:
+            return jsonify({"status": 2, "data": []})
+        
+        username = auth.get('username')
+        
+        try:
+            limit = int(request.args.get('limit', '100'))
+        except:
+            return jsonify({"status": 2, "data": []})
+        
+        conn = get_db()
+        cutoff = archives.cutoff(conn)
+        
+        # Defaults to the live (unarchived) window; YYYY-MM-DD
+        since = request.args.get('since') or cutoff
+        history_sql = """
+            SELECT id, listingid, price, passenger_username, driver_username, created_at
+            FROM reservations
+            WHERE (driver_username = ? OR passenger_username = ?) AND created_at >= ?
+            ORDER BY created_at DESC, id DESC
+            LIMIT ?
+        """
+        cursor = conn.cursor()
+        cursor.execute(history_sql, (username, username, since, limit))
+        rows = cursor.fetchall()
+        conn.close()
+        
+        # Only old requests touch the archives, and only the months they cover
+        if since < cutoff and len(rows) < limit:
+            rows += archives.query('reservations', history_sql, (username, username, since, limit),
+                                   since_month=since[:7])
+        rows.sort(key=lambda row: (row[5], row[0]), reverse=True)
+        
+        result_data = []
+        for _, listingid, price, passenger_username, driver_username, created_at in rows[:limit]:
+            result_data.append({
+                "listingid": listingid,
+                "price": f"{price:.2f}",
+                "user": passenger_username if driver_username == username else driver_username,
+                "created_at": created_at
+            })
+        
+        return jsonify({"status": 1, "data": result_data})
+        
+    except Exception as e:
+        if conn:
+            conn.close()
+        return jsonify({"status": 2, "data": []})
+
+@app.route('/internal/reconcile', methods=['POST'])
+def run_reconcile():
+    """Internal endpoint settling every pending booking now"""
+    try:
+        return jsonify({"status": 1, "settled": reconcile_reservations(everything=True)})
+    except Exception as e:
+        return jsonify({"status": 2, "settled": 0})
+
+@app.route('/internal/archive', methods=['POST'])
+def run_archive():
+    """Internal endpoint to run reservation archival now"""
+    try:
+        return jsonify({"status": 1, "moved": archive_reservations()})
+    except Exception as e:
+        return jsonify({"status": 2, "moved": 0})
+
+
+asgi_app = AsgiApp(app, upstream, verifier, asgi_threads, asgi_max_connections) if server_mode == 'asgi' else None
+
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=5000, debug=False)
+    memory.start()
+    if archive_interval > 0:
+        archives.start(archive_reservations)
+    if backup_interval > 0:
+        backups.start()
+    if compensation_retry_interval > 0:
+        threading.Thread(target=run_compensations, daemon=True).start()
+    if reconcile_interval > 0:
+        threading.Thread(target=run_reconciler, daemon=True).start()
+    if server_mode == 'asgi':
+        asyncio.run(serve_asgi(asgi_app, port, unix_socket))
+    else:
+        if unix_socket:
+            serve_unix_socket(app, unix_socket)
+        app.run(host='0.0.0.0', port=port, debug=False)
 
@@ -1,4 +1,10 @@
+DROP TABLE IF EXISTS changelog;
+DROP TABLE IF EXISTS changelog_epoch;
+DROP TABLE IF EXISTS archiving;
 DROP TABLE IF EXISTS reservations;
+DROP TABLE IF EXISTS idempotency_keys;
+DROP TABLE IF EXISTS compensations;
+DROP TABLE IF EXISTS pending_reservations;
 
 CREATE TABLE reservations (
     id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -9,3 +15,87 @@ CREATE TABLE reservations (
     created_at DATETIME DEFAULT CURRENT_TIMESTAMP
 );
 
+CREATE INDEX idx_reservations_created_at ON reservations (created_at);
+
+CREATE TABLE idempotency_keys (
+    idempotency_key TEXT PRIMARY KEY,
+    response TEXT,
+    -- SHA-256 of the request's parameters, so a key reused for another request is refused
+    body_hash TEXT,
+    created_at REAL NOT NULL
+);
+
+-- Compensating calls to other services that failed, retried until they go through
+CREATE TABLE compensations (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    target TEXT NOT NULL,
+    path TEXT NOT NULL,
+    body TEXT NOT NULL,
+    headers TEXT NOT NULL,
+    attempts INTEGER NOT NULL,
+    last_error TEXT,
+    next_attempt_at REAL NOT NULL,
+    created_at REAL NOT NULL
+);
+
+-- Bookings whose transfer got no answer: their listings stay claimed until the
+-- transfer's outcome, looked up under transfer_key, says whether they were paid for
+CREATE TABLE pending_reservations (
+    transfer_key TEXT PRIMARY KEY,
+    operation TEXT NOT NULL,
+    usernames TEXT NOT NULL,
+    passenger_username TEXT NOT NULL,
+    listings TEXT NOT NULL,
+    response TEXT NOT NULL,
+    idempotency_key TEXT,
+    attempts INTEGER NOT NULL,
+    next_attempt_at REAL NOT NULL,
+    created_at REAL NOT NULL
+);
+
+-- Holds a row while archive_old_rows moves rows to the archives, so the changelog
+-- records those deletes as 'archive' rather than 'delete'
+CREATE TABLE archiving (
+    active INTEGER NOT NULL
+);
+
+-- Change-data capture: every insert, update and delete on the tables below gets a
+-- row here (in commit order, as SQLite has one writer at a time), served by /changes
+CREATE TABLE changelog (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    table_name TEXT NOT NULL,
+    op TEXT NOT NULL,
+    row_key TEXT NOT NULL,
+    data TEXT,
+    changed_at REAL NOT NULL DEFAULT ((julianday('now') - 2440587.5) * 86400.0)
+);
+
+-- Identifies this incarnation of the database, so feed readers notice a reset
+CREATE TABLE changelog_epoch (
+    epoch TEXT NOT NULL
+);
+
+INSERT INTO changelog_epoch (epoch) VALUES (lower(hex(randomblob(8))));
+
+-- Keep a day of changes, pruning every 1000 entries
+CREATE TRIGGER changelog_prune AFTER INSERT ON changelog WHEN NEW.seq % 1000 = 0 BEGIN
+    DELETE FROM changelog WHERE changed_at < NEW.changed_at - 86400;
+END;
+
+CREATE TRIGGER reservations_changelog_insert AFTER INSERT ON reservations BEGIN
+    INSERT INTO changelog (table_name, op, row_key, data)
+    VALUES ('reservations', 'insert', json_object('id', NEW.id),
+            json_object('id', NEW.id, 'listingid', NEW.listingid, 'passenger_username', NEW.passenger_username, 'driver_username', NEW.driver_username, 'price', NEW.price, 'created_at', NEW.created_at));
+END;
+
+CREATE TRIGGER reservations_changelog_update AFTER UPDATE ON reservations BEGIN
+    INSERT INTO changelog (table_name, op, row_key, data)
+    VALUES ('reservations', 'update', json_object('id', NEW.id),
+            json_object('id', NEW.id, 'listingid', NEW.listingid, 'passenger_username', NEW.passenger_username, 'driver_username', NEW.driver_username, 'price', NEW.price, 'created_at', NEW.created_at));
+END;
+
+CREATE TRIGGER reservations_changelog_delete AFTER DELETE ON reservations BEGIN
+    INSERT INTO changelog (table_name, op, row_key, data)
+    VALUES ('reservations', CASE WHEN EXISTS (SELECT 1 FROM archiving) THEN 'archive' ELSE 'delete' END,
+            json_object('id', OLD.id), NULL);
+END;
@@ -0,0 +1,63 @@
+"""
+Shared fixtures: the services run in-process through Flask's test client.
+
+Each service is loaded once per session from its app.py, with DB_MODE=memory,
+inside a scratch directory holding its SQL file and key.txt.
+"""
+
+import importlib.util
+import os
+import shutil
+import sys
+
+import pytest
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+# The services import the shared common package from the repository root
+sys.path.insert(0, ROOT)
+SQL_FILES = {
+    'users': 'user.sql',
+    'availability': 'listings.sql',
+    'reservations': 'reservations.sql',
+    'payments': 'payments.sql',
+}
+
+
+@pytest.fixture(scope='session')
+def service_dir(tmp_path_factory):
+    """Scratch working directory with every service's SQL file and key.txt"""
+    path = tmp_path_factory.mktemp('services')
+    for name, sql in SQL_FILES.items():
+        shutil.copy(os.path.join(ROOT, name, sql), path)
+    shutil.copy(os.path.join(ROOT, 'key.txt'), path)
+    cwd = os.getcwd()
+    os.chdir(path)
+    yield path
+    os.chdir(cwd)
+
+
+@pytest.fixture(scope='session')
+def load_service(service_dir):
+    """load_service(name) imports <name>/app.py once per session"""
+    modules = {}
+    os.environ['DB_MODE'] = 'memory'
+    os.environ['BACKUP_INTERVAL'] = '0'
+
+    def load(name):
+        if name not in modules:
+            spec = importlib.util.spec_from_file_location(f"{name}_app", os.path.join(ROOT, name, 'app.py'))
+            module = importlib.util.module_from_spec(spec)
+            spec.loader.exec_module(module)
+            modules[name] = module
+        return modules[name]
+    return load
+
+
+@pytest.fixture
+def payments(load_service, monkeypatch):
+    """The payments service on a cleared database, trusting any token as the user it names"""
+    module = load_service('payments')
+    monkeypatch.setattr(module.verifier, 'verify',
+                        lambda token: {"valid": 1, "username": token, "exp": 2 ** 31})
+    module.app.test_client().get('/clear')
+    return module
@@ -0,0 +1,74 @@
+import time
+
+from flask import Flask
+
+from common.auth import sign_identity, read_identity, client_address, TokenVerifier
+from common.ratelimit import RateLimiter, Admission
+
+app = Flask(__name__)
+
+
+def test_identity_round_trip():
+    header = sign_identity('secret', 'token', {"valid": 1, "username": "ana"})
+    assert read_identity('secret', 'token', header, 30) == {"valid": 1, "username": "ana"}
+
+
+def test_identity_rejects_other_token_secret_or_stale_header():
+    header = sign_identity('secret', 'token', {"valid": 1})
+    assert read_identity('secret', 'other', header, 30) is None
+    assert read_identity('wrong', 'token', header, 30) is None
+    assert read_identity('secret', 'token', 'garbage', 30) is None
+    issued, payload, _ = header.split(':')
+    stale = sign_identity('secret', 'token', {"valid": 1}).replace(issued, str(int(issued) - 60), 1)
+    assert read_identity('secret', 'token', stale, 30) is None
+
+
+def test_client_address_from_gateway():
+    header = sign_identity('secret', '', {"client": "203.0.113.9"})
+    with app.test_request_context('/', headers={'X-Identity': header}, environ_base={'REMOTE_ADDR': '10.0.0.1'}):
+        assert client_address('secret', 30) == '203.0.113.9'
+        assert client_address('', 30) == '10.0.0.1'
+    forged = sign_identity('guess', '', {"client": "203.0.113.9"})
+    with app.test_request_context('/', headers={'X-Identity': forged}, environ_base={'REMOTE_ADDR': '10.0.0.1'}):
+        assert client_address('secret', 30) == '10.0.0.1'
+
+
+def test_verifier_trusts_gateway_identity_and_revocations():
+    verifier = TokenVerifier(upstream=None, poll_interval=60, max_staleness=30, cache_size=10,
+                             identity_secret='secret')
+    verifier.poller = object()  # no background poll
+    auth = {"valid": 1, "username": "ana", "user_id": 3, "jti": "j1", "iat": 0, "exp": time.time() + 60}
+    headers = {'Authorization': 'tok', 'X-Identity': sign_identity('secret', 'tok', auth)}
+    with app.test_request_context('/', headers=headers):
+        assert verifier.verify('tok') == auth
+        assert verifier.client_key() == 'user:ana'
+
+    verifier.revocations.add('jti:j1', time.time(), time.time() + 60)
+    with app.test_request_context('/', headers=headers):
+        assert verifier.verify('tok') == {"valid": 0}
+
+
+def test_rate_limiter_refills():
+    limiter = RateLimiter(rate=1000, burst=2, max_keys=10)
+    assert limiter.acquire('a') == 0
+    assert limiter.acquire('a') == 0
+    assert limiter.acquire('a') > 0
+    assert limiter.acquire('b') == 0
+    time.sleep(0.01)
+    assert limiter.acquire('a') == 0
+
+
+def test_admission_limits_public_endpoints_per_client():
+    limited = Flask(__name__)
+    limited.add_url_rule('/public', 'public', lambda: 'ok')
+    limited.add_url_rule('/internal', 'internal', lambda: 'ok')
+    admission = Admission(RateLimiter(rate=0.001, burst=1, max_keys=10), 4, {'internal'},
+                          lambda: client_address('', 30))
+    admission.install(limited)
+    client = limited.test_client()
+
+    assert client.get('/public').status_code == 200
+    response = client.get('/public')
+    assert response.status_code == 429 and int(response.headers['Retry-After']) >= 1
+    assert client.get('/public', environ_base={'REMOTE_ADDR': '10.0.0.2'}).status_code == 200
+    assert all(client.get('/internal').status_code == 200 for _ in range(3))
@@ -0,0 +1,75 @@
+import sqlite3
+
+import pytest
+
+
+@pytest.fixture
+def availability(load_service):
+    return load_service('availability')
+
+
+def test_day_listings_keep_listingid_and_price_order(availability):
+    listings = availability.DayListings()
+    for listingid, price in ((3, 20.0), (1, 15.0), (2, 15.0), (4, 5.0)):
+        listings.add(listingid, price, f"driver{listingid}")
+
+    assert [row[0] for row in listings.rows()] == [1, 2, 3, 4]
+    assert [row[0] for row in listings.rows_by_price()] == [4, 1, 2, 3]
+    assert listings.rows_by_price(min_price=15, max_price=15) == [(1, 15.0, 'driver1'), (2, 15.0, 'driver2')]
+    assert [row[0] for row in listings.rows_by_price(limit=2)] == [4, 1]
+
+
+def test_day_listings_remove(availability):
+    listings = availability.DayListings()
+    listings.add(1, 10.0, 'a')
+    listings.add(2, 10.0, 'b')
+
+    assert listings.remove(1)
+    assert not listings.remove(1)
+    assert listings.rows() == [(2, 10.0, 'b')]
+    assert listings.rows_by_price() == [(2, 10.0, 'b')]
+
+
+def test_listing_index_write_through_and_search(availability):
+    index = availability.ListingIndex()
+    index.add(1, 'Monday', '12.5', 'alice')
+    index.add(2, 'Monday', '8', 'bob')
+    index.add(3, 'Tuesday', '9', 'alice')
+    index.add(1, 'Friday', '1', 'carol')  # already indexed
+
+    assert len(index) == 3
+    assert index.search('Monday') == [(1, 12.5, 'alice'), (2, 8.0, 'bob')]
+    assert index.search('Monday', limit=1) == [(2, 8.0, 'bob')]
+    assert index.search('Friday') == []
+    assert index.search_days(['Monday', 'Tuesday'], max_price=9) == {
+        'Monday': [(2, 8.0, 'bob')], 'Tuesday': [(3, 9.0, 'alice')]}
+
+    index.remove(2)
+    index.remove(42)
+    assert index.search('Monday') == [(1, 12.5, 'alice')]
+
+
+def test_listing_index_load(availability):
+    conn = sqlite3.connect(':memory:')
+    conn.execute("CREATE TABLE listings (listingid INTEGER, price REAL, driver_username TEXT, day TEXT)")
+    conn.executemany("INSERT INTO listings VALUES (?, ?, ?, ?)",
+                     [(2, 7.0, 'bob', 'Sunday'), (1, 9.0, 'alice', 'Sunday'), (3, 1.0, 'carol', 'Someday')])
+    index = availability.ListingIndex()
+    index.load(conn)
+
+    assert len(index) == 2
+    assert index.search('Sunday') == [(1, 9.0, 'alice'), (2, 7.0, 'bob')]
+
+
+@pytest.mark.parametrize('query', ['price_weight=nan', 'rating_weight=inf', 'min_price=-inf', 'max_price=NaN',
+                                   'limit=-1', 'sort=worst'])
+def test_search_options_reject_invalid_values(availability, query):
+    with availability.app.test_request_context(f"/search?day=Monday&{query}"):
+        assert availability.get_search_options() is None
+
+
+def test_search_options_defaults(availability):
+    with availability.app.test_request_context("/search?day=Monday&min_price=2&limit=3"):
+        options = availability.get_search_options()
+    assert options["min_price"] == 2.0 and options["max_price"] is None and options["limit"] == 3
+    assert options["price_weight"] == availability.best_price_weight
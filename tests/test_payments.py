@@ -0,0 +1,38 @@
+from common.shards import shard_of, shard_file
+
+
+def test_shard_of_is_stable_and_in_range():
+    assert shard_of('ana', 4) == shard_of('ana', 4)
+    assert {shard_of(f"user{i}", 4) for i in range(200)} == {0, 1, 2, 3}
+    assert shard_of('ana', 1) == 0
+    assert shard_file(0, 1) == 'payments.db'
+    assert shard_file(2, 4) == 'payments-2-of-4.db'
+
+
+def test_idempotent_add_replays_and_refuses_a_different_body(payments):
+    client = payments.app.test_client()
+    headers = {'Authorization': 'ana', 'Idempotency-Key': 'k1'}
+
+    assert client.post('/add', data={'amount': '5'}, headers=headers).json == {"status": 1}
+    assert client.post('/add', data={'amount': '5'}, headers=headers).json == {"status": 1}
+    # The same parameters in another encoding are the same request
+    assert client.post('/add', json={'amount': '5'}, headers=headers).json == {"status": 1}
+    refused = client.post('/add', data={'amount': '6'}, headers=headers)
+    assert refused.status_code == 422
+
+    assert client.get('/view', headers={'Authorization': 'ana'}).json["balance"] == "5.00"
+
+
+def test_transfer_outcome_fences_a_late_transfer(payments):
+    client = payments.app.test_client()
+    client.post('/add', data={'amount': '10'}, headers={'Authorization': 'ana'})
+    body = {'from_username': 'ana', 'to_username': 'bo', 'amount': '4'}
+
+    outcome = client.post('/transfer_outcome', json={'operation': '/transfer', 'usernames': ['ana', 'bo']},
+                          headers={'Idempotency-Key': 't1'})
+    assert outcome.json == {"status": 1, "outcome": {"status": 2}}
+    assert client.post('/transfer', json=body, headers={'Idempotency-Key': 't1'}).json == {"status": 2}
+    assert client.get('/view', headers={'Authorization': 'ana'}).json["balance"] == "10.00"
+
+    assert client.post('/transfer', json=body, headers={'Idempotency-Key': 't2'}).json == {"status": 1}
+    assert client.get('/view', headers={'Authorization': 'ana'}).json["balance"] == "6.00"
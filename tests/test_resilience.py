@@ -0,0 +1,89 @@
+import logging
+import threading
+import time
+
+import pytest
+
+from common.resilience import CircuitBreaker, CircuitOpen, DeadlineExceeded, SingleFlight, freeze
+
+
+def test_circuit_breaker_opens_probes_and_closes():
+    breaker = CircuitBreaker('payments', failure_threshold=2, reset_timeout=0.05, logger=logging.getLogger(__name__))
+    breaker.before_call()
+    breaker.record_failure()
+    breaker.before_call()
+    breaker.record_failure()
+    assert breaker.state == 'open'
+    with pytest.raises(CircuitOpen):
+        breaker.before_call()
+
+    time.sleep(0.06)
+    breaker.before_call()  # the half-open probe
+    with pytest.raises(CircuitOpen):
+        breaker.before_call()  # only one probe at a time
+    breaker.record_success()
+    assert breaker.snapshot() == {"state": "closed", "failures": 0, "trips": 1, "rejected": 2}
+
+
+def test_circuit_breaker_failed_probe_reopens():
+    breaker = CircuitBreaker('user', failure_threshold=1, reset_timeout=0.05, logger=logging.getLogger(__name__))
+    breaker.record_failure()
+    time.sleep(0.06)
+    breaker.before_call()
+    breaker.record_failure()
+    assert breaker.state == 'open'
+    with pytest.raises(CircuitOpen):
+        breaker.before_call()
+
+
+def test_single_flight_coalesces_concurrent_calls():
+    flight = SingleFlight()
+    started = threading.Event()
+    release = threading.Event()
+    calls = []
+
+    def slow():
+        calls.append(1)
+        started.set()
+        release.wait(5)
+        return 'answer'
+
+    results = []
+    leader = threading.Thread(target=lambda: results.append(flight.do(('GET', 'url'), slow, 5)))
+    leader.start()
+    started.wait(5)
+    followers = [threading.Thread(target=lambda: results.append(flight.do(('GET', 'url'), slow, 5)))
+                 for _ in range(3)]
+    for follower in followers:
+        follower.start()
+    while flight.snapshot()["coalesced"] < 3:
+        time.sleep(0.001)
+    release.set()
+    for thread in [leader, *followers]:
+        thread.join()
+
+    assert calls == [1]
+    assert results == ['answer'] * 4
+    assert flight.snapshot() == {"issued": 1, "coalesced": 3, "timeouts": 0, "in_flight": 0}
+
+
+def test_single_flight_shares_errors_and_times_out_followers():
+    flight = SingleFlight()
+    with pytest.raises(ValueError):
+        flight.do(('GET', 'url'), lambda: (_ for _ in ()).throw(ValueError('boom')), 1)
+
+    release = threading.Event()
+    leader = threading.Thread(target=lambda: flight.do(('GET', 'slow'), lambda: release.wait(5), 5))
+    leader.start()
+    while not flight.snapshot()["in_flight"]:
+        time.sleep(0.001)
+    with pytest.raises(DeadlineExceeded):
+        flight.do(('GET', 'slow'), lambda: None, 0.01)
+    release.set()
+    leader.join()
+    assert flight.snapshot()["timeouts"] == 1
+
+
+def test_freeze_is_order_independent():
+    assert freeze({'b': [1, {'c': 2}], 'a': 1}) == freeze({'a': 1, 'b': [1, {'c': 2}]})
+    hash(freeze({'params': {'token': ['x']}}))
@@ -0,0 +1,40 @@
+import time
+
+from common.revocation import RevocationFilter
+
+
+def test_revoked_token_and_user():
+    revocations = RevocationFilter()
+    now = time.time()
+    revocations.add('jti:abc', now, now + 60)
+    revocations.add('user:7', now, now + 60)
+
+    assert revocations.is_revoked({'jti': 'abc', 'user_id': 1, 'iat': now})
+    assert revocations.is_revoked({'jti': 'other', 'user_id': 7, 'iat': int(now) - 1})
+    # A token issued in the second of the revocation, or later, is still good
+    assert not revocations.is_revoked({'jti': 'other', 'user_id': 7, 'iat': int(now)})
+    assert not revocations.is_revoked({'jti': 'other', 'user_id': 8, 'iat': 0})
+
+
+def test_apply_feed_deltas_and_epoch_reset():
+    revocations = RevocationFilter()
+    now = time.time()
+    revocations.apply({'epoch': 'e1', 'version': 2, 'entries': [
+        {'entry': 'jti:a', 'revoked_at': now, 'expires_at': now + 60},
+        {'entry': 'jti:gone', 'revoked_at': now, 'expires_at': now - 1}]})
+    assert revocations.version == 2 and revocations.refreshed_at >= now
+    assert revocations.is_revoked({'jti': 'a'})
+    assert 'jti:gone' not in revocations.entries
+
+    revocations.apply({'epoch': 'e2', 'version': 1, 'entries': []})
+    assert not revocations.is_revoked({'jti': 'a'})
+
+
+def test_bloom_filter_grows_with_entries():
+    revocations = RevocationFilter()
+    now = time.time()
+    for i in range(10000):
+        revocations.add(f"jti:{i}", now, now + 60)
+    assert revocations.bits >= 10000 * 16
+    assert all(revocations.is_revoked({'jti': str(i)}) for i in range(0, 10000, 997))
+    assert not revocations.is_revoked({'jti': 'missing'})
@@ -0,0 +1,35 @@
+import os
+import time
+
+
+def test_signing_key_rotation_keeps_old_key_for_grace(load_service, tmp_path):
+    users = load_service('users')
+    path = tmp_path / 'jwt_key.txt'
+    keys = users.SigningKeys(str(path), grace=0.2)
+    old_kid, old_key = keys.current()
+    assert path.read_text() == old_key
+
+    path.write_text('rotated-key')
+    os.utime(path, (time.time() + 5, time.time() + 5))
+    keys.reload()
+    new_kid, new_key = keys.current()
+    assert new_key == 'rotated-key' and new_kid != old_kid
+    assert keys.get(old_kid) == old_key
+
+    time.sleep(0.25)
+    assert keys.get(old_kid) is None
+    assert keys.get(new_kid) == 'rotated-key'
+
+
+def test_login_token_verifies(load_service):
+    users = load_service('users')
+    client = users.app.test_client()
+    client.get('/clear')
+    created = client.post('/create_user', data={
+        'first_name': 'Quin', 'last_name': 'Zed', 'username': 'rider', 'email_address': 'rider@x.com',
+        'password': 'Kite9Lamp!', 'salt': 's', 'driver': 'False', 'deposit': '0'})
+    assert created.json['status'] == 1
+    token = client.post('/login', data={'username': 'rider', 'password': 'Kite9Lamp!'}).json['jwt']
+
+    assert users.verify_jwt(token)['username'] == 'rider'
+    assert users.verify_jwt(token[:-2] + 'xx') is None
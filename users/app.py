@@ -5,67 +5,413 @@ Based on Project 1/2 code from pro222
 """
 
 import sqlite3
+import sys
 import os
 import hashlib
 import hmac
 import base64
 import json
-import requests
+import time
+import secrets
+import threading
 from flask import Flask, request, jsonify
 
+import common.db
+from common.wire import msgpack, WireJSONProvider, response_body, get_post_param
+from common.ratelimit import RateLimiter, Admission
+from common.upstream import Upstream
+from common.auth import client_address
+from common.transport import serve_unix_socket
+from common.revocation import RevocationFilter
+from common.db import QueryStats, ChangeNotifier, ChangesFeed
+from common.backup import Backups
+from common.archive import Archives
+from common.profiling import Profiling
+from common.metrics import Metrics
+from common.memory import MemoryDiagnostics
+
 app = Flask(__name__)
 db_name = "user.db"
 sql_file = "user.sql"
 db_flag = False
 
-# Read the secret key from key.txt
+# "file" keeps the database in db_name; "memory" uses a shared-cache in-memory
+# database (for tests) that /clear resets from a pristine snapshot
+db_mode = os.environ.get('DB_MODE', 'file')
+memory_anchor = None
+memory_pristine = None
+
+# With KEEP_DB=1 a service starts on the database files already there (restored or
+# bulk-loaded) instead of recreating them; /clear still resets. File mode only
+keep_db = os.environ.get('KEEP_DB', '0') == '1'
+
+# Statements slower than this are logged with their query plan
+slow_query_ms = float(os.environ.get('SLOW_QUERY_MS', '50'))
+
+# /changes long-polls wait at most CHANGES_MAX_WAIT seconds, re-reading the changelog every
+# CHANGES_POLL_INTERVAL for commits by other processes, and return up to CHANGES_BATCH_SIZE
+changes_max_wait = float(os.environ.get('CHANGES_MAX_WAIT', '25'))
+changes_poll_interval = float(os.environ.get('CHANGES_POLL_INTERVAL', '1'))
+changes_batch_size = int(os.environ.get('CHANGES_BATCH_SIZE', '1000'))
+# At most CHANGES_MAX_WAITERS /changes requests wait at once, each holding a thread; past
+# that a request that would wait gets 503 (wait=0 reads are never turned away)
+changes_max_waiters = int(os.environ.get('CHANGES_MAX_WAITERS', '32'))
+
+# Online backups: every BACKUP_INTERVAL seconds (0 turns the schedule off) the database is
+# copied into BACKUP_DIR/<UTC time>/, BACKUP_PAGES pages per step with BACKUP_SLEEP seconds
+# between steps. After BACKUP_MAX_RESTARTS restarts caused by concurrent writes, the rest
+# is copied in one step. The newest BACKUP_KEEP backups are kept
+backup_interval = float(os.environ.get('BACKUP_INTERVAL', '3600'))
+backup_dir = os.environ.get('BACKUP_DIR', 'backups')
+backup_pages = int(os.environ.get('BACKUP_PAGES', '64'))
+backup_sleep = float(os.environ.get('BACKUP_SLEEP', '0.005'))
+backup_max_restarts = int(os.environ.get('BACKUP_MAX_RESTARTS', '3'))
+backup_keep = int(os.environ.get('BACKUP_KEEP', '24'))
+
+# Memory diagnostics (opt-in): MEMORY_DIAGNOSTICS=1 starts tracemalloc with MEMORY_TRACE_FRAMES
+# frames per allocation, enables /internal/memory/snapshots and adds cache sizes in bytes to
+# /metrics. The newest MEMORY_SNAPSHOTS snapshots are kept for diffing
+memory_diagnostics = os.environ.get('MEMORY_DIAGNOSTICS', '0') == '1'
+memory_trace_frames = int(os.environ.get('MEMORY_TRACE_FRAMES', '1'))
+memory_snapshots_kept = int(os.environ.get('MEMORY_SNAPSHOTS', '8'))
+
+# Upper bounds (seconds) of the request latency histogram served at /metrics
+latency_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Rows older than the horizon are moved to monthly archive databases in archive_dir
+archive_horizon_days = int(os.environ.get('ARCHIVE_HORIZON_DAYS', '180'))
+archive_interval = float(os.environ.get('ARCHIVE_INTERVAL', '3600'))
+archive_dir = os.environ.get('ARCHIVE_DIR', 'archive')
+
+# End-to-end budget for a request without an X-Request-Timeout header, the cap on a
+# single upstream call, and when a target's circuit breaker opens and re-probes
+request_budget = float(os.environ.get('REQUEST_BUDGET', '10'))
+upstream_timeout = float(os.environ.get('UPSTREAM_TIMEOUT', '2'))
+breaker_failure_threshold = int(os.environ.get('BREAKER_FAILURE_THRESHOLD', '5'))
+breaker_reset_timeout = float(os.environ.get('BREAKER_RESET_TIMEOUT', '10'))
+
+# Encoding of service-to-service bodies: "msgpack" (when installed) or "json"
+wire_format = os.environ.get('WIRE_FORMAT', 'msgpack')
+
+# Base URL of each upstream service; "unix:///path/to.sock" reaches it over a Unix socket
+service_urls = {
+    'payments': os.environ.get('PAYMENTS_URL', 'http://payments:5000'),
+    'reservations': os.environ.get('RESERVATIONS_URL', 'http://reservations:5000')
+}
+
+# TCP port to serve on, and also this Unix socket path for co-located services
+port = int(os.environ.get('PORT', '5000'))
+unix_socket = os.environ.get('UNIX_SOCKET', '')
+
+# Token-bucket limits per (client, endpoint) and the cap on concurrent public requests
+rate_limit_rate = float(os.environ.get('RATE_LIMIT_RATE', '20'))
+rate_limit_burst = float(os.environ.get('RATE_LIMIT_BURST', '40'))
+rate_limit_max_clients = int(os.environ.get('RATE_LIMIT_MAX_CLIENTS', '100000'))
+public_concurrency = int(os.environ.get('PUBLIC_CONCURRENCY', '64'))
+
+# Shared secret for X-Identity headers signed by the gateway (empty ignores them), and how
+# long after signing one is accepted. Here they only carry the client's address for rate limiting
+identity_secret = os.environ.get('IDENTITY_SECRET', '')
+identity_ttl = float(os.environ.get('IDENTITY_TTL', '30'))
+
+# Opt-in profiling: requests signed with PROFILE_SECRET (X-Profile header) or a random
+# PROFILE_SAMPLE_RATE fraction are run under cProfile and saved to PROFILE_DIR
+profile_enabled = os.environ.get('PROFILE_ENABLED', '0') == '1'
+profile_secret = os.environ.get('PROFILE_SECRET', '')
+profile_sample_rate = float(os.environ.get('PROFILE_SAMPLE_RATE', '0'))
+profile_dir = os.environ.get('PROFILE_DIR', 'profiles')
+profile_max_files = int(os.environ.get('PROFILE_MAX_FILES', '200'))
+
+# Endpoints served on the internal lane, exempt from admission control
+internal_endpoints = {'get_user_info', 'get_rating', 'internal_verify_jwt', 'revoke_user', 'internal_revocations',
+                      'circuit_breakers', 'single_flight_stats', 'profile_summary', 'query_stats_report', 'changes_feed',
+                      'backups_report', 'take_backup', 'metrics', 'memory_report', 'take_memory_snapshot', 'memory_diff',
+                      'run_archive', 'clear_db'}
+
+# Read the password hashing secret from key.txt, once: it must never change under stored hashes
 with open('key.txt', 'r') as f:
     SECRET_KEY = f.read().strip()
 
+# JWT lifetime, signing key file and how long a rotated-out key stays valid. The signing key
+# file is created with a random key if missing, and never shares a file with SECRET_KEY.
+jwt_ttl = int(os.environ.get('JWT_TTL', '3600'))
+jwt_key_file = os.environ.get('JWT_KEY_FILE', 'jwt_key.txt')
+jwt_key_grace = int(os.environ.get('JWT_KEY_GRACE', str(jwt_ttl)))
+
+
+class SigningKeys:
+    """JWT signing keys by key ID.
+
+    The key file is re-read when it changes; the previous key is kept for
+    jwt_key_grace seconds so tokens signed before a rotation stay valid. A
+    missing key file is created with a random key.
+    """
+
+    def __init__(self, path, grace):
+        self.path = path
+        self.create_key_file()
+        self.grace = grace
+        self.current_kid = None
+        self.keys = {}
+        self.mtime = None
+        self.checked_at = 0.0
+        self.lock = threading.Lock()
+        self.reload()
+
+    def create_key_file(self):
+        try:
+            fd = os.open(self.path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        except FileExistsError:
+            return
+        with os.fdopen(fd, 'w') as f:
+            f.write(secrets.token_hex(32))
+
+    @staticmethod
+    def key_id(key):
+        return hashlib.sha256(key.encode()).hexdigest()[:16]
+
+    def reload(self):
+        now = time.time()
+        with self.lock:
+            self.checked_at = now
+            try:
+                mtime = os.stat(self.path).st_mtime
+            except OSError:
+                return
+            if mtime == self.mtime:
+                return
+            with open(self.path, 'r') as f:
+                key = f.read().strip()
+            self.mtime = mtime
+            kid = self.key_id(key)
+            if kid == self.current_kid:
+                return
+            if self.current_kid is not None:
+                old_key, _ = self.keys[self.current_kid]
+                self.keys[self.current_kid] = (old_key, now + self.grace)
+            self.keys[kid] = (key, None)
+            self.current_kid = kid
+            # Forget keys whose grace window has passed
+            for old_kid, (_, expires_at) in list(self.keys.items()):
+                if expires_at is not None and expires_at < now:
+                    del self.keys[old_kid]
+
+    def maybe_reload(self):
+        """Check the key file for rotation at most once a second"""
+        if time.time() - self.checked_at >= 1.0:
+            self.reload()
+
+    def current(self):
+        self.maybe_reload()
+        with self.lock:
+            return self.current_kid, self.keys[self.current_kid][0]
+
+    def get(self, kid):
+        self.maybe_reload()
+        with self.lock:
+            entry = self.keys.get(kid)
+        if entry is None:
+            return None
+        key, expires_at = entry
+        if expires_at is not None and expires_at < time.time():
+            return None
+        return key
+
+
+signing_keys = SigningKeys(jwt_key_file, jwt_key_grace)
+
+
+# Authoritative copy of the revocation list, written through by /logout and /revoke_user.
+# The epoch changes whenever the table is recreated so downstream filters know to reset.
+revocations = RevocationFilter()
+revocations_epoch = secrets.token_hex(8)
+
+
+upstream = Upstream(service_urls, request_budget, upstream_timeout, breaker_failure_threshold, breaker_reset_timeout,
+                    wire_format, public_concurrency, app.logger)
+upstream.install(app)
+
+
+def rate_limit_client():
+    """Rate-limit key: the verified user, or the client's address without a valid token"""
+    token = request.headers.get('Authorization')
+    if token:
+        claims = verify_jwt(token)
+        if claims:
+            return f"user:{claims['username']}"
+    return f"ip:{client_address(identity_secret, identity_ttl)}"
+
+rate_limiter = RateLimiter(rate_limit_rate, rate_limit_burst, rate_limit_max_clients)
+admission = Admission(rate_limiter, public_concurrency, internal_endpoints, rate_limit_client)
+admission.install(app)
+
+
+profiling = Profiling(profile_enabled, profile_secret, profile_sample_rate, profile_dir, profile_max_files)
+profiling.install(app)
+
+
+query_stats = QueryStats(slow_query_ms, app.logger)
+change_notifier = ChangeNotifier()
+TimedConnection = common.db.timed_connection(query_stats, change_notifier)
+query_stats.install(app)
+
+
+def backup_sources():
+    """(file name, connect function) for each database file a backup covers"""
+    return [(db_name, connect_db)] + archives.backup_sources('ratings')
+
+def prepare_backup():
+    if not db_flag:
+        create_db()
+
+# Held by archiving and by backups, so no row moves between the live copy and the archive copies
+archive_lock = threading.Lock()
+
+metrics = Metrics()
+# archive/ is in every backup, so restore can tell an empty archive from a backup without one
+backups = Backups(backup_dir, backup_pages, backup_sleep, backup_max_restarts, backup_keep, backup_interval,
+                  latency_buckets, app.logger, backup_sources, prepare=prepare_backup, hold=archive_lock,
+                  directories=('archive',))
+backups.install(app, metrics)
+metrics.install(app)
+
+# Caches and in-memory indexes whose size /metrics and /internal/memory report;
+# name -> function returning (object, number of entries)
+memory_caches = {
+    'revocations': lambda: (revocations, len(revocations.entries)),
+    'rate_limit_buckets': lambda: (rate_limiter.buckets, len(rate_limiter.buckets)),
+    'query_stats': lambda: (query_stats.stats, len(query_stats.stats))
+}
+
+memory = MemoryDiagnostics(memory_caches, memory_diagnostics, memory_trace_frames, memory_snapshots_kept)
+memory.install(app, metrics)
+
+def connect_db():
+    """Open a connection to the service database"""
+    if db_mode == 'memory':
+        return sqlite3.connect(f"file:{db_name}?mode=memory&cache=shared", uri=True, check_same_thread=False,
+                               factory=TimedConnection)
+    return sqlite3.connect(db_name, factory=TimedConnection)
+
 def create_db():
     """Create database from SQL file"""
-    conn = sqlite3.connect(db_name)
-    
-    with open(sql_file, 'r') as sql_startup:
-        init_db = sql_startup.read()
-    cursor = conn.cursor()
-    cursor.executescript(init_db)
-    conn.commit()
-    conn.close()
-    global db_flag
+    global memory_anchor, memory_pristine
+    if db_mode == 'memory' and memory_anchor is not None:
+        # Reset from the pristine snapshot instead of re-running the script
+        memory_pristine.backup(memory_anchor)
+        # A restored snapshot restarts the changelog, so it gets a new epoch
+        memory_anchor.execute("UPDATE changelog_epoch SET epoch = lower(hex(randomblob(8)))")
+        memory_anchor.commit()
+    else:
+        conn = connect_db()
+        
+        if not (keep_db and db_mode == 'file' and
+                conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'changelog_epoch'").fetchone()):
+            with open(sql_file, 'r') as sql_startup:
+                init_db = sql_startup.read()
+            cursor = conn.cursor()
+            cursor.executescript(init_db)
+            conn.commit()
+        if db_mode == 'memory':
+            # The in-memory database lives as long as this connection stays open
+            memory_anchor = conn
+            memory_pristine = sqlite3.connect(':memory:', check_same_thread=False)
+            conn.backup(memory_pristine)
+        else:
+            conn.close()
+    global db_flag, revocations, revocations_epoch
+    revocations = RevocationFilter()
+    revocations_epoch = secrets.token_hex(8)
     db_flag = True
 
 def get_db():
     """Get database connection, creating if necessary"""
     if not db_flag:
         create_db()
-    conn = sqlite3.connect(db_name)
+    conn = connect_db()
     # Enable foreign keys
     conn.execute("PRAGMA foreign_keys = ON")
     return conn
 
+changes_feed = ChangesFeed(change_notifier, get_db, changes_max_wait, changes_poll_interval, changes_batch_size,
+                           changes_max_waiters)
+changes_feed.install(app)
+
+archives = Archives(archive_dir, archive_horizon_days, archive_interval, archive_lock, get_db, TimedConnection,
+                    app.logger)
+
+
+def fold_rating_totals(cursor, where, parameters):
+    """Add ratings about to be archived to the per-user running totals"""
+    cursor.execute(f"""
+        INSERT INTO rating_totals (rated_id, rating_sum, rating_count)
+        SELECT rated_id, SUM(rating), COUNT(*) FROM main.ratings WHERE {where} GROUP BY rated_id
+        ON CONFLICT (rated_id) DO UPDATE SET
+            rating_sum = rating_sum + excluded.rating_sum,
+            rating_count = rating_count + excluded.rating_count
+    """, parameters)
+
+def archive_ratings():
+    """Move ratings older than the horizon into monthly archives, keeping averages intact"""
+    return archives.move_old_rows('ratings', """
+        CREATE TABLE IF NOT EXISTS archive.ratings (
+            id INTEGER PRIMARY KEY,
+            rater_id INTEGER NOT NULL,
+            rated_id INTEGER NOT NULL,
+            rating INTEGER NOT NULL,
+            created_at DATETIME
+        )
+    """, on_move=fold_rating_totals)
+
+def average_rating(cursor, user_id):
+    """Average rating over live ratings plus the totals of archived ones"""
+    cursor.execute("""
+        SELECT COALESCE(SUM(rating), 0) + COALESCE((SELECT rating_sum FROM rating_totals WHERE rated_id = ?), 0),
+               COUNT(*) + COALESCE((SELECT rating_count FROM rating_totals WHERE rated_id = ?), 0)
+        FROM ratings WHERE rated_id = ?
+    """, (user_id, user_id, user_id))
+    rating_sum, rating_count = cursor.fetchone()
+    return rating_sum / rating_count if rating_count else 0.00
+
 def hash_password(password, salt):
     """Hash password using HMAC-SHA256 with key (same as sadeghmo)"""
     salted = salt + password  # salt FIRST, then password
     return hmac.new(SECRET_KEY.encode(), salted.encode(), hashlib.sha256).hexdigest()
 
-def generate_jwt(username):
-    """Generate JWT token - payload only contains username (same as Project 2)"""
-    header = {"alg": "HS256", "typ": "JWT"}
-    payload = {"username": username}
+def b64url_encode(data):
+    """Base64url encode without padding"""
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode()
+
+def b64url_decode(data):
+    """Base64url decode, restoring any stripped padding"""
+    return base64.urlsafe_b64decode(data + '=' * (-len(data) % 4))
+
+def generate_jwt(user_id, username, is_driver):
+    """Generate a self-contained JWT carrying identity, role and expiry"""
+    kid, key = signing_keys.current()
+    now = int(time.time())
+    header = {"alg": "HS256", "typ": "JWT", "kid": kid}
+    payload = {
+        "username": username,
+        "user_id": user_id,
+        "is_driver": 1 if is_driver else 0,
+        "iat": now,
+        "exp": now + jwt_ttl,
+        "jti": secrets.token_hex(8)
+    }
     
     # Encode header and payload
-    header_encoded = base64.urlsafe_b64encode(json.dumps(header).encode()).decode()
-    payload_encoded = base64.urlsafe_b64encode(json.dumps(payload).encode()).decode()
+    header_encoded = b64url_encode(json.dumps(header, separators=(',', ':')).encode())
+    payload_encoded = b64url_encode(json.dumps(payload, separators=(',', ':')).encode())
     
     # Create signature
     message = f"{header_encoded}.{payload_encoded}"
-    signature = hmac.new(SECRET_KEY.encode(), message.encode(), hashlib.sha256).hexdigest()
+    signature = b64url_encode(hmac.new(key.encode(), message.encode(), hashlib.sha256).digest())
     
     return f"{header_encoded}.{payload_encoded}.{signature}"
 
 def verify_jwt(token):
-    """Verify JWT token and return username if valid"""
+    """Verify JWT token and return its claims if valid and unexpired"""
     try:
         parts = token.split('.')
         if len(parts) != 3:
@@ -73,16 +419,30 @@ def verify_jwt(token):
             
         header_encoded, payload_encoded, signature = parts
         
+        # Pick the signing key named by the header
+        header = json.loads(b64url_decode(header_encoded))
+        if header.get('alg') != 'HS256':
+            return None
+        key = signing_keys.get(header.get('kid'))
+        if key is None:
+            return None
+        
         # Verify signature
         message = f"{header_encoded}.{payload_encoded}"
-        expected_signature = hmac.new(SECRET_KEY.encode(), message.encode(), hashlib.sha256).hexdigest()
+        expected_signature = b64url_encode(hmac.new(key.encode(), message.encode(), hashlib.sha256).digest())
         
         if not hmac.compare_digest(signature, expected_signature):
             return None
             
         # Decode payload
-        payload = json.loads(base64.urlsafe_b64decode(payload_encoded).decode())
-        return payload.get('username')
+        claims = json.loads(b64url_decode(payload_encoded))
+        if not claims.get('username') or 'user_id' not in claims or 'is_driver' not in claims:
+            return None
+        if claims.get('exp', 0) <= time.time():
+            return None
+        if revocations.is_revoked(claims):
+            return None
+        return claims
     except:
         return None
 
@@ -125,29 +485,9 @@ def get_jwt_from_header():
         return None
     return auth_header
 
-def get_post_param(param_name):
-    """Robustly extract a POST parameter from form, JSON, or raw body."""
-    # 1) Standard form field
-    value = request.form.get(param_name)
-    if value is not None and value != "":
-        return value
-    # 2) JSON body
-    try:
-        json_body = request.get_json(silent=True)
-        if isinstance(json_body, dict) and param_name in json_body and json_body[param_name] != "":
-            return json_body[param_name]
-    except:
-        pass
-    # 3) URL-encoded raw body fallback
-    try:
-        from urllib.parse import parse_qs
-        raw = request.get_data(as_text=True) or ""
-        parsed = parse_qs(raw, keep_blank_values=True)
-        if param_name in parsed and len(parsed[param_name]) > 0:
-            return parsed[param_name][0]
-    except:
-        pass
-    return None
+
+app.json = WireJSONProvider(app)
+
 
 @app.route('/clear', methods=['GET'])
 def clear_db():
@@ -157,15 +497,19 @@ def clear_db():
         global db_flag
         db_flag = False
         
-        try:
+        if db_mode == 'file':
+            try:
+                if os.path.exists(db_name):
+                    temp_conn = sqlite3.connect(db_name)
+                    temp_conn.close()
+            except:
+                pass
+            
             if os.path.exists(db_name):
-                temp_conn = sqlite3.connect(db_name)
-                temp_conn.close()
-        except:
-            pass
+                os.remove(db_name)
         
-        if os.path.exists(db_name):
-            os.remove(db_name)
+        # Archived partitions belong to the database being cleared
+        archives.remove('ratings')
         
         create_db()
         return jsonify({"status": 1})
@@ -176,7 +520,7 @@ def clear_db():
             except:
                 pass
         try:
-            if os.path.exists(db_name):
+            if db_mode == 'file' and os.path.exists(db_name):
                 os.remove(db_name)
             db_flag = False
             create_db()
@@ -265,8 +609,8 @@ def create_user():
         # Initialize balance in payments service
         # Note: In docker, use service name 'payments', locally use localhost
         try:
-            payments_url = os.environ.get('PAYMENTS_URL', 'http://payments:5000/initialize')
-            requests.post(payments_url, data={'username': username, 'amount': deposit}, timeout=2)
+            payments_url = upstream.service_url('payments', '/initialize')
+            upstream.request('POST', 'payments', payments_url, data={'username': username, 'amount': deposit})
         except:
             # If payments service not available, continue anyway
             pass
@@ -293,14 +637,14 @@ def login():
         cursor = conn.cursor()
         
         # Get user data
-        cursor.execute("SELECT pass_hash, salt FROM users WHERE username = ?", (username,))
+        cursor.execute("SELECT id, is_driver, pass_hash, salt FROM users WHERE username = ?", (username,))
         user_data = cursor.fetchone()
         
         if not user_data:
             conn.close()
             return jsonify({"status": 2, "jwt": "NULL"})
         
-        stored_hash, salt = user_data
+        user_id, is_driver, stored_hash, salt = user_data
         
         # Verify password
         computed_hash = hash_password(password, salt)
@@ -310,7 +654,7 @@ def login():
             return jsonify({"status": 2, "jwt": "NULL"})
         
         # Generate JWT
-        jwt_token = generate_jwt(username)
+        jwt_token = generate_jwt(user_id, username, is_driver)
         
         conn.close()
         return jsonify({"status": 1, "jwt": jwt_token})
@@ -331,9 +675,10 @@ def rate():
             return jsonify({"status": 2})
         
         # Verify JWT
-        rater_username = verify_jwt(jwt_token)
-        if not rater_username:
+        claims = verify_jwt(jwt_token)
+        if not claims:
             return jsonify({"status": 2})
+        rater_username = claims['username']
         
         # Get parameters
         rated_username = get_post_param('username')
@@ -389,12 +734,11 @@ def rate():
         # Verify they have a confirmed reservation
         # Check with reservations service
         try:
-            reservations_url = os.environ.get('RESERVATIONS_URL', 'http://reservations:5000/check_reservation')
-            check_response = requests.post(reservations_url, 
+            reservations_url = upstream.service_url('reservations', '/check_reservation')
+            check_response = upstream.request('POST', 'reservations', reservations_url,
                 data={'rater': rater_username, 'rated': rated_username},
-                headers={'Authorization': jwt_token},
-                timeout=2)
-            if check_response.status_code != 200 or check_response.json().get('status') != 1:
+                headers={'Authorization': jwt_token})
+            if check_response.status_code != 200 or response_body(check_response).get('status') != 1:
                 conn.close()
                 return jsonify({"status": 2})
         except:
@@ -439,12 +783,7 @@ def get_user_info():
         user_id, is_driver = user_data
         
         # Calculate average rating
-        cursor.execute("SELECT AVG(rating) FROM ratings WHERE rated_id = ?", (user_id,))
-        rating_result = cursor.fetchone()[0]
-        if rating_result is None:
-            rating_avg = 0.00
-        else:
-            rating_avg = float(rating_result)
+        rating_avg = average_rating(cursor, user_id)
         
         conn.close()
         
@@ -481,12 +820,7 @@ def get_rating():
         user_id = user_data[0]
         
         # Calculate average rating
-        cursor.execute("SELECT AVG(rating) FROM ratings WHERE rated_id = ?", (user_id,))
-        rating_result = cursor.fetchone()[0]
-        if rating_result is None:
-            rating_avg = 0.00
-        else:
-            rating_avg = float(rating_result)
+        rating_avg = average_rating(cursor, user_id)
         
         conn.close()
         
@@ -507,21 +841,137 @@ def internal_verify_jwt():
     if not token:
         return jsonify({"valid": 0})
     
-    username = verify_jwt(token)
-    if not username:
+    # Identity comes straight from the signed claims, no database lookup
+    claims = verify_jwt(token)
+    if not claims:
         return jsonify({"valid": 0})
     
+    return jsonify({
+        "valid": 1,
+        "username": claims['username'],
+        "is_driver": claims['is_driver'],
+        "user_id": claims['user_id'],
+        "iat": claims.get('iat'),
+        "exp": claims['exp'],
+        "jti": claims.get('jti')
+    })
+
+def revoke(entry, revoked_at, expires_at):
+    """Record a revocation and apply it to the local filter"""
     conn = get_db()
     cursor = conn.cursor()
-    cursor.execute("SELECT id, is_driver FROM users WHERE username = ?", (username,))
-    user = cursor.fetchone()
+    cursor.execute("""
+        INSERT INTO revocations (entry, revoked_at, expires_at)
+        VALUES (?, ?, ?)
+    """, (entry, revoked_at, expires_at))
+    conn.commit()
     conn.close()
-    
-    if not user:
-        return jsonify({"valid": 0})
-    
-    return jsonify({"valid": 1, "username": username, "is_driver": user[1], "user_id": user[0]})
+    revocations.add(entry, revoked_at, expires_at)
+
+@app.route('/logout', methods=['POST'])
+def logout():
+    """Revoke the caller's token"""
+    try:
+        jwt_token = get_jwt_from_header()
+        if not jwt_token:
+            return jsonify({"status": 2})
+        
+        claims = verify_jwt(jwt_token)
+        if not claims or not claims.get('jti'):
+            return jsonify({"status": 2})
+        
+        revoke(f"jti:{claims['jti']}", time.time(), claims['exp'])
+        return jsonify({"status": 1})
+        
+    except Exception as e:
+        return jsonify({"status": 2})
+
+@app.route('/revoke_user', methods=['POST'])
+def revoke_user():
+    """Internal endpoint to revoke every token issued to a user so far"""
+    conn = None
+    try:
+        username = get_post_param('username')
+        if not username:
+            return jsonify({"status": 2})
+        
+        conn = get_db()
+        cursor = conn.cursor()
+        cursor.execute("SELECT id FROM users WHERE username = ?", (username,))
+        user_data = cursor.fetchone()
+        conn.close()
+        conn = None
+        if not user_data:
+            return jsonify({"status": 2})
+        
+        # Tokens issued up to now are revoked; they all expire within jwt_ttl
+        now = time.time()
+        revoke(f"user:{user_data[0]}", now, now + jwt_ttl)
+        return jsonify({"status": 1})
+        
+    except Exception as e:
+        if conn:
+            conn.close()
+        return jsonify({"status": 2})
+
+@app.route('/internal/revocations', methods=['GET'])
+def internal_revocations():
+    """Internal endpoint serving revocations added after version `since`.
+
+    Callers from a different epoch (or none) get the full live list instead.
+    """
+    conn = None
+    try:
+        try:
+            since = int(request.args.get('since', '0'))
+        except:
+            since = 0
+        if request.args.get('epoch') != revocations_epoch:
+            since = 0
+        
+        conn = get_db()
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT version, entry, revoked_at, expires_at
+            FROM revocations
+            WHERE version > ? AND expires_at > ?
+            ORDER BY version
+        """, (since, time.time()))
+        rows = cursor.fetchall()
+        cursor.execute("SELECT MAX(version) FROM revocations")
+        version = cursor.fetchone()[0] or 0
+        conn.close()
+        
+        return jsonify({
+            "status": 1,
+            "epoch": revocations_epoch,
+            "version": version,
+            "entries": [{"entry": entry, "revoked_at": revoked_at, "expires_at": expires_at}
+                        for _, entry, revoked_at, expires_at in rows]
+        })
+        
+    except Exception as e:
+        if conn:
+            conn.close()
+        return jsonify({"status": 2})
+
+@app.route('/internal/archive', methods=['POST'])
+def run_archive():
+    """Internal endpoint to run rating archival now"""
+    try:
+        return jsonify({"status": 1, "moved": archive_ratings()})
+    except Exception as e:
+        return jsonify({"status": 2, "moved": 0})
 
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=5000, debug=False)
+    if os.path.realpath(jwt_key_file) == os.path.realpath('key.txt'):
+        sys.exit("JWT_KEY_FILE must not be key.txt: rotating it would change the password hashing secret")
+    memory.start()
+    if archive_interval > 0:
+        archives.start(archive_ratings)
+    if backup_interval > 0:
+        backups.start()
+    if unix_socket:
+        serve_unix_socket(app, unix_socket)
+    app.run(host='0.0.0.0', port=port, debug=False)
 
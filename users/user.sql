@@ -1,3 +1,8 @@
+DROP TABLE IF EXISTS changelog;
+DROP TABLE IF EXISTS changelog_epoch;
+DROP TABLE IF EXISTS archiving;
+DROP TABLE IF EXISTS revocations;
+DROP TABLE IF EXISTS rating_totals;
 DROP TABLE IF EXISTS ratings;
 DROP TABLE IF EXISTS password_history;
 DROP TABLE IF EXISTS users;
@@ -32,3 +37,102 @@ CREATE TABLE ratings (
     FOREIGN KEY (rated_id) REFERENCES users (id) ON DELETE CASCADE
 );
 
+CREATE INDEX idx_ratings_created_at ON ratings (created_at);
+
+-- Sum and count of each user's archived ratings, so averages survive archival
+CREATE TABLE rating_totals (
+    rated_id INTEGER PRIMARY KEY,
+    rating_sum INTEGER NOT NULL,
+    rating_count INTEGER NOT NULL,
+    FOREIGN KEY (rated_id) REFERENCES users (id) ON DELETE CASCADE
+);
+
+-- Holds a row while archive_old_rows moves rows to the archives, so the changelog
+-- records those deletes as 'archive' rather than 'delete'
+CREATE TABLE archiving (
+    active INTEGER NOT NULL
+);
+
+CREATE TABLE revocations (
+    version INTEGER PRIMARY KEY AUTOINCREMENT,
+    entry TEXT NOT NULL,
+    revoked_at REAL NOT NULL,
+    expires_at REAL NOT NULL
+);
+
+-- Change-data capture: every insert, update and delete on the tables below gets a
+-- row here (in commit order, as SQLite has one writer at a time), served by /changes
+CREATE TABLE changelog (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    table_name TEXT NOT NULL,
+    op TEXT NOT NULL,
+    row_key TEXT NOT NULL,
+    data TEXT,
+    changed_at REAL NOT NULL DEFAULT ((julianday('now') - 2440587.5) * 86400.0)
+);
+
+-- Identifies this incarnation of the database, so feed readers notice a reset
+CREATE TABLE changelog_epoch (
+    epoch TEXT NOT NULL
+);
+
+INSERT INTO changelog_epoch (epoch) VALUES (lower(hex(randomblob(8))));
+
+-- Keep a day of changes, pruning every 1000 entries
+CREATE TRIGGER changelog_prune AFTER INSERT ON changelog WHEN NEW.seq % 1000 = 0 BEGIN
+    DELETE FROM changelog WHERE changed_at < NEW.changed_at - 86400;
+END;
+
+-- Password hashes and salts never enter the changelog
+
+CREATE TRIGGER users_changelog_insert AFTER INSERT ON users BEGIN
+    INSERT INTO changelog (table_name, op, row_key, data)
+    VALUES ('users', 'insert', json_object('id', NEW.id),
+            json_object('id', NEW.id, 'first_name', NEW.first_name, 'last_name', NEW.last_name, 'username', NEW.username, 'email_address', NEW.email_address, 'is_driver', NEW.is_driver, 'password_created_at', NEW.password_created_at));
+END;
+
+CREATE TRIGGER users_changelog_update AFTER UPDATE ON users BEGIN
+    INSERT INTO changelog (table_name, op, row_key, data)
+    VALUES ('users', 'update', json_object('id', NEW.id),
+            json_object('id', NEW.id, 'first_name', NEW.first_name, 'last_name', NEW.last_name, 'username', NEW.username, 'email_address', NEW.email_address, 'is_driver', NEW.is_driver, 'password_created_at', NEW.password_created_at));
+END;
+
+CREATE TRIGGER users_changelog_delete AFTER DELETE ON users BEGIN
+    INSERT INTO changelog (table_name, op, row_key, data)
+    VALUES ('users', 'delete', json_object('id', OLD.id), NULL);
+END;
+
+CREATE TRIGGER ratings_changelog_insert AFTER INSERT ON ratings BEGIN
+    INSERT INTO changelog (table_name, op, row_key, data)
+    VALUES ('ratings', 'insert', json_object('id', NEW.id),
+            json_object('id', NEW.id, 'rater_id', NEW.rater_id, 'rated_id', NEW.rated_id, 'rating', NEW.rating, 'created_at', NEW.created_at));
+END;
+
+CREATE TRIGGER ratings_changelog_update AFTER UPDATE ON ratings BEGIN
+    INSERT INTO changelog (table_name, op, row_key, data)
+    VALUES ('ratings', 'update', json_object('id', NEW.id),
+            json_object('id', NEW.id, 'rater_id', NEW.rater_id, 'rated_id', NEW.rated_id, 'rating', NEW.rating, 'created_at', NEW.created_at));
+END;
+
+CREATE TRIGGER ratings_changelog_delete AFTER DELETE ON ratings BEGIN
+    INSERT INTO changelog (table_name, op, row_key, data)
+    VALUES ('ratings', CASE WHEN EXISTS (SELECT 1 FROM archiving) THEN 'archive' ELSE 'delete' END,
+            json_object('id', OLD.id), NULL);
+END;
+
+CREATE TRIGGER rating_totals_changelog_insert AFTER INSERT ON rating_totals BEGIN
+    INSERT INTO changelog (table_name, op, row_key, data)
+    VALUES ('rating_totals', 'insert', json_object('rated_id', NEW.rated_id),
+            json_object('rated_id', NEW.rated_id, 'rating_sum', NEW.rating_sum, 'rating_count', NEW.rating_count));
+END;
+
+CREATE TRIGGER rating_totals_changelog_update AFTER UPDATE ON rating_totals BEGIN
+    INSERT INTO changelog (table_name, op, row_key, data)
+    VALUES ('rating_totals', 'update', json_object('rated_id', NEW.rated_id),
+            json_object('rated_id', NEW.rated_id, 'rating_sum', NEW.rating_sum, 'rating_count', NEW.rating_count));
+END;
+
+CREATE TRIGGER rating_totals_changelog_delete AFTER DELETE ON rating_totals BEGIN
+    INSERT INTO changelog (table_name, op, row_key, data)
+    VALUES ('rating_totals', 'delete', json_object('rated_id', OLD.rated_id), NULL);
+END;